@@ -9,11 +9,10 @@ University Hospital Cologne
 """
 
 
-import nipype.interfaces.fsl as fsl
 import os,sys
 import nibabel as nii
 import numpy as np
-import applyMICO
+from niftiScale import scaleBy10
 import subprocess
 import shutil
 
@@ -45,9 +44,10 @@ def reset_orientation(input_file):
 
 def applyBET(input_file,frac,radius,vertical_gradient):
     """Apply BET"""
+    import nipype.interfaces.fsl as fsl
     # scale Nifti data by factor 10
     data = nii.load(input_file)
-    imgTemp = data.get_fdata()
+    imgTemp = np.asanyarray(data.dataobj)  # keeps the on-disk data type
     scale = np.eye(4)* 10
     scale[3][3] = 1
 
@@ -62,7 +62,7 @@ def applyBET(input_file,frac,radius,vertical_gradient):
     hdrIn.set_xyzt_units('mm')
     scaledNiiData = nii.as_closest_canonical(scaledNiiData)
 
-    fslPath = os.path.join(os.path.dirname(input_file),'fslScaleTemp.nii.gz')
+    fslPath = os.path.join(os.path.dirname(input_file),'fslScaleTemp.nii')  # uncompressed, only read by BET
     nii.save(scaledNiiData, fslPath)
 
     # extract brain
@@ -74,20 +74,13 @@ def applyBET(input_file,frac,radius,vertical_gradient):
     os.remove(fslPath)
 
     # unscale result data by factor 10ˆ(-1)
-    dataOut = nii.load(output_file)
-    imgOut = dataOut.get_fdata()
-    scale = np.eye(4)/ 10
-    scale[3][3] = 1
-
-    unscaledNiiData = nii.Nifti1Image(imgOut, dataOut.affine * scale)
-    hdrOut = unscaledNiiData.header
-    hdrOut.set_xyzt_units('mm')
-    nii.save(unscaledNiiData, output_file)
+    output_file = scaleBy10(output_file, inv=True)
     return output_file
 
 #%% Program
 
-if __name__ == "__main__":
+def main(argv=None):
+    import applyMICO
     import argparse
 
 
@@ -128,8 +121,15 @@ if __name__ == "__main__":
         type=float, 
         default=0.0,
         )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='Number of worker processes for the bias field correction, slices are corrected in parallel - default=1',
+        type=int,
+        default=1,
+        )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # set Parameters
     input_file = None
@@ -152,7 +152,7 @@ if __name__ == "__main__":
     print("Starting Biasfieldcorrection:")
     if bias_skip == 0:
         try:
-            outputMICO = applyMICO.run_MICO(input_file,os.path.dirname(input_file))
+            outputMICO = applyMICO.run_MICO(input_file,os.path.dirname(input_file),workers=args.workers)
             print("Biasfieldcorrecttion was successful")
         except Exception as e:
             print(f'Fehler in der Biasfieldcorrecttion\nFehlermeldung: {str(e)}')
@@ -170,14 +170,7 @@ if __name__ == "__main__":
         raise
     
     print("Preprocessing completed")
- 
-
-
-
-
-
-
-
-
 
 
+if __name__ == "__main__":
+    main()
@@ -174,7 +174,7 @@ def find_mask(inputVolume):
     return glob.glob(os.path.join(directory, '*Stroke_mask.nii.gz'))
 
 
-if __name__ == "__main__":
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser(description='Registration from ABA to T2 Data')
@@ -202,7 +202,7 @@ if __name__ == "__main__":
                         default=os.path.abspath(
                             os.path.join(os.getcwd(), os.pardir, os.pardir)) + '/lib/annoVolume+2000_rsfMRI.nii.gz')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     inputVolume = None
     allenBrain_template = None
@@ -278,4 +278,5 @@ if __name__ == "__main__":
     print("Registration completed")
 
 
-
+if __name__ == "__main__":
+    main()
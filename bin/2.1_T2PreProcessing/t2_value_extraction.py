@@ -1,10 +1,10 @@
 import nibabel as nii
-import numpy as np
 import argparse
 import os
 import glob
 import csv
 import sys  # Added import statement for sys module
+from labelStats import labelStats
 
 def getOutfile(atlas_type, img_file, suffix):
     imgName = os.path.basename(img_file)
@@ -13,55 +13,42 @@ def getOutfile(atlas_type, img_file, suffix):
     outFile = os.path.join(os.path.dirname(img_file),"t2_values_extraction",f"{t2map}_T2values_{acronym_name}_{suffix}.csv")
     return outFile
 
+def readAcronyms(txt_file):
+    # {ARA ID: acronym} of a tab separated acronym file
+    with open(txt_file) as infile:
+        return {int(line.split('\t')[0]): line.split('\t')[1].strip() for line in infile}
+
 def extractT2MapdataMean(img, rois, outfile, txt_file):
-    slices = np.unique(np.where(rois > 0)[2])
-    regions = np.delete(np.unique(rois), 0)
-    
-    indices = None
-    if txt_file is not None:
-        ref_lines = open(txt_file).readlines()
-        indices = {int(line.split('\t')[0]): line.split('\t')[1].strip() for line in ref_lines}
+    # mean T2 value and size of every region within every slice
+    indices = readAcronyms(txt_file) if txt_file is not None else {}
+    stats = labelStats(img, rois, perSlice=True)
     
     with open(outfile, 'w', newline='') as csvfile:
         csv_writer = csv.writer(csvfile)
         csv_writer.writerow(["Slice", "ARA IDs", "Names", "T2 Values", "Region Sizes"])
         
-        for s in slices:
-            for r in regions:
-                region_voxels = np.where((rois[:, :, s] == r) & (rois[:, :, s] > 0))
-                if len(region_voxels[0]) == 0:
-                    continue
-                mean_value = np.mean(img[region_voxels])
-                region_size = len(region_voxels[0])
-                acro = indices.get(r, "")  # Using dict.get() to avoid KeyError
-                csv_writer.writerow([s, r, acro, "%.2f" % mean_value, "%.2f" % region_size])
+        for s, r, mean_value, region_size in zip(stats["slice"], stats["label"], stats["mean"], stats["count"]):
+            acro = indices.get(r, "")  # Using dict.get() to avoid KeyError
+            csv_writer.writerow([s, r, acro, "%.2f" % mean_value, "%.2f" % region_size])
 
 def extractT2MapdataPerRegion(img, rois, outfile, txt_file):
-    regions = np.delete(np.unique(rois), 0)
-    
-    indices = None
-    if txt_file is not None:
-        ref_lines = open(txt_file).readlines()
-        indices = {int(line.split('\t')[0]): line.split('\t')[1].strip() for line in ref_lines}
+    # mean T2 value and size of every region
+    indices = readAcronyms(txt_file) if txt_file is not None else {}
+    stats = labelStats(img, rois)
     
     with open(outfile, 'w', newline='') as csvfile:
         csv_writer = csv.writer(csvfile)
         csv_writer.writerow(["ARA IDs", "Names", "T2 Values", "Region Sizes"])
         
-        for r in regions:
-            region_voxels = np.where((rois == r) & (rois > 0))
-            if len(region_voxels[0]) == 0:
-                continue
-            mean_value = np.mean(img[region_voxels])
-            region_size = len(region_voxels[0])
+        for r, mean_value, region_size in zip(stats["label"], stats["mean"], stats["count"]):
             acro = indices.get(r, "")  # Using dict.get() to avoid KeyError
             csv_writer.writerow([r, acro, "%.2f" % mean_value, "%.2f" % region_size])
 
-if __name__ == '__main__':
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Extracts the T2w values for every atlas region')
     requiredNamed = parser.add_argument_group('Required named arguments')
     requiredNamed.add_argument('-i', '--input', help='Input T2w file, should be a nifti file')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     acronyms_files = glob.glob(os.path.join(os.getcwd(), "*.txt"))
     print(f"Extracting T2 values for: {args.input}")
@@ -108,3 +95,7 @@ if __name__ == '__main__':
             raise  # Raising the exception to halt execution
 
     print("Finished T2 map processing")
+
+
+if __name__ == '__main__':
+    main()
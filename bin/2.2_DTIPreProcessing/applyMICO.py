@@ -24,16 +24,12 @@ import numpy as np
 import nibabel as nii
 import sys,os
 import MICO
-import progressbar
-import cv2
-from tqdm import tqdm
 
-def run_MICO(IMGdata,outputPath):
+def run_MICO(IMGdata,outputPath,workers=1,seed=0,iterNum=100,tol=1e-5,warmStart=False):
     data = nii.load(IMGdata)
 
     # get UNSCALED img data
     vol = data.get_fdata()
-    biasCorrectedVol = np.zeros(vol.shape[0:3])
 
     #1) Scaling factor depending on image intensity
     ImgMe = np.mean(vol)
@@ -68,8 +64,6 @@ def run_MICO(IMGdata,outputPath):
     print("------------------------------------------------------------\n")
     #--- Ende Debug ---
 
-    progressbar = tqdm(total=vol.shape[2], desc='Biasfieldcorrection')
-
     #Debug output
     print(f"Amount of non-zero voxels in total volumen: {nz_all.size}")
     print(
@@ -77,93 +71,30 @@ def run_MICO(IMGdata,outputPath):
     print(f"Global ROI-threshold of volume: {global_thr:.3f}")
     #--- Ende Debug output --
 
-    # 3) loop over slices, ROI with global threshold
-    for idx in range(vol.shape[2]):
-
-        Img = vol[:,:,idx] / nCvalue
-        kernel =np.ones((5,5),np.uint8)
-        erosion = cv2.erode(Img,kernel,iterations = 1)
-
-        iterNum = 100
-        N_region = 1
-        q = 1
-        A = 1
-        Img_original = Img
-
-        nrow = Img.shape[0]
-        ncol = Img.shape[1]
-        n = nrow * ncol
-
-        #Global ROI thresholding
-        if global_thr > 0:
-            ROIt = Img > global_thr
-        else:
-            # Fallback: simple non-zero thresholding
-            ROIt = Img > 0
-
-        ROI = np.zeros((nrow, ncol))
-        ROI[ROIt] = 1
-
-        Bas = getBasisOrder3(nrow, ncol)
-
-        N_bas = Bas.shape[2]
-
-        ImgG = np.zeros([nrow,ncol,10])
-        GGT = np.zeros([nrow, ncol, 10,10])
-
-        for ii in range(N_bas):
-            ImgG[:,:,ii] = Img * Bas[:,:, ii]*ROI
-            for jj in range(N_bas):
-                GGT[:,:,ii, jj] = Bas[:,:, ii]*Bas[:,:, jj]*ROI
-                GGT[:,:,jj, ii] = GGT[:,:,ii, jj]
-
-        energy_MICO = np.zeros([3, iterNum])
-
-        b = np.ones([nrow,ncol])
-
-        for ini_num  in range(1):
-            C = np.random.rand(3, 1)
-            C = C * A
-            M = np.random.rand(nrow, ncol, 3)
-            a = np.sum(M, 2)
-            for k in range(N_region):
-                M[:,:, k]=M[:,:, k]/ a
-
-            e_max = np.amax(M,2)
-            N_max = np.argmax(M,2)
-
-            M_old = M
-            chg = 10000
-
-            energy_MICO[ini_num, 0] = get_energy(Img, b, C, M, ROI, q)
-
-            for n in range(1,iterNum):
-                M, b, C = MICO.runMICO(Img, q, ROI, M, C, b, Bas, GGT, ImgG, 1, 1)
-                energy_MICO[ini_num, n] = get_energy(Img, b, C, M, ROI, q)
-                if np.mod(n, 1) == 0:
-                    PC = np.zeros([nrow,ncol])
-                    for k in range(N_region):
-                        PC = PC + C[k] * M[:,:, k]
-                        img_bc = Img /b # bias field corrected image
-                        smV = img_bc < 0
-                        img_bc[smV] = 0
-                        smV = img_bc > 5000
-                        img_bc[smV] = 0
-
-
-
+    # 3) stack all slices, ROI with global threshold
+    Img = np.moveaxis(vol_norm, 2, 0)
 
-        M, C = sortMemC(M, C)
-        seg = np.zeros([nrow,ncol])
-        for k in range(N_region):
-            seg = seg + k * M[:,:, k] # label  the k-th region
-
-
-        biasCorrectedVol[:, :, idx] = img_bc
-        
-        progressbar.update(1)
+    q = 1
 
+    #Global ROI thresholding
+    if global_thr > 0:
+        ROI = Img > global_thr
+    else:
+        # Fallback: simple non-zero thresholding
+        ROI = Img > 0
+
+    from tqdm import tqdm  # only needed for the progress bar
+    # slices are seeded individually, the result does not depend on workers
+    progressbar = tqdm(total=Img.shape[0], desc='Biasfieldcorrection')
+    b, iterations = MICO.biasField(Img, ROI, iterNum, q, seed=seed, workers=workers, tol=tol,
+                                   warmStart=warmStart, callback=progressbar.update)
     progressbar.close()
+    print(f"MICO iterations per slice: {iterations.tolist()}")
+
+    img_bc = Img / b # bias field corrected image
+    img_bc[img_bc < 0] = 0
+    img_bc[img_bc > 5000] = 0
+    biasCorrectedVol = np.moveaxis(img_bc, 0, 2)
 
     unscaledNiiData = nii.Nifti1Image(biasCorrectedVol, data.affine)
     hdrOut = unscaledNiiData.header
@@ -175,66 +106,6 @@ def run_MICO(IMGdata,outputPath):
 
     return outputData
 
-def sortMemC(M, C):
-    C_out =np.sort(C)
-    IDX= np.argsort(C)
-
-    if len(M.shape) == 4:
-        M_out = np.zeros([M.shape[0], M.shape[1], M.shape[2], len(IDX)])
-        for k in range(np.size(C)):
-            M_out[:,:,:,k] = M[:,:,:,IDX[k]]
-
-    elif len(M.shape) == 3:
-        M_out = np.zeros([M.shape[0], M.shape[1], len(IDX)])
-        for k in range(np.size(C)):
-            M_out[:,:,k] = M[:,:,IDX[k]]
-
-    else:
-            sys.exit('Error: sortMemC: wrong dimension of the membership function')
-
-    return M_out, C_out
-
-
-def get_energy(Img,b,C,M,ROI,q):
-    N = M.shape[2]
-    energy = 0
-
-    for k in range(N):
-        C_k = C[k] * np.ones([Img.shape[0],Img.shape[1]])
-        energy = energy + np.sum(np.sum((Img * ROI - b * C_k * ROI) ** 2 * M[:, :, k] ** q))
-
-    return energy
-
-
-def getBasisOrder3(Height,Wide):
-    x = np.zeros([Height,Wide])
-    y = np.zeros([Height,Wide])
-    for i  in range(Height):
-        x[i,:] =  np.linspace(-1,1,Wide)
-
-    for i  in range(Wide):
-        y[:,i] =  np.linspace(-1,1,Height)
-
-    bais = np.zeros([Height,Wide,10])
-    bais[:,:,0] = 1
-    bais[:,:,1] = x
-    bais[:,:,2] = (3*x*x - 1)/2
-    bais[:,:,3] = (5*x*x*x - 3*x)/2
-    bais[:,:,4] = y
-    bais[:,:,5] = x*y
-    bais[:,:,6] = y*(3*x*x -1)/2
-    bais[:,:,7] = (3*y*y -1)/2
-    bais[:,:,8] = (3*y*y -1)*x/2
-    bais[:,:,9] = (5*y*y*y -3*y)/2
-    B = bais
-    for kk in range(10):
-        A=bais[:,:,kk]**2
-        r = np.sqrt(sum(sum(A)))
-        B[:,:,kk]=bais[:,:,kk]/r
-
-    return B
-
-
 if __name__ == "__main__":
     import argparse
 
@@ -243,6 +114,10 @@ if __name__ == "__main__":
 
     requiredNamed = parser.add_argument_group('required named arguments')
     requiredNamed.add_argument('-i','--input', help='Path to input file',required=True)
+    parser.add_argument('-w','--workers', help='Number of worker processes, slices are corrected in parallel - default=1', type=int, default=1)
+    parser.add_argument('-n','--iterNum', help='Maximum number of MICO iterations - default=100', type=int, default=100)
+    parser.add_argument('-t','--tol', help='Relative energy change below which a slice stops iterating, 0 runs all iterations - default=1e-5', type=float, default=1e-5)
+    parser.add_argument('--warm_start', help='Start every slice from the result of the previous slice (serial)', action='store_true')
 
     args = parser.parse_args()
 
@@ -252,4 +127,5 @@ if __name__ == "__main__":
     if not os.path.exists(input):
         sys.exit("Error: '%s' is not an existing directory of file %s is not in directory." % (input, args.file,))
 
-    result = run_MICO(input)
+    result = run_MICO(input,os.path.dirname(input),workers=args.workers,iterNum=args.iterNum,
+                      tol=args.tol,warmStart=args.warm_start)
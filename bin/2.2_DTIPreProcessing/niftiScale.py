@@ -0,0 +1,53 @@
+"""
+Scaling of the voxel size by factor 10 around FSL calls.
+
+FSL tools expect human sized voxels, so the images are handed to FSL with
+a 10 times larger voxel size and the results are scaled back afterwards.
+Only the affine and the voxel size in the header change: the voxel data
+are written as stored on disk, with their data type and scale factor
+(scl_slope/scl_inter), instead of being converted to float64, and the
+temporary input for FSL is written uncompressed.
+
+"""
+
+import os
+import sys
+import numpy as np
+import nibabel as nii
+
+
+def scaledImage(img, factor):
+    # img with the voxel size scaled by factor; the header (data type, TR, ...)
+    # is taken over. Data loaded from a file are written unchanged: the stored
+    # values with the stored scale factor, which np.asanyarray would apply
+    # and the writer then compute anew (changing the voxel values).
+    scale = np.eye(4) * factor
+    scale[3][3] = 1
+    if nii.is_proxy(img.dataobj) and hasattr(img.dataobj, 'get_unscaled'):
+        scaledImg = nii.Nifti1Image(img.dataobj.get_unscaled(), img.affine * scale, header=img.header)
+        scaledImg.header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    else:
+        scaledImg = nii.Nifti1Image(np.asanyarray(img.dataobj), img.affine * scale, header=img.header)
+    scaledImg.header.set_xyzt_units('mm', img.header.get_xyzt_units()[1])
+    return scaledImg
+
+
+def scaleBy10(input_path, inv, output_path=None):
+    # inv=False: writes an uncompressed copy with 10 times larger voxels for
+    # FSL (default: <input>_fslScaleTemp.nii next to the input) and returns its path.
+    # inv=True: scales the voxel size of an FSL result back by 1/10, in place
+    # unless output_path is given.
+    img = nii.load(input_path, mmap=False)  # not memory mapped, input_path may be overwritten
+    if inv is False:
+        if output_path is None:
+            output_path = os.path.join(os.path.dirname(input_path),
+                                       os.path.basename(input_path).split('.')[0] + '_fslScaleTemp.nii')
+        nii.save(scaledImage(img, 10), output_path)
+        return output_path
+    elif inv is True:
+        if output_path is None:
+            output_path = input_path
+        nii.save(scaledImage(img, 1 / 10), output_path)
+        return output_path
+    else:
+        sys.exit("Error: inv - parameter should be a boolean.")
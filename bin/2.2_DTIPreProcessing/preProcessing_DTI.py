@@ -9,12 +9,10 @@ University Hospital Cologne
 """
 
 
-import nipype.interfaces.fsl as fsl
 import os, sys
 import nibabel as nii
 import numpy as np
-import applyMICO
-import cv2
+from niftiScale import scaleBy10
 from pathlib import Path
 import subprocess
 import shutil
@@ -48,9 +46,10 @@ def applyBET(input_file: str, frac: float, radius: int, output_path: str) -> str
     """
     Performs brain extraction via the FSL Brain Extraction Tool (BET). Requires an appropriate input file (input_file), the fractional intensity threshold (frac), the head radius (radius) and the output path (output_path).
     """
+    import nipype.interfaces.fsl as fsl
     # scale Nifti data by factor 10
     data = nii.load(input_file)
-    imgTemp = data.get_fdata()
+    imgTemp = np.asanyarray(data.dataobj)  # keeps the on-disk data type
     scale = np.eye(4)* 10
     scale[3][3] = 1
     imgTemp = np.flip(imgTemp, 2)
@@ -60,7 +59,7 @@ def applyBET(input_file: str, frac: float, radius: int, output_path: str) -> str
     hdrIn.set_xyzt_units('mm')
     scaledNiiData = nii.as_closest_canonical(scaledNiiData)
 
-    fsl_path = os.path.join(os.path.dirname(input_file),'fslScaleTemp.nii.gz')
+    fsl_path = os.path.join(os.path.dirname(input_file),'fslScaleTemp.nii')  # uncompressed, only read by BET
     nii.save(scaledNiiData, fsl_path)
 
     # extract brain
@@ -71,21 +70,14 @@ def applyBET(input_file: str, frac: float, radius: int, output_path: str) -> str
 
 
     # unscale result data by factor 10ˆ(-1)
-    dataOut = nii.load(output_file)
-    imgOut = dataOut.get_fdata()
-    scale = np.eye(4)/ 10
-    scale[3][3] = 1
-
-    unscaledNiiData = nii.Nifti1Image(imgOut, dataOut.affine * scale)
-    hdrOut = unscaledNiiData.header
-    hdrOut.set_xyzt_units('mm')
-    nii.save(unscaledNiiData, output_file)
+    output_file = scaleBy10(output_file, inv=True)
     return output_file
 
 def smoothIMG(input_file, output_path):
     """
     Smoothes image via FSL. Only input and output has do be specified. Parameters are fixed to box shape and to the kernel size of 0.1 voxel.
     """
+    import nipype.interfaces.fsl as fsl
     data = nii.load(input_file)
     vol = data.get_fdata()
     ImgSmooth = np.min(vol, 3)
@@ -109,6 +101,7 @@ def smoothIMG(input_file, output_path):
     return output_file
 
 def thresh(input_file, output_path):
+    import nipype.interfaces.fsl as fsl
     #output_file = os.path.join(os.path.dirname(input_file),os.path.basename(input_file).split('.')[0]+ 'Thres.nii.gz')
     output_file = os.path.join(output_path, os.path.basename(input_file).split('.')[0] + 'Thres.nii.gz')
     myThres = fsl.Threshold(in_file=input_file,out_file=output_file,thresh=20)#,direction='above')
@@ -116,6 +109,7 @@ def thresh(input_file, output_path):
     return output_file
 
 def cropToSmall(input_file,output_path):
+    import nipype.interfaces.fsl as fsl
     #output_file = os.path.join(os.path.dirname(input_file),os.path.basename(input_file).split('.')[0]  + 'Crop.nii.gz')
     output_file = os.path.join(output_path, os.path.basename(input_file).split('.')[0] + 'Crop.nii.gz')
     myCrop = fsl.ExtractROI(in_file=input_file,roi_file=output_file,x_min=40,x_size=130,y_min=50,y_size=110,z_min=0,z_size=12)
@@ -123,7 +117,8 @@ def cropToSmall(input_file,output_path):
     return  output_file
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    import applyMICO
     import argparse
 
 
@@ -136,7 +131,8 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--radius', help='Head radius (mm not voxels) - default=45', nargs='?', type=int ,default=45)
     parser.add_argument('-g', '--vertical_gradient', help='Vertical gradient in fractional intensity threshold - default=0.0, positive values give larger brain outlines at bottom and smaller brain outlines at top', nargs='?',
                         type=float,default=0.0)
-    args = parser.parse_args()
+    parser.add_argument('-w', '--workers', help='Number of worker processes for the bias field correction, slices are corrected in parallel - default=1', type=int, default=1)
+    args = parser.parse_args(argv)
 
     # set parameters
     input_file = None
@@ -165,7 +161,7 @@ if __name__ == "__main__":
 
     # intensity correction using non parametric bias field correction algorithm
     try:
-        output_mico = applyMICO.run_MICO(output_smooth,output_path)
+        output_mico = applyMICO.run_MICO(output_smooth,output_path,workers=args.workers)
         print("Biasfieldcorrecttion was successful")
     except Exception as e:
         print(f'Fehler in der Biasfieldcorrecttion\nFehlermeldung: {str(e)}')
@@ -176,20 +172,5 @@ if __name__ == "__main__":
     print("Brainextraction was successful")
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+if __name__ == "__main__":
+    main()
@@ -10,11 +10,10 @@ University Hospital Cologne
 
 
 
-import nipype.interfaces.fsl as fsl
 import os,sys
 import nibabel as nii
 import numpy as np
-import nipype.interfaces.ants as ants
+from niftiScale import scaleBy10
 from pathlib import Path
 import subprocess
 import shutil
@@ -45,10 +44,11 @@ def reset_orientation(input_file):
     subprocess.run(forceradiological_command, shell=True)
 
 def applyBET(input_file,frac,radius,outputPath):
+    import nipype.interfaces.fsl as fsl
 
     # scale Nifti data by factor 10
     data = nii.load(input_file)
-    imgTemp = data.get_fdata()
+    imgTemp = np.asanyarray(data.dataobj)  # keeps the on-disk data type
     scale = np.eye(4)* 10
     scale[3][3] = 1
     #imgTemp = np.rot90(imgTemp,2)
@@ -60,7 +60,7 @@ def applyBET(input_file,frac,radius,outputPath):
     scaledNiiData = nii.as_closest_canonical(scaledNiiData)
     print('Orientation:' + str(nii.aff2axcodes(scaledNiiData.affine)))
 
-    fslPath = os.path.join(os.path.dirname(input_file),'fslScaleTemp.nii.gz')
+    fslPath = os.path.join(os.path.dirname(input_file),'fslScaleTemp.nii')  # uncompressed, only read by BET
     nii.save(scaledNiiData, fslPath)
 
     # extract brain
@@ -71,20 +71,13 @@ def applyBET(input_file,frac,radius,outputPath):
 
 
     # unscale result data by factor 10ˆ(-1)
-    dataOut = nii.load(output_file)
-    imgOut = dataOut.get_fdata()
-    scale = np.eye(4)/ 10
-    scale[3][3] = 1
-
-    unscaledNiiData = nii.Nifti1Image(imgOut, dataOut.affine * scale)
-    hdrOut = unscaledNiiData.header
-    hdrOut.set_xyzt_units('mm')
-    nii.save(unscaledNiiData, output_file)
+    output_file = scaleBy10(output_file, inv=True)
 
     print("Brain extraction completed")
     return output_file
 
 def biasfieldcorr(input_file,outputPath):
+    import nipype.interfaces.ants as ants
     output_file = os.path.join(outputPath, os.path.basename(input_file).split('.')[0] + 'Bias.nii.gz')
     myAnts = ants.N4BiasFieldCorrection(input_image=input_file,output_image=output_file,shrink_factor=4,dimension=3)
     myAnts.run()
@@ -95,6 +88,8 @@ def smoothIMG(input_file,outputPath):
     """
     Smoothes image via FSL. Only input and output has do be specified. Parameters are fixed to box shape and to the kernel size of 0.1 voxel.
     """
+    import nipype.interfaces.fsl as fsl
+    inputFile = input_file
     data = nii.load(input_file)
     vol = data.get_fdata()
     ImgSmooth = np.min(vol, 3)
@@ -115,6 +110,7 @@ def smoothIMG(input_file,outputPath):
     return output_file
 
 def thresh(input_file,outputPath):
+    import nipype.interfaces.fsl as fsl
     #output_file = os.path.join(os.path.dirname(input_file),os.path.basename(input_file).split('.')[0]+ 'Thres.nii.gz')
     output_file = os.path.join(outputPath, os.path.basename(input_file).split('.')[0] + 'Thres.nii.gz')
     myThres = fsl.Threshold(in_file=input_file,out_file=output_file,thresh=20)#,direction='above')
@@ -123,6 +119,7 @@ def thresh(input_file,outputPath):
     return output_file
 
 def cropToSmall(input_file,outputPath):
+    import nipype.interfaces.fsl as fsl
     #output_file = os.path.join(os.path.dirname(input_file),os.path.basename(input_file).split('.')[0]  + 'Crop.nii.gz')
     output_file = os.path.join(outputPath, os.path.basename(input_file).split('.')[0] + 'Crop.nii.gz')
     myCrop = fsl.ExtractROI(in_file=input_file,roi_file=output_file,x_min=40,x_size=130,y_min=50,y_size=110,z_min=0,z_size=12)
@@ -131,7 +128,7 @@ def cropToSmall(input_file,outputPath):
     return  output_file
 
 
-if __name__ == "__main__":
+def main(argv=None):
     import argparse
 
 
@@ -146,7 +143,7 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--radius', help='Head radius (mm not voxels) - default=45', nargs='?', type=int ,default=45)
     parser.add_argument('-g', '--vertical_gradient', help='Vertical gradient in fractional intensity threshold - default=0.0, positive values give larger brain outlines at bottom and smaller brain outlines at top', nargs='?',
                         type=float,default=0.0)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # set parameters
     inputFile = None
@@ -174,11 +171,5 @@ if __name__ == "__main__":
     print("Preprocessing completed")
 
 
-
-
-
-
-
-
-
-
+if __name__ == "__main__":
+    main()
@@ -153,7 +153,7 @@ def find_relatedData(pathBase):
     return pathT2,pathStroke_mask,pathAnno,pathAllen,bsplineMatrix
 
 
-if __name__ == "__main__":
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser(description='Registration of Allen Brain Atlas to rsfMRI')
@@ -171,7 +171,7 @@ if __name__ == "__main__":
 
 
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
 
 
@@ -275,4 +275,5 @@ if __name__ == "__main__":
     print("Registration done")
 
 
-
+if __name__ == "__main__":
+    main()
@@ -9,21 +9,19 @@ pages={153--166},
 year={1993},
 publisher={IEEE} """
 
-from math import *
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.optimize, scipy.signal
+from snrHistogram import normHistogram
 
 
-def calcSNR(img, show, fac):
-    # Normalize input dataset and plot histogram
+def calcSNR(img, show, fac, mapping=True, hist=None):
+    # without mapping (and show) only the noise is estimated, snrMap is None;
+    # hist: normHistogram(img, fac, integer=True), if already computed
+    import scipy.optimize
+    # Normalize input dataset and plot histogram (shared with the other methods)
     # img = np.fliplr(img)
-    img = img.astype(int)
-    maxi = img.max()
-    imgFlat = img.flatten()
-    imgNorm = imgFlat / maxi
-    bins = ceil(sqrt(imgNorm.size)) * fac
-    binCount, binLoc = np.histogram(imgNorm, int(bins))
+    if hist is None:
+        hist = normHistogram(img, fac, integer=True)
+    img, maxi, imgNorm, binCount, binLoc = hist
 
     maxRayl = max(binCount)
     estStd = np.argmax(binCount)
@@ -37,9 +35,13 @@ def calcSNR(img, show, fac):
     estStdNorm = yout[1]
     estStd = (yout[1] * maxi) / 10
 
+    if not (mapping or show > 0):
+        return None, estStd, estStdNorm
+
     snrMap = np.sqrt(abs(np.square(img) - (np.square(estStd)))) / estStd
 
     if show > 0:
+        import matplotlib.pyplot as plt
         if len(img.shape) == 2:
             plt.figure(3)
             plt.imshow(snrMap)
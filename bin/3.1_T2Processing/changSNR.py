@@ -7,50 +7,41 @@ pages={1136--1142},
 year={2005},
 organization={International Society for Optics and Photonics}"""
 
-from math import *
 import numpy as np
-import matplotlib.pyplot as plt
+from snrHistogram import normHistogram, kdeMode
 
 
-def calcSNR(img, show, fac):
+def calcSNR(img, show, fac, mapping=True, hist=None):
+    # without mapping (and show) only the noise is estimated, snrMap is None;
+    # hist: normHistogram(img, fac, integer=True), if already computed
     # Normalize input dataset and plot histogram
     # img = np.fliplr(img)
 
-    img = img.astype(int)
-    maxi = img.max()
-    imgFlat = img.flatten(2)
-    imgNorm = imgFlat / maxi
-    bins = ceil(sqrt(imgNorm.size)) * fac
-    binCount, binLoc = np.histogram(imgNorm, int(bins))
+    if hist is None:
+        hist = normHistogram(img, fac, integer=True)
+    img, maxi, imgNorm, binCount, binLoc = hist
+    bins = len(binCount)
     n = len(imgNorm)
 
     estStd = np.argmax(binCount)
-    estStd = (estStd) / binCount.shape
-
-    x = np.linspace(0, 1, bins)
-    fhat = np.zeros([1, len(x)])
+    estStd = (estStd) / bins
 
     h = 1.06 * n ** (-1 / 5) * estStd
 
-    # define function
-    gauss = lambda x: gaussianFct(x)
-
-    for i in range(n):
-        # get each kernel function evaluated at x
-        # centered at data
-        f = gauss((x - imgNorm[i]) / h)
-        # plot(x, f / (n * h))
-        fhat = fhat + f
-
-    fhat = fhat / (n * h)
+    # Mode of the kernel density estimate on linspace(0, 1, bins), the
+    # histogram convolved with the Gaussian kernel by FFT (see kdeMode)
+    maxPos = kdeMode(imgNorm, bins, h)
     # SNR-Map
-    maxPos = np.argmax(fhat)
     estStdNorm = binLoc[maxPos]
     estStd = (binLoc[maxPos] * maxi) / 10
 
+    if not (mapping or show > 0):
+        return None, estStd, estStdNorm
+
     snrMap = np.sqrt(abs(np.square(img) - (np.square(estStd)))) / estStd
 
     if show > 0:
+        import matplotlib.pyplot as plt
         if len(img.shape) == 2:
             figChang = plt.figure(3)
             plt.imshow(snrMap)
@@ -61,8 +52,3 @@ def calcSNR(img, show, fac):
             plt.show()
 
     return snrMap, estStd, estStdNorm
-
-
-def gaussianFct(x):
-    y = 1 / sqrt(2 * pi) * np.exp((-(np.square(x))) / 2)
-    return y
@@ -3,15 +3,16 @@ import sys
 import nibabel as nii
 import glob
 import numpy as np
-import progressbar
-import matplotlib
-import matplotlib.pyplot as plt
-
-# --- Fonts & Text Display ---
-matplotlib.rcParams['svg.fonttype'] = 'none'     #text remains editable in SVG
-matplotlib.rcParams['pdf.fonttype'] = 42         # Editable text in PDF (Type 42)
 
 def heatMap(incidenceMap, araVol, outputLocation):
+    # matplotlib is only needed for the plots, so it is imported here
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    # --- Fonts & Text Display ---
+    matplotlib.rcParams['svg.fonttype'] = 'none'     #text remains editable in SVG
+    matplotlib.rcParams['pdf.fonttype'] = 42         # Editable text in PDF (Type 42)
+
     maxV = int(np.max(incidenceMap))
     fig, axes = plt.subplots(nrows=3, ncols=4)
     t = 1
@@ -46,6 +47,7 @@ def incidenceMap2(path_listInc, araTemplate, inputFile, outputLocation):
     araDataTemplate = nii.load(araTemplate)
     realAraImg = np.asanyarray(araDataTemplate.dataobj)
     overlaidIncidences = np.zeros_like(realAraImg)
+    import progressbar
     bar = progressbar.ProgressBar()
     for fileIndex in bar(range(len(path_listInc))):
         dataMRI = nii.load(path_listInc[fileIndex])
@@ -156,7 +156,7 @@ def findRegisteredAnno(path):
 
     return regANNO_list
 
-if __name__ == "__main__":
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser(description='Calculate incidence sizes of regions. You do not need to enter single files, but the path to the .../T2w folder')
@@ -174,7 +174,7 @@ if __name__ == "__main__":
     allenBrain_anno = None
     outfile = None
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
 
     if args.inputFolder is not None:
@@ -212,3 +212,7 @@ if __name__ == "__main__":
         sys.exit("Error: For one or more annotations no corresponding MR file is defined in '%s'." % (inputFolder,))
 
     incidenceMap(regMR_list,regInc_list,regANNO_list,araDataTemplate,incidenceMask,thres,outfile,labels)
+
+
+if __name__ == "__main__":
+    main()
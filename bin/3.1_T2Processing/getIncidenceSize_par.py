@@ -23,7 +23,7 @@ def find_nearest(array,value):
     idx = (np.abs(array-value)).argmin()
     return array[idx]
 
-def thresholdingSlc(volumeMR,maskImg,thres):
+def thresholdingSlc(volumeMR,maskImg,thres,outfile):
     volumeMR=ndimage.gaussian_filter(volumeMR, sigma=(1.2, 1.2, 1))
 
     volumeMR = volumeMR * maskImg[:, :, :, 0]
@@ -200,7 +200,7 @@ def findRegisteredAnno(path):
 
     return regANNO_list
 
-if __name__ == "__main__":
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser(description='Calculate incidence sizes of parental regions. You do not need to enter single files, but the path to the .../T2w folder')
@@ -218,7 +218,7 @@ if __name__ == "__main__":
     allenBrain_anno = None
     outfile = None
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.inputFolder is not None:
         inputFolder = args.inputFolder
@@ -253,3 +253,7 @@ if __name__ == "__main__":
         sys.exit("Error: For one or more annotations is no corresponding MR file defined in '%s'." % (inputFolder,))
 
     incidenceMap(regMR_list,regInc_list,regANNO_list,araDataTemplate,incidenceMask,thres,outfile,labels)
+
+
+if __name__ == "__main__":
+    main()
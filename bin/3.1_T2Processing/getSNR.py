@@ -9,55 +9,118 @@ University Hospital Cologne
 '''
 
 import os
+import sys
+import csv
+import concurrent.futures
 import changSNR as ch
 import brummerSNR as bm
 import sijbersSNR as sj
+from snrHistogram import normHistogram
 import numpy as np
 import glob
 import nibabel as nii
 
+# noise estimators, they share the normalised histogram of a slice (snrHistogram)
+METHODS = [('Chang', ch), ('Brummer', bm), ('Sijbers', sj)]
+
+CSV_FIELDS = ['file', 'subject', 'session', 'level', 'slice', 'method', 'noise_std', 'snr_db']
+
+
+def sliceNoise(slice, maps=False):
+    # Noise std of one slice for every method, and their SNR maps with maps
+    noise, snrMaps = {}, {}
+    hist = normHistogram(slice, 1, integer=True)
+    for name, method in METHODS:
+        snrMap, estStd, estStdNorm = method.calcSNR(slice, 0, 1, mapping=maps, hist=hist)
+        noise[name] = float(np.squeeze(estStd))
+        snrMaps[name] = snrMap
+    return noise, snrMaps
 
-def snrCalclualtor(input_file):
-    fileSNR = open(os.path.join(os.path.dirname(input_file), 'snr.txt'), 'w')
 
+def snrCalclualtor(input_file, maps=False):
+    # Writes the volume SNR of all methods to snr.txt next to input_file and,
+    # with maps, the SNR maps as <input>_SNR_<method>.nii.gz.
+    # Returns the per-slice and per-volume rows of the cohort table.
     data = nii.load(input_file)
-    imgData = data.get_data()
+    imgData = np.asanyarray(data.dataobj)
 
     # nx = imgData.shape[0] # Images size in x - direction
     # ny = imgData.shape[1] # Images size in y - direction
     ns = imgData.shape[2]  # Number of slices
 
-    noiseChSNR = np.zeros(ns)
-    noiseBmSNR = np.zeros(ns)
-    noiseSjSNR = np.zeros(ns)
+    noise = {name: np.zeros(ns) for name, method in METHODS}
+    snrMaps = {name: np.zeros(imgData.shape) for name, method in METHODS} if maps else None
+    meanSlice = np.zeros(ns)
 
     imgData = np.ndarray.astype(imgData, 'float64')
     for slc in range(ns):
-        #   Print % of progress
-        print('Slice: ' + str(slc + 1))
-
         # Temporal image containing all TE values for the selected slice
         slice = imgData[:, :, slc]
+        meanSlice[slc] = np.mean(slice)
 
-        curSnrCHMap, estStdChang, estStdChangNorm = ch.calcSNR(slice, 0, 1)
-
-        curSnrBMMap, estStdBrummer, estStdBrummerNorm = bm.calcSNR(slice, 0, 1)
-
-        curSnrSJMap, estStdSijbers, estStdSijbersNorm = sj.calcSNR(slice, 0, 1)
+        curNoise, curSnrMaps = sliceNoise(slice, maps)
+        for name, method in METHODS:
+            noise[name][slc] = curNoise[name]
+            if maps:
+                snrMaps[name][:, :, slc] = curSnrMaps[name]
 
-        noiseChSNR[slc] = estStdChang
-        noiseBmSNR[slc] = estStdBrummer
-        noiseSjSNR[slc] = estStdSijbers
+    snr = {name: 20 * np.log10(np.mean(imgData) / np.mean(noise[name])) for name, method in METHODS}
 
-    snrCh = 20 * np.log10(np.mean(imgData) / np.mean(noiseChSNR))
-    snrBrum = 20 * np.log10(np.mean(imgData) / np.mean(noiseBmSNR))
-    snrSij = 20 * np.log10(np.mean(imgData) / np.mean(noiseSjSNR))
-
-    fileSNR.write("Mean of Chang: %0.3f dB \n" % snrCh)
-    fileSNR.write("Mean of Brummer: %0.3f dB\n" % snrBrum)
-    fileSNR.write("Mean of Sijbers: %0.3f dB\n" % snrSij)
+    fileSNR = open(os.path.join(os.path.dirname(input_file), 'snr.txt'), 'w')
+    fileSNR.write("Mean of Chang: %0.3f dB \n" % snr['Chang'])
+    fileSNR.write("Mean of Brummer: %0.3f dB\n" % snr['Brummer'])
+    fileSNR.write("Mean of Sijbers: %0.3f dB\n" % snr['Sijbers'])
     fileSNR.close()
 
+    if maps:
+        baseName = os.path.basename(input_file).split('.nii')[0]
+        for name, method in METHODS:
+            mapNii = nii.Nifti1Image(snrMaps[name].astype(np.float32), data.affine)
+            nii.save(mapNii, os.path.join(os.path.dirname(input_file), baseName + '_SNR_' + name + '.nii.gz'))
+
+    parts = os.path.normpath(input_file).split(os.sep)
+    subject = next((part for part in parts if part.startswith('sub-')), '')
+    session = next((part for part in parts if part.startswith('ses-')), '')
+    rows = []
+    for name, method in METHODS:
+        for slc in range(ns):
+            rows.append({'file': input_file, 'subject': subject, 'session': session, 'level': 'slice',
+                         'slice': slc, 'method': name, 'noise_std': noise[name][slc],
+                         'snr_db': 20 * np.log10(meanSlice[slc] / noise[name][slc])})
+        rows.append({'file': input_file, 'subject': subject, 'session': session, 'level': 'volume',
+                     'slice': '', 'method': name, 'noise_std': np.mean(noise[name]), 'snr_db': snr[name]})
+    return rows
+
+
+def snrCohort(fileList, csvFile, workers=None, maps=False):
+    # SNR of all files, distributed over a process pool with workers > 1
+    # (None: number of CPUs), written to one table csvFile
+    rows = {}
+    if workers == 1 or len(fileList) < 2:
+        for input_file in fileList:
+            try:
+                rows[input_file] = snrCalclualtor(input_file, maps)
+                print(input_file)
+            except Exception as e:
+                print("Error: SNR of '%s' failed: %s" % (input_file, e))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(snrCalclualtor, input_file, maps): input_file for input_file in fileList}
+            for future in concurrent.futures.as_completed(futures):
+                input_file = futures[future]
+                try:
+                    rows[input_file] = future.result()
+                    print(input_file)
+                except Exception as e:
+                    print("Error: SNR of '%s' failed: %s" % (input_file, e))
+
+    with open(csvFile, 'w', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for input_file in fileList:
+            writer.writerows(rows.get(input_file, []))
+    return csvFile
+
 
 def findRegisteredData(path, studyPrefix):
     regMR_list = []
@@ -67,21 +130,39 @@ def findRegisteredData(path, studyPrefix):
     return regMR_list
 
 
+def findProcData(path, pattern='*T2w.nii.gz'):
+    # anatomical images of a proc_data tree (sub-*/ses-*/anat)
+    return sorted(glob.glob(os.path.join(path, 'sub-*', 'ses-*', 'anat', pattern)))
+
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description='Calculate SNR')
     requiredNamed = parser.add_argument_group('Required named arguments')
-    requiredNamed.add_argument('-i', '--inputData', help='Folder of all files of one study')
-    requiredNamed.add_argument('-s', '--studyPrefix', help='First letter of files in input data')
+    requiredNamed.add_argument('-i', '--inputData', help='Folder of all files of one study (e.g. proc_data)', required=True)
+    parser.add_argument('-s', '--studyPrefix',
+                        help='First letter of files in input data; uses the former layout <prefix>*/T2w/*1.nii.gz '
+                             'instead of sub-*/ses-*/anat')
+    parser.add_argument('-p', '--pattern', default='*T2w.nii.gz',
+                        help='File pattern in the anat folders of a proc_data tree. Default = *T2w.nii.gz')
+    parser.add_argument('-o', '--output', help='CSV file of the per-slice and per-volume SNR. Default = <inputData>/snr.csv')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of files processed in parallel. Default = number of CPUs')
+    parser.add_argument('-m', '--maps', action='store_true', help='Also save the SNR maps of all methods')
 
     args = parser.parse_args()
 
     pathData = args.inputData
-    studyPrefix = args.studyPrefix
-
-    listMr = findRegisteredData(pathData, studyPrefix)
-
-    for i in listMr:
-        print(i)
-        snrCalclualtor(i)
+    if not os.path.isdir(pathData):
+        sys.exit("Error: '%s' is not an existing directory." % (pathData,))
+
+    if args.studyPrefix is not None:
+        listMr = findRegisteredData(pathData, args.studyPrefix)
+    else:
+        listMr = findProcData(pathData, args.pattern)
+    if len(listMr) == 0:
+        sys.exit("Error: no files found in '%s'." % (pathData,))
+
+    csvFile = args.output if args.output is not None else os.path.join(pathData, 'snr.csv')
+    snrCohort(listMr, csvFile, args.jobs, args.maps)
+    print('SNR table: ' + csvFile)
@@ -9,22 +9,21 @@ pages={1335},
 year={2007},
 publisher={IOP Publishing} """
 
-from math import *
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.optimize
+from snrHistogram import normHistogram
 
 
-def calcSNR(img, show, fac):
-    # Normalize input dataset and plot histogram
+def calcSNR(img, show, fac, mapping=True, hist=None):
+    # without mapping (and show) only the noise is estimated, snrMap is None;
+    # hist: normHistogram(img, fac, integer=True), if already computed
+    import scipy.optimize
+    # Normalize input dataset and plot histogram (shared with the other methods)
     # img = np.fliplr(img)
 
-    img = img.astype(int)
-    maxi = img.max()
-    imgFlat = img.flatten(2)
-    imgNorm = imgFlat / maxi
-    bins = ceil(sqrt(imgNorm.size)) * fac
-    binCount, binLoc = np.histogram(imgNorm, int(bins))
+    if hist is None:
+        hist = normHistogram(img, fac, integer=True)
+    img, maxi, imgNorm, binCount, binLoc = hist
+    bins = len(binCount)
 
     estStd = np.argmax(binCount)
     fc = binLoc[2 * estStd]
@@ -40,9 +39,13 @@ def calcSNR(img, show, fac):
     estStdNorm = out
     estStd = (out * maxi) / 10
 
+    if not (mapping or show > 0):
+        return None, estStd, estStdNorm
+
     snrMap = np.sqrt(abs(np.square(img) - (np.square(estStd)))) / estStd
 
     if show > 0:
+        import matplotlib.pyplot as plt
         if len(img.shape) == 2:
             figSijbers = plt.figure(3)
             plt.imshow(snrMap)
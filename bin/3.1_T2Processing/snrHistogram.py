@@ -0,0 +1,98 @@
+"""
+Histogram of the normalised image shared by the SNR estimators
+(Brummer, Chang, Sijbers) and the kernel density mode of Chang's method.
+
+"""
+
+from math import ceil, floor, sqrt, pi
+import numpy as np
+import scipy.signal
+
+
+def normHistogram(img, fac, integer=False):
+    """
+    # normHistogram
+    #
+    # Histogram of the image normalised to its maximum with
+    # ceil(sqrt(voxels)) * fac bins. With integer the image values are
+    # truncated to integers first. To estimate the noise of one image with
+    # several methods, compute it once and pass it to their calcSNR.
+    #------------------------------------------------------------------------------
+    # Returns (image as float, maximum, normalised flattened image, bin counts,
+    # bin edges), all read-only.
+    """
+    # the truncation changes nothing for images of an integer type
+    integer = integer and not np.issubdtype(img.dtype, np.integer)
+    values = img.astype(float)
+    if integer:
+        values = np.trunc(values)
+    maxi = values.max()
+    imgNorm = values.ravel() / maxi
+    bins = ceil(sqrt(imgNorm.size)) * fac
+    binCount, binLoc = np.histogram(imgNorm, int(bins))
+
+    result = (values, maxi, imgNorm, binCount, binLoc)
+    for array in result:
+        if isinstance(array, np.ndarray):
+            array.setflags(write=False)
+    return result
+
+
+def kdeMode(data, nGrid, h):
+    """
+    # kdeMode
+    #
+    # Index of the point of the grid linspace(0, 1, nGrid) with the largest
+    # Gaussian kernel density estimate sum(gaussian((x - data) / h)) of data.
+    # The data are binned linearly onto a grid with a spacing of at most h/8
+    # and convolved with the kernel by FFT. The binning error is bounded by
+    # the number of data near every grid point; at the grid points it does
+    # not rule out, the estimate is recomputed exactly from the sorted data
+    # around them. O(n log n) instead of O(n * nGrid).
+    # With h = 0 the grid point nearest to most data is returned.
+    #------------------------------------------------------------------------------
+    """
+    data = np.asarray(data, dtype=float).ravel()
+    delta = 1 / (nGrid - 1)
+    grid = np.linspace(0, 1, nGrid)
+    if not h > 0:
+        nearest = np.clip(np.rint(data / delta), 0, nGrid - 1).astype(int)
+        return int(np.argmax(np.bincount(nearest, minlength=nGrid)))
+
+    # linear binning onto a fine grid covering the data and [0, 1]
+    ratio = int(min(ceil(8 * delta / h), 256))
+    step = delta / ratio
+    start = min(floor(data.min() / step), 0)
+    pos = data / step - start
+    left = np.floor(pos).astype(int)
+    weight = pos - left
+    nFine = max(left.max(), (nGrid - 1) * ratio - start) + 2
+    counts = np.bincount(left, 1 - weight, nFine) + np.bincount(left + 1, weight, nFine)
+
+    # convolution with the kernel, sampled at the grid points
+    offsets = np.arange(-(nFine - 1), nFine)
+    kernel = gaussianFct(offsets * step / h)
+    fhat = scipy.signal.fftconvolve(counts, kernel, mode='valid')[-start::ratio][:nGrid]
+
+    # error bound: linear interpolation error of the kernel times the data
+    # within the truncation radius (counted per fine cell), plus the
+    # truncated tails
+    cells = np.concatenate([[0], np.cumsum(np.bincount(left, minlength=nFine))])
+    radius = 8 * h + step
+    first = np.clip(np.floor((grid - radius) / step - start).astype(int), 0, nFine)
+    last = np.clip(np.floor((grid + radius) / step - start).astype(int) + 1, 0, nFine)
+    error = (step / h) ** 2 / 8 * gaussianFct(0) * (cells[last] - cells[first]) + 1e-12 * data.size
+    candidates = np.flatnonzero(fhat + error >= np.max(fhat - error))
+
+    # exact estimate at the candidates from the sorted data around them
+    near = np.sort(data[(data >= grid[candidates[0]] - 8 * h) & (data <= grid[candidates[-1]] + 8 * h)])
+    exact = np.zeros(len(candidates))
+    for idx, j in enumerate(candidates):
+        lo, hi = np.searchsorted(near, [grid[j] - 8 * h, grid[j] + 8 * h])
+        exact[idx] = gaussianFct((grid[j] - near[lo:hi]) / h).sum()
+    return int(candidates[np.argmax(exact)])
+
+
+def gaussianFct(x):
+    y = 1 / sqrt(2 * pi) * np.exp((-(np.square(x))) / 2)
+    return y
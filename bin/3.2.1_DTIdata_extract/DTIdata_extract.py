@@ -11,6 +11,7 @@ import sys
 import argparse
 import numpy as np
 import nibabel as nii
+from labelStats import labelStats
 
 def getOutfile(roi_file,img_file):
     imgName = os.path.basename(img_file)
@@ -22,29 +23,23 @@ def getOutfile(roi_file,img_file):
     return outFile
 
 def extractDTIData(img,rois,outfile,txt_file):
-
-    regions = np.uint16(np.unique(rois))
-    regions=np.delete(regions,0)
+    # mean parameter value of every region, all regions in one pass
+    stats = labelStats(img, rois)
+    regions = np.uint16(stats["label"])
 
     indices = None
     if txt_file is not None:
-
         ref_lines = open(txt_file).readlines()
-        indices = np.zeros_like(ref_lines)
-        for idx in range(np.size(ref_lines)):
-            curNum = int(str.split(ref_lines[idx], '\t')[0])
-
-            indices[idx] = curNum
-        indices = np.uint16(indices)
+        indices = {}
+        for line in ref_lines:
+            indices.setdefault(int(str.split(line, '\t')[0]), str.split(line, '\t')[1][:-1])
 
     fileID = open(outfile, 'w')
     fileID.write("%s values for %i given regions:\n\n" % (str.upper(outfile[-6:-4]),np.size(regions)))
 
-    for r in regions:
-        paramValue = np.mean(img[rois==r])
+    for r, paramValue in zip(regions, stats["mean"]):
         if indices is not None:
-            str_idx = ref_lines[int(np.argwhere(indices == r)[0])]
-            acro = str.split(str_idx,'\t')[1][:-1]
+            acro = indices[r]
             fileID.write("%i\t%s\t%.2f\n" % (r,acro ,paramValue))
         else:
             fileID.write("%i\t%.2f\n" % (r, paramValue))
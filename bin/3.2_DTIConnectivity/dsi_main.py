@@ -15,7 +15,7 @@ import glob
 import dsi_tools
 import shutil
 
-if __name__ == '__main__':
+def main(argv=None):
     # default dsi studio directory
     f = open(os.path.join(os.getcwd(), "dsi_studioPath.txt"), "r")
     dsi_studio = f.read().split("\n")[0]
@@ -45,7 +45,7 @@ if __name__ == '__main__':
                         nargs = '*',
                         help = 'Optional arguments.\n\t"fa0": Renames the FA metric data to former DSI naming convention.\n\t"nii_gz": Converts ROI labeling relating files from .nii to .nii.gz format to match former data structures.'
                         )    
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
         
      # Determine the btable source based on the -b option
     if args.b_table.lower() == 'auto':
@@ -125,3 +125,6 @@ if __name__ == '__main__':
                     os.remove(newName)
                 os.rename(oldName, newName)
 
+
+if __name__ == '__main__':
+    main()
@@ -29,34 +29,18 @@ import time
 import glob
 import nibabel as nii
 import numpy as np
-import nipype.interfaces.fsl as fsl
 import shutil
+import tempfile
+import concurrent.futures
 import subprocess
-import pandas as pd
-
-def scaleBy10(input_path, inv):
-    data = nii.load(input_path)
-    imgTemp = data.get_fdata()
-    if inv is False:
-        scale = np.eye(4) * 10
-        scale[3][3] = 1
-        scaledNiiData = nii.Nifti1Image(imgTemp, data.affine * scale)
-        # overwrite old nifti
-        fslPath = os.path.join(os.path.dirname(input_path), 'fslScaleTemp.nii.gz')
-        nii.save(scaledNiiData, fslPath)
-        return fslPath
-    elif inv is True:
-        scale = np.eye(4) / 10
-        scale[3][3] = 1
-        unscaledNiiData = nii.Nifti1Image(imgTemp, data.affine * scale)
-        hdrOut = unscaledNiiData.header
-        hdrOut.set_xyzt_units('mm')
-
-        nii.save(unscaledNiiData, input_path)
-        return input_path
-    else:
-        sys.exit("Error: inv - parameter should be a boolean.")
 
+def thread_option():
+    """
+    DSI Studio thread count option, following the OpenMP thread budget (OMP_NUM_THREADS)
+    a batchProc.py job gets. Empty if no budget is set.
+    """
+    threads = os.environ.get('OMP_NUM_THREADS')
+    return ' --thread_count=%s' % threads if threads else ''
 
 def findSlicesData(path, pre):
     regMR_list = []
@@ -67,50 +51,72 @@ def findSlicesData(path, pre):
     return regMR_list
 
 
-def fsl_SeparateSliceMoCo(input_file, par_folder):
-    # scale Nifti data by factor 10
+def scratchDir(nbytes):
+    # RAM backed scratch space (/dev/shm) if it has room for nbytes, otherwise
+    # the default temporary folder
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        stat = os.statvfs(shm)
+        if stat.f_bavail * stat.f_frsize > 2 * nbytes:
+            return shm
+    return None
+
+def motionCorrectSlice(slice_file, out_file):
+    import nipype.interfaces.fsl as fsl
+    myMCFLIRT = fsl.preprocess.MCFLIRT(in_file=slice_file, out_file=out_file, save_plots=True,
+                                       output_type='NIFTI', terminal_output='none')
+    result = myMCFLIRT.run()
+    os.remove(slice_file)
+    return result.outputs.out_file, result.outputs.par_file
+
+def fsl_SeparateSliceMoCo(input_file, par_folder, workers=None):
+    # Motion correction slice by slice with MCFLIRT. The slices are written
+    # uncompressed into a private scratch folder (RAM backed where possible)
+    # and registered concurrently by workers threads (default: the thread
+    # budget OMP_NUM_THREADS of the batchProc.py job, else all cores). Only
+    # the merged volume and the .par files of the slices are written to disk.
     dataName = os.path.basename(input_file).split('.')[0]
-    fslPath = scaleBy10(input_file, inv=False)
-
-    aidamri_dir = os.getcwd()
-    temp_dir = os.path.join(os.path.dirname(input_file), "temp")
-    if not os.path.exists(temp_dir):
-        os.mkdir(temp_dir)
-
-    os.chdir(temp_dir)
-    mySplit = fsl.Split(in_file=fslPath, dimension='z', out_base_name=dataName)
-    mySplit.run()
-    os.remove(fslPath)
-
-    # sparate ref and src volume in slices
-    sliceFiles = findSlicesData(os.getcwd(), dataName)
-
-    # start to correct motions slice by slice
-    for i in range(len(sliceFiles)):
-        slc = sliceFiles[i]
-        output_file = os.path.join(par_folder, os.path.basename(slc))
-        myMCFLIRT = fsl.preprocess.MCFLIRT(in_file=slc, out_file=output_file, save_plots=True, terminal_output='none')
-        myMCFLIRT.run()
-        os.remove(slc)
-
-    # merge slices to a single volume
-    mcf_sliceFiles = findSlicesData(par_folder, dataName)
-    output_file = os.path.join(os.path.dirname(input_file),
-                               os.path.basename(input_file).split('.')[0]) + '_mcf.nii.gz'
-    myMerge = fsl.Merge(in_files=mcf_sliceFiles, dimension='z', merged_file=output_file)
-    myMerge.run()
+    data = nii.load(input_file)
+    img = data.get_fdata(dtype=np.float32)  # MCFLIRT works on float32
 
-    for slc in mcf_sliceFiles: 
-        os.remove(slc)
+    # scale Nifti data by factor 10
+    scale = np.eye(4) * 10
+    scale[3][3] = 1
+    affine = data.affine * scale
 
-    # unscale result data by factor 10**(-1)
-    output_file = scaleBy10(output_file, inv=True)
-    
-    os.chdir(aidamri_dir)
+    if workers is None:
+        workers = int(os.environ.get('OMP_NUM_THREADS', 0)) or os.cpu_count()
+
+    temp_dir = tempfile.mkdtemp(prefix=dataName + '_moco_', dir=scratchDir(img.nbytes))
+    try:
+        slices = []
+        for z in range(img.shape[2]):
+            slice_file = os.path.join(temp_dir, '%s%04d.nii' % (dataName, z))
+            nii.save(nii.Nifti1Image(img[:, :, z:z + 1], affine), slice_file)
+            slices.append((slice_file, os.path.join(temp_dir, '%s%04d_mcf.nii' % (dataName, z))))
+
+        # start to correct motions of all slices
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda files: motionCorrectSlice(*files), slices))
+
+        # merge slices to a single volume, .par files named like the former fslsplit slices
+        mcf = np.zeros(img.shape)
+        for z, (out_file, par_file) in enumerate(results):
+            mcf[:, :, z:z + 1] = nii.load(out_file).get_fdata().reshape(mcf[:, :, z:z + 1].shape)
+            shutil.copyfile(par_file, os.path.join(par_folder, '%s%04d.nii.gz.par' % (dataName, z)))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    output_file = os.path.join(os.path.dirname(input_file),
+                               os.path.basename(input_file).split('.')[0]) + '_mcf.nii.gz'
+    unscaledNiiData = nii.Nifti1Image(mcf, data.affine)
+    unscaledNiiData.header.set_xyzt_units('mm')
+    nii.save(unscaledNiiData, output_file)
 
     return output_file
 
 
+
 def make_dir(dir_out, dir_sub):
     """
     Creates new directory.
@@ -166,7 +172,7 @@ def connectivity(dsi_studio, dir_in, dir_seeds, dir_out, dir_con):
     connect_vals = ['qa', 'count']
     for i in connect_vals:
         parameters = (dsi_studio, 'ana', filename, file_trk, file_seeds, i, 'pass,end')
-        os.system(cmd_ana % parameters)
+        os.system(cmd_ana % parameters + thread_option())
 
     #move_files(dir_in, dir_con, re.escape(filename) + '\.' + re.escape(pre_seeds) + '.*(?:\.pass\.|\.end\.)')
     move_files(os.path.dirname(file_trk), dir_con, '/*.txt')
@@ -275,7 +281,7 @@ def srcgen(dsi_studio, dir_in, dir_msk, dir_out, b_table):
     # create fib files
     file_msk = dir_msk
     parameters = (dsi_studio, 'rec', file_src, file_msk, 1, '1.25', 0, 1,'"[Step T2][B-table][flip by]+[Step T2][B-table][flip bz]"')
-    os.system(cmd_rec % parameters)
+    os.system(cmd_rec % parameters + thread_option())
 
     # move fib to corresponding folders
     move_files(dir_src, dir_fib, '/*fib.gz')
@@ -364,9 +370,10 @@ def tracking(dsi_studio, dir_in):
     # Use this tracking parameters in the form of parameter_id that you can get directly from the dsi_studio gui console. (this is here now the defualt mode)
     parameters = (dsi_studio, 'trk', filename, os.path.join(dir_in, filename+'.trk.gz'), '0AD7A33C9A99193FE8D5123F0AD7233CCDCCCC3D9A99993EbF04240420FdcaCDCC4C3Ec')
 
-    os.system(cmd_trk % parameters)
+    os.system(cmd_trk % parameters + thread_option())
 
 def merge_bval_bvec_to_btable(folder_path):
+    import pandas as pd
     # List files in the specified folder
     files = os.listdir(folder_path)
 
@@ -1,22 +1,31 @@
 import numpy as np
 import scipy.io as io
-from scipy.stats import pearsonr
 
 def calculate_p_corr_matrix(data, lines, output_paths):
+    # Pearson correlation of all column pairs of data (time points x regions)
+    # at once: the standardized columns are multiplied in one matmul, the
+    # two-sided p-values follow from the t distribution with n-2 degrees of
+    # freedom, as scipy.stats.pearsonr computes them pair by pair. The
+    # diagonal stays 0, pairs with a constant column are NaN.
+    from scipy.special import stdtr
+    data = np.asarray(data, dtype=np.float64)
     (rows, cols) = np.shape(data)
-    correlation_matrix = np.zeros((cols,cols))
-    p_value_matrix = np.zeros((cols,cols))
-    for i in range(cols):
-        for j in range(i+1, cols):
-            corr_coef, p_value = pearsonr(data[:,i], data[:,j])
-            correlation_matrix[i, j] = corr_coef
-            correlation_matrix[j, i] = corr_coef
-            p_value_matrix[i, j] = p_value
-            p_value_matrix[j, i] = p_value
 
-    # calculate fisher-transformation
-    matrix_PcorrZ = np.arctanh(correlation_matrix)
-    
+    centered = data - data.mean(axis=0)
+    norms = np.linalg.norm(centered, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        standardized = centered / norms
+        correlation_matrix = np.clip(standardized.T @ standardized, -1.0, 1.0)
+        np.fill_diagonal(correlation_matrix, 0)
+
+        df = rows - 2
+        t_values = correlation_matrix * np.sqrt(df / ((1.0 - correlation_matrix) * (1.0 + correlation_matrix)))
+        p_value_matrix = 2 * stdtr(df, -np.abs(t_values))
+        np.fill_diagonal(p_value_matrix, 0)
+
+        # calculate fisher-transformation
+        matrix_PcorrZ = np.arctanh(correlation_matrix)
+
     io.savemat(output_paths[0], dict([('matrix', correlation_matrix),('label',lines)]))
     io.savemat(output_paths[1], dict([('matrix', p_value_matrix),('label',lines)]))
     io.savemat(output_paths[2], dict([('matrix', matrix_PcorrZ),('label',lines)]))
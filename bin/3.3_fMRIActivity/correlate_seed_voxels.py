@@ -36,42 +36,75 @@ def save_nifti(sFilename, data, index, ext_nii):
 
     # save matrix (NIfTI)
     image = nib.Nifti1Image(data, None)
-    header = image.get_header()
+    header = image.header
     header.set_xyzt_units(xyz=None, t=None)
     image.to_filename(sFilename + '_%03d' % (index + 1,) + ext_nii)
     print("Output:", image.get_filename())
 
-def get_seed_stat(sPathMatrix, sPathTS, data, seed, ext_nii, r_to_z=False, save_mat=False, ignore_nan=False):
+def pairwise_corr_stat(ts, r_to_z=False, ignore_nan=False, block_size=2048):
+    # Min, max, mean and std of the correlations of all voxel pairs (upper
+    # triangle of np.corrcoef(ts)) for time series ts (voxels x time points).
+    # The matrix is never built: the standardized time series are multiplied
+    # in blocks of block_size x block_size voxels and the statistics are
+    # merged block by block, so the memory does not grow with the seed size.
+    ts = np.asarray(ts, dtype=np.float64)
+    centered = ts - ts.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = centered / np.linalg.norm(centered, axis=1, keepdims=True)
+
+    count, mean, m2 = 0, 0.0, 0.0
+    vmin, vmax = np.inf, -np.inf
+    has_nan = False
+    n = z.shape[0]
+    for a in range(0, n, block_size):
+        for c in range(a, n, block_size):
+            block = z[a:a + block_size] @ z[c:c + block_size].T
+            if c == a:
+                block = block[np.triu_indices_from(block, k=1)]
+            block = np.clip(block.ravel(), -1, 1)
+            if r_to_z:
+                with np.errstate(divide='ignore'):
+                    block = np.arctanh(block)
+            block[np.isinf(block)] = np.nan
+            nans = np.isnan(block)
+            if nans.any():
+                has_nan = True
+                block = block[~nans]
+            if block.size == 0:
+                continue
+            # merge mean and sum of squared deviations (Chan et al.)
+            block_mean = block.mean()
+            block_m2 = np.sum((block - block_mean) ** 2)
+            total = count + block.size
+            delta = block_mean - mean
+            mean += delta * block.size / total
+            m2 += block_m2 + delta ** 2 * count * block.size / total
+            count = total
+            vmin = min(vmin, block.min())
+            vmax = max(vmax, block.max())
+
+    if count == 0 or (has_nan and not ignore_nan):
+        return np.full(4, np.nan)
+    return np.array([vmin, vmax, mean, np.sqrt(m2 / count)])
+
+def get_seed_stat(sPathMatrix, sPathTS, data, seed, ext_nii, r_to_z=False, save_mat=False, ignore_nan=False, block_size=2048):
+    # Rows: number of voxels, min, max, mean and std of the voxel pair
+    # correlations of every seed ROI. The voxel x voxel matrices are only
+    # built when they are saved (save_mat).
     seed_stat = np.zeros((5, seed.shape[3]), dtype=np.float64)
     for k in range(seed.shape[3]):
         msk = seed[:,:,:,k] > 0
         maskData = data[msk, :]
-        if maskData.size == 0:
-            matrix[0] = np.nan
-        else:
+        if save_mat and maskData.size > 0:
             matrix = np.corrcoef(maskData, rowvar=True)
-        if r_to_z:
-            matrix = np.arctanh(matrix)
-        if save_mat:
+            if r_to_z:
+                matrix = np.arctanh(matrix)
             #pos = np.where(seed[:,:,:,k] > 0)
             #labels = [', '.join(str(v) for v in t) for t in zip(pos[0], pos[1], pos[2])]
             save_nifti(sPathTS, data[msk,:].T, k, ext_nii)
             save_nifti(sPathMatrix, matrix, k, ext_nii)
-        # get upper-triangle of matrix as list and set inf to nan
-        triu_cc = matrix[np.triu_indices_from(matrix, k=1)]
-        #triu_cc[np.where(np.isinf(triu_cc))] = np.nan
-        triu_cc[np.isinf(triu_cc)] = np.nan
-        seed_stat[0,k] = matrix.shape[0]
-        if ignore_nan:
-            seed_stat[1,k] = np.nanmin(triu_cc)
-            seed_stat[2,k] = np.nanmax(triu_cc)
-            seed_stat[3,k] = np.nanmean(triu_cc)
-            seed_stat[4,k] = np.nanstd(triu_cc)
-        else:
-            seed_stat[1,k] = np.amin(triu_cc)
-            seed_stat[2,k] = np.amax(triu_cc)
-            seed_stat[3,k] = np.mean(triu_cc)
-            seed_stat[4,k] = np.std(triu_cc)
+        seed_stat[0,k] = maskData.shape[0]
+        seed_stat[1:,k] = pairwise_corr_stat(maskData, r_to_z=r_to_z, ignore_nan=ignore_nan, block_size=block_size)
     return seed_stat
 
 def make_text_stat(sPathData, sPathSeed, seed_stat):
@@ -127,10 +160,10 @@ if __name__ == '__main__':
     # read 3D data file (NIfTI)
     print("Data:", sPathData)
     data_img = nib.load(sPathData)
-    data_data = data_img.get_data()
+    data_data = np.asanyarray(data_img.dataobj)
     #print("data_data.dtype:", data_data.dtype)
     #print("data_data.shape:", data_data.shape)
-    data_hdr = data_img.get_header()
+    data_hdr = data_img.header
     data_shape = data_hdr.get_data_shape()
     #print("data_shape:", data_shape)
     if len(data_shape) != 4:
@@ -139,10 +172,10 @@ if __name__ == '__main__':
     # read 4D seed ROIs file (NIfTI)
     print("Seed:", sPathSeed)
     seed_img = nib.load(sPathSeed)
-    seed_data = seed_img.get_data()
+    seed_data = np.asanyarray(seed_img.dataobj)
     #print("seed_data.dtype:", seed_data.dtype)
     #print("seed_data.shape:", seed_data.shape)
-    seed_hdr = seed_img.get_header()
+    seed_hdr = seed_img.header
     seed_shape = seed_hdr.get_data_shape()
     #print("seed_shape:", seed_shape)
     if len(seed_shape) != 4:
@@ -17,12 +17,46 @@ import scipy.io as io
 import correlate_matrix
 
 from datetime import datetime
-def start_fsl_mean_ts(sPathData,sPathMask,labelNames,postTxt):
-    # input data
+
+def roi_operator(mask, labels=None):
+    # Sparse region x voxel matrix with a 1 for every voxel of a region. mask
+    # is a 4D hyperstack with one volume per region or, with labels, a 3D
+    # atlas where region k are the voxels with the value labels[k]. Voxels are
+    # numbered in Fortran order, like nibabel arranges the data in memory.
+    from scipy import sparse
+    mask = np.asarray(mask)
+    if labels is None:
+        voxels, regions = np.nonzero(mask.reshape(-1, mask.shape[3], order='F') > 0)
+        return sparse.csr_matrix((np.ones(len(voxels)), (regions, voxels)),
+                                 shape=(mask.shape[3], mask[..., 0].size))
+
+    # one row per distinct label, then a row per region (labels may repeat)
+    atlas = mask.ravel(order='F')
+    unique_labels, inverse = np.unique(np.asarray(labels), return_inverse=True)
+    index = np.minimum(np.searchsorted(unique_labels, atlas), len(unique_labels) - 1)
+    voxels = np.flatnonzero(unique_labels[index] == atlas)
+    by_label = sparse.csr_matrix((np.ones(len(voxels)), (index[voxels], voxels)),
+                                 shape=(len(unique_labels), atlas.size))
+    to_region = sparse.csr_matrix((np.ones(len(inverse)), (np.arange(len(inverse)), inverse)),
+                                  shape=(len(inverse), len(unique_labels)))
+    return to_region @ by_label
+
+def roi_mean_ts(data, operator, dtype=None):
+    # Mean time series of every region (regions x time points) of 4D data in
+    # one sparse product over the voxels, regions without voxels stay 0.
+    counts = np.asarray(operator.sum(axis=1)).ravel()
+    sums = operator @ np.asarray(data).reshape(-1, data.shape[3], order='F')
+    m = np.zeros((operator.shape[0], data.shape[3]), dtype=dtype if dtype is not None else data.dtype)
+    m[counts > 0] = sums[counts > 0] / counts[counts > 0, np.newaxis]
+    return m
+
+def start_fsl_mean_ts(sPathData,sPathMask,labelNames,postTxt,roiLabels=None):
+    # sPathMask: 4D seed ROIs (one volume per region) or, with roiLabels, the
+    # 3D atlas; region k are then the voxels with the label roiLabels[k]
 
     # Read 4D data file (NIfTI )
     data_img = nib.load(sPathData)
-    data = data_img.get_data()
+    data = np.asanyarray(data_img.dataobj)
     data_hdr = data_img.header
     data_dtype = data_hdr.get_data_dtype()
     data_shape = data_hdr.get_data_shape()
@@ -47,25 +81,22 @@ def start_fsl_mean_ts(sPathData,sPathMask,labelNames,postTxt):
     if len(data_shape) != 4:
         sys.exit("Error: data %s has no 4D shape." % (str(data_shape),))
 
-    # Read 4D mask file (NIfTI)
+    # Read 4D mask file or 3D atlas (NIfTI)
     mask_img = nib.load(sPathMask)
-    mask = mask_img.get_data()
+    mask = np.asanyarray(mask_img.dataobj)
     mask_hdr = mask_img.header
     #mask_dtype = mask_hdr.get_data_dtype()
     mask_shape = mask_hdr.get_data_shape()
 
-    if len(mask_shape) != 4:
+    if roiLabels is None and len(mask_shape) != 4:
         sys.exit("Error: mask %s has no 4D shape." % (str(mask_shape),))
+    if roiLabels is not None and len(mask_shape) != 3:
+        sys.exit("Error: atlas %s has no 3D shape." % (str(mask_shape),))
 
     if data_shape[:3] != mask_shape[:3]:
         sys.exit("Error: data %s and mask %s are not the same shape." % (str(data_shape[:3]), str(mask_shape[:3])))
 
-    m = np.zeros((mask_shape[3], data_shape[3]), dtype=data_dtype)
-    for k in range(mask_shape[3]):
-        msk = np.array(mask[:, :, :, k]) > 0
-        maskedData = data[msk, :]
-        if maskedData.size > 0:
-            m[k] = np.mean(data[msk, :], 0)
+    m = roi_mean_ts(data, roi_operator(mask, roiLabels), dtype=data_dtype)
 
     fileNames = open(labelNames, 'r');
     lines = fileNames.readlines()
@@ -118,7 +149,7 @@ if __name__ == '__main__':
     # Read 4D data file (NIfTI )
     #print(sPathData)
     data_img = nib.load(sPathData)
-    data = data_img.get_data()
+    data = np.asanyarray(data_img.dataobj)
     #data = np.squeeze(data_img.get_data())
     #data = np.cast[np.float32](data_img.get_data())
     #print("data.dtype:", data.dtype)
@@ -134,7 +165,7 @@ if __name__ == '__main__':
     # Read 4D mask file (NIfTI)
     #print(sPathMask)
     mask_img = nib.load(sPathMask)
-    mask = mask_img.get_data()
+    mask = np.asanyarray(mask_img.dataobj)
     #mask = np.squeeze(mask_img.get_data())
     #mask = np.cast[np.float32](mask_img.get_data())
     #print("mask.dtype:", mask.dtype)
@@ -150,12 +181,7 @@ if __name__ == '__main__':
     if data_shape[:3] != mask_shape[:3]:
         sys.exit("Error: data %s and mask %s are not the same shape." % (str(data_shape[:3]), str(mask_shape[:3])))
 
-    m = np.zeros((mask_shape[3], data_shape[3]), dtype=data_dtype)
-    for k in range(mask_shape[3]):
-        msk = np.array(mask[:,:,:,k]) > 0
-        maskedData = data[msk,:]
-        if maskedData.size > 0:
-            m[k] = np.mean(data[msk,:], 0)
+    m = roi_mean_ts(data, roi_operator(mask), dtype=data_dtype)
 
     #s = [['%.4f' % (x,) for x in line] for line in m.T.tolist()]
     #s = [map(lambda x: '%.4f' % (x,), line) for line in m.T.tolist()]
@@ -9,10 +9,10 @@ University Hospital Cologne
 """
 
 import sys,os
-import numpy as np
 import glob
 import parReader
 import i32Reader
+import getSingleRegTable
 
 def findData(path,addon):
     reg_list = []
@@ -21,7 +21,7 @@ def findData(path,addon):
         reg_list.append(filename)
     return reg_list
 
-def getRegrTable(file_name):
+def getRegrTable(file_name,text=False):
     # proof par Folder
     par_Path = os.path.join(file_name,'rs-fMRI_mcf')
     if not os.path.exists(par_Path):
@@ -43,11 +43,6 @@ def getRegrTable(file_name):
     #if not  len(listofPar_names) == len(listofI32_names):
     #   print('\x1b[00;37;43m' + 'Some Data of I32 have no corresponding par data!' + '\x1b[0m')
 
-    headlineStr = ['#Resp. BLC(1)','Resp. Deriv.(2)','Card. BLC(3)',
-                  'Card. Deriv.(4)','RotX(5)','RotY(6)','RotZ(7)',
-                  'dX(8)','dY(9)','dZ(10)','1st Order Drift(11)',
-                  '2nd Order Drift(12)','3rd Order Drift(13)']
-
     for i in range(len(listofPar_names)):
         #  get par folder info
         par_folder_path = os.path.join(listofPar_names[i])
@@ -58,6 +53,10 @@ def getRegrTable(file_name):
         # get par-Folder content
         cur_contentOfPar = findData(par_folder_path, '*.par')
         numberOfSlices = len(cur_contentOfPar)
+        parSlices = [int(os.path.basename(cur_par_file_path).split('_slc')[1][0:4]) for cur_par_file_path in cur_contentOfPar]
+        getSingleRegTable.checkParSlices(parSlices,par_folder_path)
+        # name of the regression table, shared by all .par files of the folder
+        rgrName = os.path.basename(cur_contentOfPar[0]).split('_slc')[0]
 
         # find corresponding I32 dataset
         str_indexI32 = [s for s in listofI32_names if par_folder_name2comp in s]
@@ -78,41 +77,14 @@ def getRegrTable(file_name):
         trigger,i32Table = i32Reader.getI32(i32_folder_path,numberOfSlices,numberOfAllRepitionsParTable)
         numberOfAllRepitionsI32 = len(trigger)/numberOfSlices
 
-        # generate drifts
-        driftTable = np.zeros([numberOfAllRepitionsParTable,3])
-        x = np.linspace(-1,1,numberOfAllRepitionsParTable)
-        driftTable[:,0] = x
-        driftTable[:,1] = x**2
-        driftTable[:,2] = x**3
-
-        for j in range(len(cur_contentOfPar)):
-            tempRgrName = os.path.basename(cur_contentOfPar[j]).split('_slc')
-            cur_slc = int(tempRgrName[1][0:4])
-            rgr_folder_name = tempRgrName[0] + '_mcf_slice_' + tempRgrName[1][0:4] + '.txt'
-            rgr_folder_path = os.path.join(target_folder,rgr_folder_name)
-
-            # get par - Data
-            cur_par_file_path = cur_contentOfPar[j]
-            parTable = parReader.getPar(cur_par_file_path)
-
-            # get I32 entries for cur_slc
-            cur_slc_i32entries = i32Table[trigger[cur_slc::numberOfSlices]]
-
-            # merge i32Table, parTable and driftTable
-            fid = open(rgr_folder_path,'w')
-            fid.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n'
-                      % (headlineStr[0],headlineStr[1],headlineStr[2],headlineStr[3],headlineStr[4],
-                         headlineStr[5],headlineStr[6],headlineStr[7],headlineStr[8],headlineStr[9]
-                         ,headlineStr[10],headlineStr[11],headlineStr[12]))
-
-            for repIndex in range(numberOfAllRepitionsParTable):
-                fid.write('%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\n'
-                          % (cur_slc_i32entries[repIndex,0],cur_slc_i32entries[repIndex,1],
-                             cur_slc_i32entries[repIndex,2],cur_slc_i32entries[repIndex,3],
-                             parTable[repIndex,0],parTable[repIndex,1],parTable[repIndex,2],
-                             parTable[repIndex,3],parTable[repIndex,4],parTable[repIndex,5],
-                             driftTable[repIndex,0],driftTable[repIndex,1],driftTable[repIndex,2]))
-            fid.close()
+        # motion parameters of every slice, in slice order
+        parTables = [None] * numberOfSlices
+        for cur_slc, cur_par_file_path in zip(parSlices, cur_contentOfPar):
+            parTables[cur_slc] = parReader.getPar(cur_par_file_path)
+
+        # merge i32Table, parTable and driftTable
+        design = getSingleRegTable.getRegrDesign(trigger,i32Table,parTables,numberOfSlices,numberOfAllRepitionsParTable)
+        getSingleRegTable.saveRegrDesign(design,target_folder,rgrName,text)
     return 0
 
 if __name__ == "__main__":
@@ -123,6 +95,7 @@ if __name__ == "__main__":
 
     requiredNamed = parser.add_argument_group('required named arguments')
     requiredNamed.add_argument('-i','--input', help='Path to input data',required=True)
+    parser.add_argument('-t', '--text', action='store_true', help='Also write a tab separated table per slice (FSL)')
     args = parser.parse_args()
 
 
@@ -131,4 +104,4 @@ if __name__ == "__main__":
     if not os.path.exists(input):
         sys.exit("Error: '%s' is not an existing directory or file %s is not in directory." % (input, args.file,))
 
-    result = getRegrTable(input)
+    result = getRegrTable(input,text=args.text)
@@ -24,7 +24,53 @@ def findData(path,addon):
         reg_list.append(filename)
     return reg_list
 
-def getRegrTable(file_name,physio_Folder,parPath_folder):
+headlineStr = ['#Resp. BLC(1)','Resp. Deriv.(2)','Card. BLC(3)',
+               'Card. Deriv.(4)','RotX(5)','RotY(6)','RotZ(7)',
+               'dX(8)','dY(9)','dZ(10)','1st Order Drift(11)',
+               '2nd Order Drift(12)','3rd Order Drift(13)']
+
+def checkParSlices(slices,par_folder_path):
+    # slices: slice index of every .par file of par_folder_path; exits unless
+    # every slice 0..n-1 has exactly one .par file
+    if len(slices) == 0:
+        sys.exit("Error: %s contains no .par files." % (par_folder_path,))
+    missing = [slc for slc in range(max(slices) + 1) if slc not in slices]
+    if missing:
+        sys.exit("Error: no .par file of slice(s) %s in %s." % (', '.join(str(slc) for slc in missing), par_folder_path))
+    if len(set(slices)) != len(slices):
+        sys.exit("Error: more than one .par file of a slice in %s." % (par_folder_path,))
+
+def getRegrDesign(trigger,i32Table,parTables,numberOfSlices,numberOfAllRepitionsParTable):
+    # Regressors of all slices (slices x repetitions x 13 columns of headlineStr):
+    # physio entries at the trigger of every slice and repetition, motion
+    # parameters of the slice (parTables in slice order) and polynomial drifts
+    reps = numberOfAllRepitionsParTable
+    design = np.zeros([numberOfSlices, reps, len(headlineStr)])
+
+    # trigger[slc::numberOfSlices][rep] is trigger[rep*numberOfSlices + slc]
+    design[:, :, 0:4] = i32Table[trigger[:reps * numberOfSlices].reshape(reps, numberOfSlices).T]
+    design[:, :, 4:10] = np.stack([parTable[:reps] for parTable in parTables])
+
+    # generate drifts
+    x = np.linspace(-1,1,reps)
+    design[:, :, 10] = x
+    design[:, :, 11] = x**2
+    design[:, :, 12] = x**3
+    return design
+
+def saveRegrDesign(design,target_folder,tempRgrName,text=False):
+    # design as a single .npy file (read by regress.py); text: also the former
+    # tab separated table of every slice (FSL, fsl_regfilt -d)
+    design_path = os.path.join(target_folder, tempRgrName + '_mcf_regressors.npy')
+    np.save(design_path, design)
+    if text:
+        for cur_slc in range(design.shape[0]):
+            rgr_folder_path = os.path.join(target_folder, tempRgrName + '_mcf_slice_' + '%04d' % cur_slc + '.txt')
+            np.savetxt(rgr_folder_path, design[cur_slc], fmt='%f', delimiter='\t',
+                       header='\t'.join(headlineStr)[1:], comments='#')
+    return design_path
+
+def getRegrTable(file_name,physio_Folder,parPath_folder,text=False):
     # proof par Folder
     par_Path = os.path.join(file_name,'rs-fMRI_mcf')
     if not os.path.exists(par_Path):
@@ -36,6 +82,8 @@ def getRegrTable(file_name,physio_Folder,parPath_folder):
     # get par-Folder content
     cur_contentOfPar = findData(par_folder_path, '*.par')
     numberOfSlices = len(cur_contentOfPar)
+    parSlices = [int(cur_par_file_path[-15:-11]) for cur_par_file_path in cur_contentOfPar]
+    checkParSlices(parSlices,par_folder_path)
 
     # read the first par Table to get the real number of Repition
     cur_par_file_path = cur_contentOfPar[0]
@@ -65,51 +113,20 @@ def getRegrTable(file_name,physio_Folder,parPath_folder):
     #if not  len(listofPar_names) == len(listofI32_names):
     #   print('\x1b[00;37;43m' + 'Some Data of I32 have no corresponding par data!' + '\x1b[0m')
 
-    headlineStr = ['#Resp. BLC(1)','Resp. Deriv.(2)','Card. BLC(3)',
-                  'Card. Deriv.(4)','RotX(5)','RotY(6)','RotZ(7)',
-                  'dX(8)','dY(9)','dZ(10)','1st Order Drift(11)',
-                  '2nd Order Drift(12)','3rd Order Drift(13)']
-
-
     # get i32 - Data
     trigger,i32Table = i32Reader.getI32(physio_Folder,numberOfSlices,numberOfAllRepitionsParTable)
     numberOfAllRepitionsI32 = len(trigger)/numberOfSlices
     #print(numberOfAllRepitionsI32)
 
-    # generate drifts
-    driftTable = np.zeros([numberOfAllRepitionsParTable,3])
-    x = np.linspace(-1,1,numberOfAllRepitionsParTable)
-    driftTable[:,0] = x
-    driftTable[:,1] = x**2
-    driftTable[:,2] = x**3
+    # motion parameters of every slice, in slice order
     tempRgrName = os.path.basename(physio_Folder).split('.')[0]
-    for j in range(len(cur_contentOfPar)):
-        cur_slc = int(cur_contentOfPar[j][-15:-11])
-        rgr_folder_name = tempRgrName + '_mcf_slice_' + cur_contentOfPar[j][-15:-11] + '.txt'
-        rgr_folder_path = os.path.join(target_folder,rgr_folder_name)
-
-        # get par - Data
-        cur_par_file_path = cur_contentOfPar[j]
-        parTable = parReader.getPar(cur_par_file_path)
-
-        # get I32 entries for cur_slc
-        cur_slc_i32entries = i32Table[trigger[cur_slc::numberOfSlices]]
-
-        # merge i32Table, parTable and driftTable
-        fid = open(rgr_folder_path,'w')
-        fid.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n'
-                  % (headlineStr[0],headlineStr[1],headlineStr[2],headlineStr[3],headlineStr[4],
-                     headlineStr[5],headlineStr[6],headlineStr[7],headlineStr[8],headlineStr[9]
-                     ,headlineStr[10],headlineStr[11],headlineStr[12]))
-
-        for repIndex in range(numberOfAllRepitionsParTable):
-            fid.write('%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\n'
-                      % (cur_slc_i32entries[repIndex,0],cur_slc_i32entries[repIndex,1],
-                         cur_slc_i32entries[repIndex,2],cur_slc_i32entries[repIndex,3],
-                         parTable[repIndex,0],parTable[repIndex,1],parTable[repIndex,2],
-                         parTable[repIndex,3],parTable[repIndex,4],parTable[repIndex,5],
-                         driftTable[repIndex,0],driftTable[repIndex,1],driftTable[repIndex,2]))
-        fid.close()
+    parTables = [None] * numberOfSlices
+    for cur_slc, cur_par_file_path in zip(parSlices, cur_contentOfPar):
+        parTables[cur_slc] = parReader.getPar(cur_par_file_path)
+
+    # merge i32Table, parTable and driftTable
+    design = getRegrDesign(trigger,i32Table,parTables,numberOfSlices,numberOfAllRepitionsParTable)
+    saveRegrDesign(design,target_folder,tempRgrName,text)
     return 0
 
 if __name__ == "__main__":
@@ -121,6 +138,7 @@ if __name__ == "__main__":
     requiredNamed = parser.add_argument_group('required named arguments')
     requiredNamed.add_argument('-i','--input', help='Path to input data',required=True)
     requiredNamed.add_argument('-p', '--physio_Folder', help='Path to the Physio folder', required=True)
+    parser.add_argument('-t', '--text', action='store_true', help='Also write a tab separated table per slice (FSL)')
     args = parser.parse_args()
 
 
@@ -134,4 +152,4 @@ if __name__ == "__main__":
     if not os.path.exists(physio_Folder):
         sys.exit("Error: '%s' is not an existing directory or file %s is not in directory." % (physio_Folder, args.file,))
 
-    result = getRegrTable(input,physio_Folder)
+    result = getRegrTable(input,physio_Folder,text=args.text)
@@ -22,9 +22,9 @@ def getI32(file_name,numberOfSlices,numberOfAllRepitionsParTable):
 
 
     #fileSize = fileInfo.bytes/4
-    fid = open(file_name)
-
-    fileTable   = np.fromfile(fid, dtype=np.float32)
+    # 4 interleaved float32 channels (time, respiration, trigger, cardiac),
+    # mapped copy-on-write: the channels are strided views into the file
+    fileTable   = np.memmap(file_name, dtype=np.float32, mode='c')
 
 
     #fpRawTime	= fileTable[0:len(fileTable):4]
@@ -76,15 +76,17 @@ def getI32(file_name,numberOfSlices,numberOfAllRepitionsParTable):
     print('avg. Card Rate: ' + str(len(pksCardpMax) / (len(CardBLC) / 60000)) + ' 1/min')
 
     # if the trigger max is not equal 1 but higher
-    if max(fpRawTrig) != 1.0:
-        fpRawTrig = fpRawTrig-(max(fpRawTrig)-1)
+    if fpRawTrig.max() != 1.0:
+        fpRawTrig = fpRawTrig-(fpRawTrig.max()-1)
 
     # find missing trigger and replace 1 by 0
     idx_missedTrigger = np.where(np.diff(fpRawTrig,2)==2)[0]+1
     if len(idx_missedTrigger)>0:
         fpRawTrig[idx_missedTrigger+1] =0
 
-    triggerDataPoints = np.argwhere(fpRawTrig == 0)
+    # positions of all triggers, searched once
+    allTriggerDataPoints = np.flatnonzero(fpRawTrig == 0)
+    triggerDataPoints = allTriggerDataPoints
     numberOfTiggers = len(triggerDataPoints)
     numberOfRepitions = numberOfTiggers / (numberOfSlices * 2)
     print('Number of Repetitions: ' + str(numberOfRepitions))
@@ -100,16 +102,17 @@ def getI32(file_name,numberOfSlices,numberOfAllRepitionsParTable):
     # if some wrong triggers in i32 file
     if numberOfTiggers > (numberOfAllRepitionsParTable + 5) * numberOfSlices * 2:
         wrongAmountOfTriggers = numberOfTiggers-(numberOfAllRepitionsParTable + 5) * numberOfSlices * 2
-        fpRawTrig_cut = fpRawTrig[wrongAmountOfTriggers*100-1::]
-        triggerDataPoints = np.argwhere(fpRawTrig_cut == 0)
+        # triggers of fpRawTrig[cut::], relative to the cut
+        cut = min(wrongAmountOfTriggers*100-1, len(fpRawTrig))
+        triggerDataPoints = allTriggerDataPoints[np.searchsorted(allTriggerDataPoints, cut):] - cut
         numberOfTiggers = len(triggerDataPoints)
         numberOfRepitions = numberOfTiggers / (numberOfSlices * 2)
         print('Number of Repetitions: ' + str(numberOfRepitions))
 
 
 
-    triggerDataPoints_1st = triggerDataPoints[numberOfSlices * 5 * 2 : numberOfTiggers:2,0]
-    triggerDataPoints_2nd = triggerDataPoints[numberOfSlices * 5 * 2 +1: numberOfTiggers:2,0]
+    triggerDataPoints_1st = triggerDataPoints[numberOfSlices * 5 * 2 : numberOfTiggers:2]
+    triggerDataPoints_2nd = triggerDataPoints[numberOfSlices * 5 * 2 +1: numberOfTiggers:2]
     usedTriggerAmount = ((numberOfAllRepitionsParTable+5)*numberOfSlices*2-5*2*numberOfSlices)/2
 
     if not len(triggerDataPoints_1st) == len(triggerDataPoints_2nd):
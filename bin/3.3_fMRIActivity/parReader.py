@@ -13,18 +13,8 @@ import numpy as np
 import os,sys
 def getPar(filename):
 
-    ## Open the text file.
-    fileID = open(filename,'r')
-
-    # Read columns of data according to the format.
-    fileID.seek(0)
-    lines = fileID.readlines()
-    parData = np.zeros([len(lines),6])
-    for row in range(len(lines)):
-        for j in range(0, 12, 2):
-            colume = int(j/2)
-            parData[row][colume] = float(lines[row].split(' ')[j])
-    fileID.close()
+    # MCFLIRT motion parameters, one row per volume: 3 rotations, 3 translations
+    parData = np.loadtxt(filename, ndmin=2)[:, :6]
 
 
     # Create output variable
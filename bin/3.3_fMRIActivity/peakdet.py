@@ -24,13 +24,76 @@ function [maxtab, mintab]=peakdet(v, delta, x)
 """
 
 import sys
-from numpy import NaN, Inf, arange, isscalar, asarray, array
+import numpy as np
+from numpy import arange, isscalar, asarray, array
+
+
+def _nextPeak(v, start, delta, lookformax, width=256):
+    # First index i > start where v[i] falls more than delta below the running
+    # maximum of v[start..i] (lookformax) or rises more than delta above the
+    # running minimum, together with the position of that extreme in
+    # v[start:i]. Returns (None, None) if v ends before. The running extreme
+    # is accumulated in growing windows, so every sample is visited about once.
+    accumulate = np.fmax.accumulate if lookformax else np.fmin.accumulate
+    extreme = None
+    offset = start
+    while offset < len(v):
+        window = v[offset:offset + width]
+        running = accumulate(window)
+        if extreme is not None:
+            running = np.fmax(running, extreme) if lookformax else np.fmin(running, extreme)
+        if lookformax:
+            hits = np.flatnonzero(window < running - delta)
+        else:
+            hits = np.flatnonzero(window > running + delta)
+        if hits.size > 0:
+            i = offset + hits[0]
+            # first occurrence of the extreme, as the loop only moves it on a strict > / <
+            if extreme is None:
+                pos = start + np.argmax(running == running[hits[0]])
+            else:
+                pos = start + (np.nanargmax(v[start:i]) if lookformax else np.nanargmin(v[start:i]))
+            return i, pos
+        extreme = running[-1]
+        offset += width
+        width *= 2
+    return None, None
+
+
+def _loopPeaks(v, start, delta, lookformax, maxpos, minpos):
+    # sample by sample search of the MATLAB original from start on
+    mn, mx = np.inf, -np.inf
+    mnpos, mxpos = None, None
+    for i in range(start, len(v)):
+        this = v[i]
+        if this > mx:
+            mx = this
+            mxpos = i
+        if this < mn:
+            mn = this
+            mnpos = i
 
+        if lookformax:
+            if this < mx - delta:
+                maxpos.append(mxpos)
+                mn = this
+                mnpos = i
+                lookformax = False
+        else:
+            if this > mn + delta:
+                minpos.append(mnpos)
+                mx = this
+                mxpos = i
+                lookformax = True
 
-def peakdet(v, delta, x=None):
 
-    maxtab = []
-    mintab = []
+def peakdet(v, delta, x=None):
+    # Same peaks as the sample by sample loop of the MATLAB original: the
+    # search alternates between a maximum (until the signal drops by more
+    # than delta) and a minimum (until it rises by more than delta), each
+    # segment is searched with NumPy (_nextPeak) instead of a Python loop.
+    # For signals with peaks only a few samples apart the overhead per
+    # segment exceeds the loop, the rest is then searched sample by sample.
 
     if x is None:
         x = arange(len(v))
@@ -46,34 +109,36 @@ def peakdet(v, delta, x=None):
     if delta <= 0:
         sys.exit('Input argument delta must be positive')
 
-    mn, mx = Inf, -Inf
-    mnpos, mxpos = NaN, NaN
+    x = asarray(x)
+    maxpos = []
+    minpos = []
 
+    start = 0
     lookformax = True
-
-    for i in arange(len(v)):
-        this = v[i]
-        if this > mx:
-            mx = this
-            mxpos = x[i]
-        if this < mn:
-            mn = this
-            mnpos = x[i]
-
+    segments = 0
+    width = 256
+    while start < len(v):
+        if segments >= 64 and start < 32 * segments:
+            _loopPeaks(v, start, delta, lookformax, maxpos, minpos)
+            break
+        i, pos = _nextPeak(v, start, delta, lookformax, width)
+        if i is None:
+            break
         if lookformax:
-            if this < mx - delta:
-                maxtab.append((mxpos, mx))
-                mn = this
-                mnpos = x[i]
-                lookformax = False
+            maxpos.append(pos)
         else:
-            if this > mn + delta:
-                mintab.append((mnpos, mn))
-                mx = this
-                mxpos = x[i]
-                lookformax = True
-
-    return array(maxtab), array(mintab)
+            minpos.append(pos)
+        # the next extreme is searched from the sample that ended this one,
+        # the first window covers about twice the last segment
+        width = max(64, 2 * (i - start))
+        start = i
+        lookformax = not lookformax
+        segments += 1
+
+    # two columns (position, value) like array() of the (position, value) tuples
+    maxtab = np.column_stack((x[maxpos], v[maxpos])) if maxpos else array([])
+    mintab = np.column_stack((x[minpos], v[minpos])) if minpos else array([])
+    return maxtab, mintab
 
 
 if __name__ == "__main__":
@@ -10,32 +10,39 @@ University Hospital Cologne
 
 
 import sys, os
-import nipype.interfaces.fsl as fsl
 import nibabel as nii
 import numpy as np
 import glob
 import shutil
+import tempfile
+import concurrent.futures
 import regress
 import getSingleRegTable
-import scipy.misc as mc
 import create_seed_rois
 import fsl_mean_ts
+from niftiScale import scaleBy10
 from pathlib import Path 
 import json
 
-def copyAtlasOfData(path,post,labels):
+def copyAtlasOfData(path,post,labels,writeRois=False):
+    # Returns the atlas and the label of every seed region (labels text file),
+    # the time series are taken from the atlas directly. With writeRois the
+    # 4D seed ROIs (one volume per region) are written as well.
     fileALL = glob.glob(path + '/*' + post + '.nii.gz')
     if fileALL.__len__()>1:
         sys.exit("Error: '%s' has no related Atlas File." % (path,))
     else:
         fileALL = fileALL[0]
 
-    print("Copy Atlas Data and generate seed ROIs")
-    #pathfMRI = os.path.join(os.path.dirname(path),'fMRI')
-    outputRois = create_seed_rois.startSeedPoint(in_atlas=os.path.join(path, os.path.basename(fileALL)),in_labels=labels)
-    return outputRois
+    atlasFile = os.path.join(path, os.path.basename(fileALL))
+    if writeRois:
+        print("Copy Atlas Data and generate seed ROIs")
+        #pathfMRI = os.path.join(os.path.dirname(path),'fMRI')
+        create_seed_rois.startSeedPoint(in_atlas=atlasFile,in_labels=labels)
+    return atlasFile, create_seed_rois.read_labels(labels)[1]
 
 def imgScaleResize(img):
+    import scipy.misc as mc
     newImg = np.zeros([128,128,20,355])
     for i in range(img.shape[3]):
         for j in range(img.shape[2]):
@@ -43,29 +50,6 @@ def imgScaleResize(img):
 
     return newImg
 
-def scaleBy10(input_path,inv):
-    data = nii.load(input_path)
-    imgTemp = data.get_fdata()
-    if inv is False:
-        scale = np.eye(4) * 10
-        scale[3][3] = 1
-        scaledNiiData = nii.Nifti1Image(imgTemp, data.affine * scale)
-        fslPath = os.path.join(os.path.dirname(input_path), 'fslScaleTemp.nii.gz')
-        nii.save(scaledNiiData, fslPath)
-        return fslPath
-    elif inv is True:
-        scale = np.eye(4) / 10
-        scale[3][3] = 1
-        unscaledNiiData = nii.Nifti1Image(imgTemp, data.affine * scale)
-        hdrOut = unscaledNiiData.header
-        hdrOut.set_xyzt_units('mm')
-
-        # hdrOut['sform_code'] = 1
-        nii.save(unscaledNiiData, input_path)
-        return input_path
-    else:
-        sys.exit("Error: inv - parameter should be a boolean.")
-
 def findSlicesData(path,pre):
     regMR_list = []
     fileALL = glob.iglob(path+'/'+pre+'*.nii.gz',recursive=True)
@@ -91,6 +75,7 @@ def getRASorientation(file_name,proc_Path):
     return output_file
 
 def getEPIMean(file_name,proc_Path):
+    import nipype.interfaces.fsl as fsl
     output_file = os.path.join(proc_Path, os.path.basename(file_name).split('.')[0]) + 'mean.nii.gz'
     myMean = fsl.MeanImage(in_file=file_name, out_file=output_file)
     print(myMean.cmdline)
@@ -98,6 +83,7 @@ def getEPIMean(file_name,proc_Path):
     return output_file
 
 def applyBET(input_file,frac,radius,vertical_gradient):
+    import nipype.interfaces.fsl as fsl
 
     # scale Nifti data by factor 10
     fslPath = scaleBy10(input_file,inv=False)
@@ -114,6 +100,7 @@ def applyBET(input_file,frac,radius,vertical_gradient):
     return output_file,maskFile
 
 def applyMask(input_file,mask_file):
+    import nipype.interfaces.fsl as fsl
     fslPath = scaleBy10(input_file, inv=False)
     # maks apply
     output_file = os.path.join(os.path.dirname(input_file), os.path.basename(input_file).split('.')[0]) + 'BET.nii.gz'
@@ -125,53 +112,67 @@ def applyMask(input_file,mask_file):
     output_file = scaleBy10(output_file, inv=True)
     return output_file
 
-def fsl_SeparateSliceMoCo(input_file,par_folder):
-    # scale Nifti data by factor 10
+def scratchDir(nbytes):
+    # RAM backed scratch space (/dev/shm) if it has room for nbytes, otherwise
+    # the default temporary folder
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        stat = os.statvfs(shm)
+        if stat.f_bavail * stat.f_frsize > 2 * nbytes:
+            return shm
+    return None
+
+def motionCorrectSlice(slice_file, out_file):
+    import nipype.interfaces.fsl as fsl
+    myMCFLIRT = fsl.preprocess.MCFLIRT(in_file=slice_file, out_file=out_file, save_plots=True,
+                                       output_type='NIFTI', terminal_output='none')
+    result = myMCFLIRT.run()
+    os.remove(slice_file)
+    return result.outputs.out_file, result.outputs.par_file
+
+def fsl_SeparateSliceMoCo(input_file, par_folder, workers=None):
+    # Motion correction slice by slice with MCFLIRT. The slices are written
+    # uncompressed into a private scratch folder (RAM backed where possible)
+    # and registered concurrently by workers threads (default: the thread
+    # budget OMP_NUM_THREADS of the batchProc.py job, else all cores). Only
+    # the merged volume and the .par files of the slices are written to disk.
     dataName = os.path.basename(input_file).split('.')[0]
+    data = nii.load(input_file)
+    img = data.get_fdata(dtype=np.float32)  # MCFLIRT works on float32
 
-    aidamri_dir = os.getcwd()
-    temp_dir = os.path.join(os.path.dirname(input_file), "temp")
-    if not os.path.exists(temp_dir):
-        os.mkdir(temp_dir)
-
-    fslPath = scaleBy10(input_file, inv=False)
-    os.chdir(temp_dir)
-    mySplit= fsl.Split(in_file=fslPath,dimension='z',out_base_name = dataName)
-    print(mySplit.cmdline)
-    mySplit.run()
-    os.remove(fslPath)
-
-
-    # sparate ref and src volume in slices
-    sliceFiles = findSlicesData(os.getcwd(),dataName)
-
-    #start to correct motions slice by slice
-    for i in  range(len(sliceFiles)):
-        slc = sliceFiles[i]
-        # ref = refFiles[i]
-        # take epi as ref
-        output_file = os.path.join(par_folder,os.path.basename(slc))
-        myMCFLIRT = fsl.preprocess.MCFLIRT(in_file=slc,out_file=output_file,save_plots=True,terminal_output='none')
-        myMCFLIRT.run()
-        os.remove(slc)
-        # os.remove(ref)
-
-    # merge slices to a single volume
+    # scale Nifti data by factor 10
+    scale = np.eye(4) * 10
+    scale[3][3] = 1
+    affine = data.affine * scale
+
+    if workers is None:
+        workers = int(os.environ.get('OMP_NUM_THREADS', 0)) or os.cpu_count()
+
+    temp_dir = tempfile.mkdtemp(prefix=dataName + '_moco_', dir=scratchDir(img.nbytes))
+    try:
+        slices = []
+        for z in range(img.shape[2]):
+            slice_file = os.path.join(temp_dir, '%s%04d.nii' % (dataName, z))
+            nii.save(nii.Nifti1Image(img[:, :, z:z + 1], affine), slice_file)
+            slices.append((slice_file, os.path.join(temp_dir, '%s%04d_mcf.nii' % (dataName, z))))
+
+        # start to correct motions of all slices
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda files: motionCorrectSlice(*files), slices))
+
+        # merge slices to a single volume, .par files named like the former fslsplit slices
+        mcf = np.zeros(img.shape)
+        for z, (out_file, par_file) in enumerate(results):
+            mcf[:, :, z:z + 1] = nii.load(out_file).get_fdata().reshape(mcf[:, :, z:z + 1].shape)
+            shutil.copyfile(par_file, os.path.join(par_folder, '%s%04d.nii.gz.par' % (dataName, z)))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
-    mcf_sliceFiles = findSlicesData(par_folder,dataName)
     output_file = os.path.join(os.path.dirname(input_file),
                                os.path.basename(input_file).split('.')[0]) + '_mcf.nii.gz'
-    myMerge = fsl.Merge(in_files=mcf_sliceFiles,dimension='z',merged_file =output_file)
-    print(myMerge.cmdline)
-    myMerge.run()
-
-    for slc in mcf_sliceFiles: os.remove(slc)
-
-    # unscale result data by factor 10ˆ(-1)
-    output_file = scaleBy10(output_file, inv=True)
-    
-    #os.remove(temp_dir)
-    os.chdir(aidamri_dir)
+    unscaledNiiData = nii.Nifti1Image(mcf, data.affine)
+    unscaledNiiData.header.set_xyzt_units('mm')
+    nii.save(unscaledNiiData, output_file)
 
     return output_file
 
@@ -277,7 +278,7 @@ def startProcess(Rawfile_name):
 
     return mcfFile_name
 
-if __name__ == "__main__":
+def main(argv=None):
 
     TR = 1.42
     cutOff_sec = 100.0
@@ -292,8 +293,14 @@ if __name__ == "__main__":
     parser.add_argument('-c', '--cutOff_sec', default=cutOff_sec, help='High-pass filter cutoff sec')
     parser.add_argument('-f', '--FWHM', default=FWHM, help='Full width at half maximum')
     parser.add_argument('-stc', '--slicetimecorrection', default="False", type=str, help='choose to perform slice time correction or not')
+    parser.add_argument('-fsl', '--fslChain', action='store_true',
+                        help='run the steps after the regression as separate FSL calls on files instead of in memory')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='also write the intermediate images of the in-memory steps after the regression')
+    parser.add_argument('-r', '--seedRois', action='store_true',
+                        help='also write the 4D seed ROIs (Seed_ROIs.nii.gz, one volume per region) of the atlases')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.slicetimecorrection == "True":
         stc = True
@@ -339,7 +346,8 @@ if __name__ == "__main__":
         slice_order_path = os.path.join(Path(meta_data_file).parent, "slice_order.txt")
         create_txt_file(slice_order_path, slice_order)
         
-        rgr_file, srgr_file, sfrgr_file = regress.startRegression(mcfFile_name, FWHM, cutOff_sec, TR, stc, slice_order_path, costum_timings_path)
+        rgr_file, srgr_file, sfrgr_file = regress.startRegression(mcfFile_name, FWHM, cutOff_sec, TR, stc, slice_order_path, costum_timings_path,
+                                                                     fused=not args.fslChain, debug=args.debug)
 
         # delete temp txt files
         delete_txt_file(costum_timings_path)
@@ -347,16 +355,21 @@ if __name__ == "__main__":
 
     else:
         print("Starting Regression without slice time correction:")
-        rgr_file, srgr_file, sfrgr_file = regress.startRegression(mcfFile_name, FWHM, cutOff_sec, TR, stc)
+        rgr_file, srgr_file, sfrgr_file = regress.startRegression(mcfFile_name, FWHM, cutOff_sec, TR, stc,
+                                                                     fused=not args.fslChain, debug=args.debug)
         print(f"sfrgr_file {sfrgr_file}")
 
     
 
     atlasPath = os.path.dirname(input_file)
-    roisPath = copyAtlasOfData(atlasPath,'Anno_parental',labels)
+    atlasFile, roiLabels = copyAtlasOfData(atlasPath,'Anno_parental',labels,args.seedRois)
+
+    fslMeantsFile = fsl_mean_ts.start_fsl_mean_ts(sfrgr_file, atlasFile, labelNames, 'MasksTCs.', roiLabels)
 
-    fslMeantsFile = fsl_mean_ts.start_fsl_mean_ts(sfrgr_file, roisPath, labelNames, 'MasksTCs.')
+    atlasFile, roiLabels = copyAtlasOfData(atlasPath, 'AnnoSplit_parental', labels2000, args.seedRois)
 
-    roisPath = copyAtlasOfData(atlasPath, 'AnnoSplit_parental', labels2000)
+    fslMeantsFile = fsl_mean_ts.start_fsl_mean_ts(sfrgr_file, atlasFile, labelNames2000, 'MasksTCsSplit.', roiLabels)
 
-    fslMeantsFile = fsl_mean_ts.start_fsl_mean_ts(sfrgr_file, roisPath, labelNames2000, 'MasksTCsSplit.')
+
+if __name__ == "__main__":
+    main()
@@ -14,32 +14,12 @@ import numpy as np
 import nipype.interfaces.fsl as fsl
 import glob
 import shutil
+import tempfile
+import concurrent.futures
 from pathlib import Path
+from niftiScale import scaleBy10, scaledImage
 
 
-def scaleBy10(input_path,inv):
-    data = nii.load(input_path)
-    imgTemp = data.get_data()
-    if inv == False:
-        scale = np.eye(4) * 10
-        scale[3][3] = 1
-        scaledNiiData = nii.Nifti1Image(imgTemp, data.affine * scale)
-        fslPath = os.path.join(os.path.dirname(input_path), os.path.basename(input_path).split('.')[0]+'_fslScaleTemp.nii.gz')
-        nii.save(scaledNiiData, fslPath)
-        return fslPath
-    elif inv == True:
-        scale = np.eye(4) / 10
-        scale[3][3] = 1
-        unscaledNiiData = nii.Nifti1Image(imgTemp, data.affine * scale)
-        hdrOut = unscaledNiiData.header
-        hdrOut.set_xyzt_units('mm')
-
-        # hdrOut['sform_code'] = 1
-        nii.save(unscaledNiiData, input_path)
-        return input_path
-    else:
-        sys.exit("Error: inv - parameter should be a boolean.")
-
 def findRegData(path):
     regMR_list = []
     fileALL = glob.iglob(path+'/*.txt',recursive=True)
@@ -137,6 +117,213 @@ def fsl_RegrSliceWise(input_file,txtregr_Path,regr_Path):
 
     return output_file
 
+def readDesign(regr_file):
+    # regression table of getRegrTable.py / getSingleRegTable.py: one row per
+    # repetition, the header line starts with '#' (skipped like fsl_regfilt does)
+    design = np.loadtxt(regr_file, comments='#', ndmin=2)
+    return design
+
+def readDesigns(txtregr_Path):
+    # regressors of all slices (slices x repetitions x regressors) from the
+    # binary table of getSingleRegTable.py, else from the text tables of the
+    # slices; None if there are none
+    designFiles = glob.glob(os.path.join(txtregr_Path, '*_regressors.npy'))
+    if len(designFiles) > 1:
+        sys.exit('Error: More than one regressor table in %s' % txtregr_Path)
+    if len(designFiles) == 1:
+        return np.load(designFiles[0])
+    regrTextFiles = findRegData(txtregr_Path)
+    if len(regrTextFiles) == 0:
+        return None
+    return [readDesign(regr) for regr in regrTextFiles]
+
+def regressSlice(data, design, columns):
+    # Non-aggressive nuisance regression of fsl_regfilt for one slice:
+    # data (x, y, t) and design (t, regressors) are demeaned over time, all
+    # voxels are fitted with the pseudo-inverse of the full design and only the
+    # fits of the (1-based) columns are subtracted. The temporal mean of every
+    # voxel stays unchanged.
+    design = design - design.mean(axis=0)
+    voxels = data.reshape(-1, data.shape[-1]).T.astype(np.float64)
+    cols = np.asarray(columns) - 1
+    betas = np.linalg.pinv(design)[cols] @ voxels
+    voxels -= design[:, cols] @ betas
+    return voxels.T.reshape(data.shape)
+
+def regressVolume(img, txtregr_Path, columns=(1,2,7,9,11,12,13), workers=None):
+    # Regressed 4D data (float32) of img, or None without regression tables:
+    # the slices are regressed with their own design (readDesigns)
+    # by workers threads (default: the thread budget OMP_NUM_THREADS of the
+    # batchProc.py job, else all cores).
+    designs = readDesigns(txtregr_Path)
+    if designs is None:
+        print('No regression with physio data!')
+        return None
+
+    data = np.asanyarray(img.dataobj)
+    if not len(designs) == data.shape[2]:
+        sys.exit('Error: Not enough slices in the regressors of %s' % txtregr_Path)
+
+    for slc, design in enumerate(designs):
+        if not design.shape[0] == data.shape[3] or design.shape[1] < max(columns):
+            sys.exit('Error: regressors of slice %i have %i x %i entries, expected %i repetitions and %i regressors.'
+                     % (slc, design.shape[0], design.shape[1], data.shape[3], max(columns)))
+
+    if workers is None:
+        workers = int(os.environ.get('OMP_NUM_THREADS', 0)) or os.cpu_count()
+
+    print('Start separate slice Regression ... ')
+    regrData = np.empty(data.shape, dtype=np.float32)
+
+    def regressOne(slc):
+        regrData[:, :, slc, :] = regressSlice(data[:, :, slc, :], designs[slc], columns)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(regressOne, range(data.shape[2])))
+    return regrData
+
+def regrSliceWise(input_file, txtregr_Path, regr_Path, columns=(1,2,7,9,11,12,13), workers=None):
+    # Same result as fsl_RegrSliceWise without splitting the volume into slice
+    # files: the 4D data are read once, regressed in memory (regressVolume)
+    # and written as a single float32 volume.
+    output_file = os.path.join(regr_Path,
+                               os.path.basename(input_file).split('.')[0]) + '_RGR.nii.gz'
+
+    img = nii.load(input_file)
+    regrData = regressVolume(img, txtregr_Path, columns, workers)
+    if regrData is None:
+        shutil.copyfile(input_file, output_file)
+        return output_file
+
+    saveImage(regrData, img, output_file)
+    return output_file
+
+def saveImage(data, img, output_file):
+    # data as float32 NIfTI with the geometry and header of img, as fslmaths writes it
+    outImg = nii.Nifti1Image(data, img.affine, header=img.header)
+    outImg.set_data_dtype(np.float32)
+    nii.save(outImg, output_file)
+    return output_file
+
+def fslPercentile(values, percent):
+    # percentile as fslstats -p: the value at index int(n * percent/100) of the sorted values
+    values = np.ravel(values)
+    if values.size == 0:
+        return 0.0
+    index = min(int(np.float32(values.size) * np.float32(percent / 100.0)), values.size - 1)
+    return float(np.partition(values, index)[index])
+
+def highpassFilter(data, sigma):
+    # Temporal high-pass filter of fslmaths -bptf sigma -1 (sigma in volumes),
+    # in place on the last axis of data: for every time point a straight line
+    # is fitted to the neighbourhood weighted with a Gaussian (cut at 3 sigma)
+    # and its value at that point is subtracted. Like FSL >= 5.0.7 the
+    # temporal mean is removed as well.
+    from scipy.ndimage import correlate1d
+
+    half = int(sigma * 3)
+    dt = np.arange(-half, half + 1)
+    weights = np.exp(-0.5 * dt ** 2 / sigma ** 2)
+    ones = np.ones(data.shape[-1])
+    N = correlate1d(ones, weights, mode='constant')
+    A = correlate1d(ones, weights * dt, mode='constant')
+    C = correlate1d(ones, weights * dt * dt, mode='constant')
+    denom = C * N - A * A
+    valid = denom != 0
+    denom[~valid] = 1
+
+    for slc in range(data.shape[2]):
+        voxels = data[:, :, slc, :].astype(np.float64)
+        B = correlate1d(voxels, weights, axis=-1, mode='constant')
+        D = correlate1d(voxels, weights * dt, axis=-1, mode='constant')
+        data[:, :, slc, :] = voxels - np.where(valid, (B * C - A * D) / denom, 0)
+    return data
+
+def fusedRegression(input_file, txtregr_Path, regr_Path, FWHM, cutOff_sec, TR, debug=False):
+    # Regression and the following steps of startRegression with the 4D data
+    # kept in memory: percentiles, masks, dilation, means, intensity
+    # normalisation and high-pass filter are computed with NumPy, only BET
+    # (on the 3D mean) and SUSAN still run in FSL. Written is the final
+    # _SFRGR volume; with debug also the intermediates of the FSL chain under
+    # their usual names. Returns (rgr_file, srgr_file, sfrgr_file), the first
+    # two are None without debug.
+    baseName = os.path.join(regr_Path, os.path.basename(input_file).split('.')[0])
+    img = nii.load(input_file)
+    data = regressVolume(img, txtregr_Path)
+    if data is None:
+        data = img.get_fdata(dtype=np.float32)
+
+    def intermediate(data, output_file):
+        if debug:
+            return saveImage(data, img, output_file)
+        return None
+
+    # brain mask of the mean
+    meanRegr_File = saveImage(data.mean(axis=3, dtype=np.float64), img, os.path.join(regr_Path, 'mean2.nii.gz'))
+    file_nameEPI_BET, mask_file = applyBET(meanRegr_File, frac=0.35, radius=45, vertical_gradient=0.1)
+    os.remove(meanRegr_File)
+    data *= (np.asanyarray(nii.load(mask_file).dataobj) > 0)[..., np.newaxis]
+    regr_File = intermediate(data, baseName + '_RGR.nii.gz')
+
+    # "robust intensity range" which calculates values similar to the 98% percentiles
+    upperp = fslPercentile(data, 98)
+
+    # get binary mask: voxels above 10 % of it over all time points
+    tmin = data.min(axis=3)
+    mask = (tmin >= upperp / 10) & (tmin > 0)
+    del tmin
+
+    # "robust intensity range" which calculates values similar to the 50% percentiles with mask
+    meanintensity = fslPercentile(data[mask], 50) * 0.75
+
+    # maxmium filter of mask
+    from scipy.ndimage import maximum_filter
+    mask = maximum_filter(mask, size=3, mode='constant')
+    if debug:
+        saveImage(mask.astype(np.uint8), img, os.path.join(regr_Path, 'mask.nii.gz'))
+
+    # apply mask on regrFile
+    data *= mask[..., np.newaxis]
+    mean_func = data.mean(axis=3, dtype=np.float64).astype(np.float32)
+    intermediate(data, baseName + '_RGRthres.nii.gz')
+    intermediate(mean_func, os.path.join(regr_Path, 'mean_func.nii.gz'))
+
+    # SUSAN on uncompressed temporary files with 10 times larger voxels
+    temp_dir = tempfile.mkdtemp(prefix='susan_')
+    try:
+        fslPath = os.path.join(temp_dir, 'thres.nii')
+        meanPath = os.path.join(temp_dir, 'mean_func.nii')
+        susanPath = os.path.join(temp_dir, 'SRGR.nii')
+        nii.save(scaledImage(nii.Nifti1Image(data, img.affine, header=img.header), 10), fslPath)
+        nii.save(scaledImage(nii.Nifti1Image(mean_func, img.affine, header=img.header), 10), meanPath)
+        del data
+        mySusan = fsl.SUSAN(in_file=fslPath, brightness_threshold=meanintensity, fwhm=FWHM, dimension=2,
+                            use_median=1, usans=[(meanPath, meanintensity), ], out_file=susanPath,
+                            output_type='NIFTI')
+        print(mySusan.cmdline)
+        mySusan.run()
+        data = nii.load(susanPath).get_fdata(dtype=np.float32)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    srgr_file = intermediate(data, baseName + '_SRGR.nii.gz')
+
+    # apply mask and multiply image with inscalefactor
+    data *= mask[..., np.newaxis]
+    intermediate(data, baseName + '_SRGR_smooth.nii.gz')
+    data *= np.float32(10000.0 / meanintensity)
+    intermediate(data, baseName + '_SRGR_smooth_intnorm.nii.gz')
+
+    # filter image cut-off frequency 0.01 Hz, the temporal mean is added back
+    tempMean = data.mean(axis=3, dtype=np.float64).astype(np.float32)
+    intermediate(tempMean, os.path.join(regr_Path, 'tempMean.nii.gz'))
+    highpassFilter(data, cutOff_sec / (2.0 * TR))
+    data += tempMean[..., np.newaxis]
+    sfrgr_file = saveImage(data, img, baseName + '_SFRGR.nii.gz')
+    if debug:
+        getThresMask(sfrgr_file)
+
+    return regr_File, srgr_file, sfrgr_file
+
 def getMask(input_file,threshold):
     threshold = threshold/10
     output_file = os.path.join(os.path.dirname(input_file), 'mask.nii.gz')
@@ -203,14 +390,16 @@ def filterFSL(input_file,highpass,tempMean):
     myHP = fsl.TemporalFilter(in_file = input_file,highpass_sigma=highpass, args='-add '+tempMean,out_file=outputSFRGR)
     print(myHP.cmdline)
     myHP.run()
-    input_file = outputSFRGR
+    getThresMask(outputSFRGR)
+    return outputSFRGR
+
+def getThresMask(input_file):
     output_file = os.path.join(os.path.dirname(input_file),  os.path.basename(input_file).split('.')[0])+'_thres_mask.nii.gz'
     #input_file = getMean(input_file,'HPmean')
     thres = fsl.Threshold(in_file=input_file, thresh=17, out_file=output_file, output_datatype='float',use_robust_range=True,args='-Tmean -bin')
     print(thres.cmdline)
     thres.run()
-
-    return outputSFRGR
+    return output_file
 
 
 def applyBET(input_file,frac,radius,vertical_gradient):
@@ -231,7 +420,9 @@ def applyBET(input_file,frac,radius,vertical_gradient):
     return output_file,maskFile
 
 
-def startRegression(input_File, FWHM, cutOff_sec, TR, stc, slice_order = None, costum_timings = None):
+def startRegression(input_File, FWHM, cutOff_sec, TR, stc, slice_order = None, costum_timings = None, fused = True, debug = False):
+    # fused: regression and the following steps in memory (fusedRegression),
+    # else as separate FSL calls on files. debug: keep the intermediates of the fused chain.
     # generate folder regr images
     
     origin_Path = os.path.dirname(os.path.dirname(input_File))
@@ -253,8 +444,14 @@ def startRegression(input_File, FWHM, cutOff_sec, TR, stc, slice_order = None, c
     # proof regression files
     txtregr_Path = os.path.join(origin_Path, 'txtRegrPython')
 
+    if fused:
+        regr_FileReal, srgr_file, filtered_image = fusedRegression(input_File5Sub, txtregr_Path, regr_Path,
+                                                                   FWHM, cutOff_sec, TR, debug)
+        print('Regression completed!')
+        return regr_FileReal, srgr_file, filtered_image
+
     # slive wise regression with physio data
-    regr_FileReal = fsl_RegrSliceWise(input_File5Sub, txtregr_Path, regr_Path)
+    regr_FileReal = regrSliceWise(input_File5Sub, txtregr_Path, regr_Path)
 
     # get mean
     meanRegr_File = getMean(regr_FileReal,'mean2')
@@ -17,97 +17,245 @@ Neuroimaging & Neuroengineering
 Department of Neurology
 University Hospital Cologne
 
-"""
+Batched MICO engine: all slices of a volume are processed as one stack.
+Images, ROI weights and bias fields are stored as (slices, voxels) arrays,
+memberships as (slices, classes, voxels). The basis functions and their
+pairwise products only depend on the slice geometry and are computed once,
+so the normal equations of the bias field reduce to a single matrix product
+per iteration.
 
+"""
 
 
 import numpy as np
+import concurrent.futures
 import sys
 
-def runMICO(Img,q,W,M,C,b,Bas,GGT,ImgG, Iter, iterCM):
+
+def getBasisOrder3(Height, Wide):
+    # Legendre polynomials up to order 3, each normalised to unit L2 norm
+    x = np.tile(np.linspace(-1, 1, Wide), (Height, 1))
+    y = np.tile(np.linspace(-1, 1, Height)[:, np.newaxis], (1, Wide))
+
+    bais = np.stack([np.ones([Height, Wide]),
+                     x,
+                     (3*x*x - 1)/2,
+                     (5*x*x*x - 3*x)/2,
+                     y,
+                     x*y,
+                     y*(3*x*x - 1)/2,
+                     (3*y*y - 1)/2,
+                     (3*y*y - 1)*x/2,
+                     (5*y*y*y - 3*y)/2], axis=2)
+
+    r = np.sqrt(np.sum(bais**2, axis=(0, 1)))
+    return bais / r
+
+
+def getBasisProducts(Bas):
+    # Bas: (voxels, N_bas) -> products of all basis pairs ii <= jj,
+    # (voxels, N_bas*(N_bas+1)/2). This replaces the former per slice GGT tensor.
+    ii, jj = np.triu_indices(Bas.shape[1])
+    return Bas[:, ii] * Bas[:, jj]
+
+
+def rowProduct(X, Y):
+    # Row-wise product X[s] @ Y of a stack of vectors X (slices, n) with a
+    # shared matrix Y (n, m). Every slice is reduced on its own, so results do
+    # not depend on how many slices are stacked together.
+    return np.matmul(X[:, np.newaxis, :], Y)[:, 0, :]
 
 
-    D = np.zeros(M.shape)
+def runMICO(Img, q, W, M, C, b, Bas, BasBas, Iter, iterCM):
+
     for n in range(Iter):
         C = updateC(Img, W, b, M)
-        for k in range (iterCM):
-            N_class = M.shape[2]
-            e = np.zeros(M.shape)
-            for kk in range(N_class):
-                D[:,:, kk] = (Img - C[kk] * b)** 2
-
+        for k in range(iterCM):
+            D = (Img[:, np.newaxis, :] - C[:, :, np.newaxis] * b[:, np.newaxis, :]) ** 2
             M = updateM(D, q)
 
-    b_out = updateB(Img, q, C, M, Bas, GGT, ImgG)
+    b_out = updateB(Img, q, C, M, W, Bas, BasBas)
     M_out = M
     C_out = C
 
-
     return M_out, b_out, C_out
 
-def updateB(Img, q, C, M, Bas,GGT,ImgG):
-    PC2 = np.zeros(Img.shape)
-    PC = PC2
-
-    N_class = M.shape[2]
-    for kk in range(N_class):
-        PC2 = PC2 + C[kk] ** 2 * M[:,:, kk]** q
-        PC = PC + C[kk] * M[:,:, kk]** q
-    N_bas = Bas.shape[2]
-    V = np.zeros(N_bas)
-    A = np.zeros([N_bas,N_bas])
-    for ii in range(N_bas):
-        ImgG_PC = ImgG[:,:,ii] * PC # Mask in ImgG
-        V[ii] = np.sum(ImgG_PC) # inner product
-        for jj in range(N_bas):
-            B = GGT[:,:,ii, jj] * PC2 # Mask in GGT
-            A[ii, jj] = np.sum(B) # inner product
-            A[jj, ii] = A[ii, jj]
-
-    w = np.dot(np.linalg.inv(A) , V)
-    b = np.zeros(Img.shape)
-    for kk in range (N_bas):
-        b = b + np.dot(w[kk] , Bas[:,:, kk])
 
-    return b
+def updateB(Img, q, C, M, W, Bas, BasBas):
+    Mq = M if q == 1 else M ** q
+    PC2 = np.einsum('sk,skv->sv', C ** 2, Mq) * W
+    PC = np.einsum('sk,skv->sv', C, Mq) * W
 
+    N_bas = Bas.shape[1]
+    V = rowProduct(Img * PC, Bas)  # inner products with the masked basis
+    A = np.zeros([Img.shape[0], N_bas, N_bas])
+    ii, jj = np.triu_indices(N_bas)
+    A[:, ii, jj] = rowProduct(PC2, BasBas)
+    A[:, jj, ii] = A[:, ii, jj]
 
+    try:
+        # numerical stable: solves Ax = V for all slices at once
+        w = np.linalg.solve(A, V[:, :, np.newaxis])[:, :, 0]
+    except np.linalg.LinAlgError:
+        # Fallback if A is rank deficient / singular for at least one slice
+        w = np.zeros(V.shape)
+        for s in range(A.shape[0]):
+            try:
+                w[s] = np.linalg.solve(A[s], V[s])
+            except np.linalg.LinAlgError:
+                print("Warning: A is singular, uses pseudoinverse in updateB")
+                w[s] = np.dot(np.linalg.pinv(A[s]), V[s])
 
+    b = rowProduct(w, Bas.T)
 
+    return b
 
-def updateC(Img, W,b, M):
-    N_class=M.shape[2]
-    C_new = np.zeros(N_class)
-    for nn in range (N_class):
-        N=b*Img*M[:,:,nn]
-        D=(b**2) *M[:,:,nn]
-        sN = np.sum(N*W)    # inner product
-        sD = np.sum(D*W)   # inner product
-        C_new[nn]=sN/(sD+(sD==0))
 
-    return  C_new
+def updateC(Img, W, b, M):
+    N = (b * Img * W)[:, np.newaxis, :] * M
+    D = ((b ** 2) * W)[:, np.newaxis, :] * M
+    sN = np.sum(N, axis=2)  # inner product
+    sD = np.sum(D, axis=2)  # inner product
+    C_new = sN / (sD + (sD == 0))
+
+    return C_new
+
 
 def updateM(e, q):
 
-    M = np.zeros(e.shape)
-    N_class= e.shape[2]
-    if q >1:
-        epsilon=0.000000000001
-        e=e+epsilon  # avoid division by zero
+    N_class = e.shape[1]
+    if q > 1:
+        epsilon = 0.000000000001
+        e = e + epsilon  # avoid division by zero
         p = 1/(q-1)
         f = 1/(e**p)
-        f_sum = np.sum(f,2)
-        for kk in range(N_class):
-            M[:,:,kk] = f[:,:,kk]/f_sum
+        f_sum = np.sum(f, 1)
+        M = f / f_sum[:, np.newaxis, :]
 
-    elif q==1:
-        e_min = np.amin(e,2)
-        N_min = np.argmin(e,2)
-        for kk in range (N_class):
-            tempComp = (N_min == kk)
-            M[:,:,kk] = tempComp
+    elif q == 1:
+        N_min = np.argmin(e, 1)
+        M = (N_min[:, np.newaxis, :] == np.arange(N_class)[:, np.newaxis]).astype(float)
 
     else:
         sys.exit('Error: MICO: wrong fuzzifizer')
 
-    return M
\ No newline at end of file
+    return M
+
+
+def initMembership(seeds, n, N_class=3, N_region=1):
+    # random start of class constants and memberships from a fixed seed per
+    # slice; only the first N_region classes are normalised, as in the
+    # original slice wise implementation
+    C = np.zeros([len(seeds), N_class])
+    M = np.zeros([len(seeds), N_class, n])
+    for s, seed in enumerate(seeds):
+        rng = np.random.RandomState(seed)
+        C[s] = rng.rand(N_class)
+        M[s] = rng.rand(N_class, n)
+    a = np.sum(M, 1)
+    for k in range(N_region):
+        M[:, k, :] = M[:, k, :] / a
+
+    return M, C
+
+
+def getEnergy(Img, b, C, M, W, q):
+    # MICO energy of every slice, (slices,)
+    Mq = M if q == 1 else M ** q
+    D = (Img[:, np.newaxis, :] - C[:, :, np.newaxis] * b[:, np.newaxis, :]) ** 2
+    return np.sum(np.sum(D * Mq, axis=1) * W, axis=1)
+
+
+def estimateBias(Img, W, iterNum, q, N_class, N_region, seeds, nrow, ncol, tol=0, b=None, M=None):
+    # Img, W: (slices, voxels); runs in worker processes as well.
+    # Slices stop individually once the relative change of their energy drops
+    # below tol (tol=0: always iterNum - 1 iterations). b and M may be given
+    # to warm start from a neighbouring slice.
+    nSlices = Img.shape[0]
+    n = nrow * ncol
+    Bas = getBasisOrder3(nrow, ncol).reshape(n, -1)
+    BasBas = getBasisProducts(Bas)
+
+    M_init, C = initMembership(seeds, n, N_class, N_region)
+    if M is None:
+        M = M_init
+    if b is None:
+        b = np.ones(Img.shape)
+
+    iterations = np.zeros(nSlices, dtype=int)
+    active = np.arange(nSlices)
+    energy = getEnergy(Img, b, C, M, W, q)
+
+    for it in range(1, iterNum):
+        if active.size == nSlices:
+            M, b, C = runMICO(Img, q, W, M, C, b, Bas, BasBas, 1, 1)
+        else:
+            M[active], b[active], C[active] = runMICO(Img[active], q, W[active], M[active], C[active],
+                                                      b[active], Bas, BasBas, 1, 1)
+        iterations[active] += 1
+
+        if tol > 0:
+            energy_new = getEnergy(Img[active], b[active], C[active], M[active], W[active], q)
+            change = np.abs(energy[active] - energy_new) / np.maximum(energy[active], np.finfo(float).tiny)
+            energy[active] = energy_new
+            active = active[change > tol]
+            if active.size == 0:
+                break
+
+    return b, M, iterations
+
+
+def biasField(Img, ROI, iterNum, q=1, N_class=3, N_region=1, seed=0, workers=1, tol=0, warmStart=False,
+              callback=None):
+    """Estimate the bias field of a stack of slices.
+
+    Img and ROI are (slices, nrow, ncol) arrays. Returns the bias field with
+    the same shape and the number of iterations used per slice. Slice idx is
+    initialised from the seed seed + idx, so the result is reproducible and
+    does not depend on the number of workers. With workers > 1 the slices are
+    distributed over a process pool. A slice stops iterating once the
+    relative change of its energy is below tol, after iterNum - 1 iterations
+    at the latest. With warmStart the slices are processed one after another
+    and each slice starts from the memberships and bias field of the previous
+    one (workers is ignored). callback is called with the number of finished
+    slices, e.g. to advance a progress bar.
+    """
+    nSlices, nrow, ncol = Img.shape
+    n = nrow * ncol
+
+    Img = Img.reshape(nSlices, n)
+    W = ROI.reshape(nSlices, n).astype(float)
+    seeds = seed + np.arange(nSlices)
+    b = np.ones([nSlices, n])
+    iterations = np.zeros(nSlices, dtype=int)
+
+    if warmStart:
+        b_prev, M_prev = None, None
+        for idx in range(nSlices):
+            b[idx:idx + 1], M, iterations[idx:idx + 1] = estimateBias(Img[idx:idx + 1], W[idx:idx + 1], iterNum, q,
+                                                                      N_class, N_region, seeds[idx:idx + 1],
+                                                                      nrow, ncol, tol, b_prev, M_prev)
+            # only slices with a ROI give a usable start for their neighbour
+            if np.any(W[idx]):
+                b_prev, M_prev = b[idx:idx + 1].copy(), M
+            else:
+                b_prev, M_prev = None, None
+            if callback is not None:
+                callback(1)
+    elif workers > 1 and nSlices > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(estimateBias, Img[idx:idx + 1], W[idx:idx + 1], iterNum, q,
+                                       N_class, N_region, seeds[idx:idx + 1], nrow, ncol, tol): idx
+                       for idx in range(nSlices)}
+            for future in concurrent.futures.as_completed(futures):
+                idx = futures[future]
+                b_idx, M, iterations_idx = future.result()
+                b[idx], iterations[idx] = b_idx[0], iterations_idx[0]
+                if callback is not None:
+                    callback(1)
+    else:
+        b, M, iterations = estimateBias(Img, W, iterNum, q, N_class, N_region, seeds, nrow, ncol, tol)
+        if callback is not None:
+            callback(nSlices)
+
+    return b.reshape(nSlices, nrow, ncol), iterations
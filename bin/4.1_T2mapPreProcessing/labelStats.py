@@ -0,0 +1,51 @@
+"""
+Region statistics of an image for all labels of an atlas in one pass.
+Instead of masking the image once per label (and slice), the voxels are
+grouped by their label with np.bincount and a single sort, so the cost does
+not grow with the number of atlas regions.
+
+"""
+
+import numpy as np
+
+
+def labelStats(img, rois, perSlice=False):
+    """Count, mean, std, min, max and median of img for every label > 0 of rois.
+
+    img and rois must have the same shape. Returns a dict of arrays with one
+    entry per label, sorted by label: 'label', 'count', 'mean', 'std'
+    (population), 'min', 'max' and 'median'. With perSlice the statistics are
+    computed per label within every slice of the last axis; the rows are
+    then sorted by slice and label and 'slice' holds the slice index.
+    """
+    img = np.asarray(img)
+    rois = np.asarray(rois)
+    if img.shape != rois.shape:
+        raise ValueError("image and atlas differ in shape: %s vs. %s" % (img.shape, rois.shape))
+
+    voxels = np.flatnonzero(rois > 0)
+    labels, key = np.unique(rois.ravel()[voxels], return_inverse=True)
+    values = img.ravel()[voxels].astype(float)
+    if perSlice:
+        slices = np.unravel_index(voxels, rois.shape)[-1]
+        groups, key = np.unique(slices * len(labels) + key, return_inverse=True)
+        label_idx = groups % len(labels)
+    else:
+        groups = np.arange(len(labels))
+        label_idx = groups
+
+    count = np.bincount(key, minlength=len(groups))
+    mean = np.bincount(key, values, minlength=len(groups)) / count
+    std = np.sqrt(np.bincount(key, (values - mean[key]) ** 2, minlength=len(groups)) / count)
+
+    # sorted by group, then by value: min, max and median are positions in each group
+    order = np.lexsort((values, key))
+    sorted_values = values[order]
+    start = np.cumsum(count) - count
+    median = (sorted_values[start + (count - 1) // 2] + sorted_values[start + count // 2]) / 2
+
+    stats = {"label": labels[label_idx], "count": count, "mean": mean, "std": std,
+             "min": sorted_values[start], "max": sorted_values[start + count - 1], "median": median}
+    if perSlice:
+        stats["slice"] = groups // len(labels)
+    return stats
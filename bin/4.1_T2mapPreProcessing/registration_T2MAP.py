@@ -112,7 +112,7 @@ def find_relatedData(pathBase):
 
 
 
-if __name__ == "__main__":
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser(description='Registration Allen Brain to T2map')
@@ -129,7 +129,7 @@ if __name__ == "__main__":
     parser.add_argument('-a', '--anno_rsfMRI', help='Parental Annotations atlas for rsfMRI/T2map', nargs='?', type=str,
                         default=os.path.abspath(os.path.join(os.getcwd(), os.pardir,os.pardir))+'/lib/annoVolume.nii.gz')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     stroke_mask = None
     inputVolume = None
@@ -229,4 +229,5 @@ if __name__ == "__main__":
     print("Registration completed")
 
 
-
+if __name__ == "__main__":
+    main()
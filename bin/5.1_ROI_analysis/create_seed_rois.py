@@ -91,7 +91,7 @@ def create_rois_3(iatlas, labels, labels_hdr, labels_data, datatype=None, preser
     else:
         labels_dtype = labels_hdr[0].get_data_dtype()
     labels_shape = labels_hdr[0].get_data_shape()
-    mask = np.zeros(labels_shape, dtype=np.bool)
+    mask = np.zeros(labels_shape, dtype=bool)
     rois = np.zeros(labels_shape + (len(iatlas),), dtype=labels_dtype)
     if preserve:
         for k, index in enumerate(iatlas):
@@ -110,7 +110,73 @@ def create_rois_3(iatlas, labels, labels_hdr, labels_data, datatype=None, preser
 
     return rois
 
-def create_rois(path_labels, list_atlas, datatype=None, preserve=False):
+def rois_dtype(labels_hdr, datatype=None, preserve=False):
+    # data type of the ROIs: the chosen NIfTI datatype, else the atlas data
+    # type for preserved label values and uint8 for binary ROIs
+    if datatype == 2:
+        return np.uint8
+    elif datatype == 4:
+        return np.int16
+    elif datatype == 8:
+        return np.int32
+    elif datatype == 16:
+        return np.float32
+    elif preserve:
+        return labels_hdr[0].get_data_dtype()
+    return np.uint8
+
+def rois_operator(iatlas, labels, labels_data, preserve=False):
+    # Sparse ROI x voxel matrix (voxels in Fortran order, like
+    # fsl_mean_ts.roi_operator) with 1 or, with preserve, the label value for
+    # every voxel of a ROI. Each atlas is looked up once: np.searchsorted finds
+    # every voxel value in the sorted labels of its ROIs, instead of comparing
+    # the whole volume with every label. labels[k] is a label or a list of labels.
+    from scipy import sparse
+    nvoxels = np.asarray(labels_data[0]).size
+    operator = sparse.csr_matrix((len(iatlas), nvoxels))
+    for index in sorted(set(iatlas)):
+        # distinct (ROI, label) pairs of this atlas
+        pairs = np.unique([(k, label) for k in range(len(iatlas)) if iatlas[k] == index
+                           for label in np.atleast_1d(labels[k])], axis=0)
+        unique_labels, inverse = np.unique(pairs[:, 1], return_inverse=True)
+
+        atlas = np.asarray(labels_data[index-1]).ravel(order='F')
+        lut = np.minimum(np.searchsorted(unique_labels, atlas), len(unique_labels) - 1)
+        voxels = np.flatnonzero(unique_labels[lut] == atlas)
+        values = atlas[voxels] if preserve else np.ones(len(voxels))
+        by_label = sparse.csr_matrix((values, (lut[voxels], voxels)), shape=(len(unique_labels), nvoxels))
+        to_roi = sparse.csr_matrix((np.ones(len(pairs)), (pairs[:, 0], inverse.ravel())),
+                                   shape=(len(iatlas), len(unique_labels)))
+        operator = operator + to_roi @ by_label
+    return operator
+
+def create_rois_lut(iatlas, labels, labels_hdr, labels_data, datatype=None, preserve=False, output='stack'):
+    # ROIs of all labels in one lookup per atlas (rois_operator), written
+    # directly into the output:
+    # 'stack': 4D hyperstack as create_rois_1, binary ROIs as uint8 unless datatype is given
+    # 'sparse': the ROI x voxel matrix of rois_operator
+    # 'labels': 3D image with the ROI number (1, 2, ...) of every voxel, the ROIs must not overlap
+    labels_shape = labels_hdr[0].get_data_shape()
+    operator = rois_operator(iatlas, labels, labels_data, preserve=preserve and output != 'labels')
+    if output == 'sparse':
+        return operator
+
+    coo = operator.tocoo()
+    indices = np.unravel_index(coo.col, labels_shape, order='F')
+    if output == 'labels':
+        if len(coo.col) > 0 and np.bincount(coo.col).max() > 1:
+            sys.exit("Error: ROIs overlap, they cannot be stored as one 3D labels image.")
+        rois = np.zeros(labels_shape, dtype=np.min_scalar_type(len(iatlas)))
+        rois[indices] = coo.row + 1
+        return rois
+    if output != 'stack':
+        sys.exit("Error: Unknown output '%s' (stack, sparse or labels)." % (output,))
+
+    rois = np.zeros(labels_shape + (len(iatlas),), dtype=rois_dtype(labels_hdr, datatype, preserve))
+    rois[indices + (coo.row,)] = coo.data
+    return rois
+
+def create_rois(path_labels, list_atlas, datatype=None, preserve=False, output='stack'):
     # read labels text file
     iatlas, labels = pt.read_labels(path_labels)
 
@@ -122,10 +188,10 @@ def create_rois(path_labels, list_atlas, datatype=None, preserve=False):
     for k, path_atlas in enumerate(list_atlas):
         #print("Atlas%d:" % (k + 1,), path_atlas)
         labels_img.append(nib.load(path_atlas))
-        labels_data.append(labels_img[k].get_data())
+        labels_data.append(np.asanyarray(labels_img[k].dataobj))
         #print("labels_data[%d].dtype:" % (k,), labels_data[k].dtype)
         #print("labels_data[%d].shape:" % (k,), labels_data[k].shape)
-        labels_hdr.append(labels_img[k].get_header())
+        labels_hdr.append(labels_img[k].header)
         labels_shape.append(labels_hdr[k].get_data_shape())
         #print("labels_shape[%d]:" % (k,), labels_shape[k])
         if len(labels_shape[k]) != 3:
@@ -136,7 +202,7 @@ def create_rois(path_labels, list_atlas, datatype=None, preserve=False):
             sys.exit("Error: Atlas1 labels %s and Atlas%d labels %s don't have the same shape." % (str(labels_shape[0]), k, str(labels_shape[k])))
 
     # create atlas labels hyperstack (4D)
-    rois = create_rois_1(iatlas, labels, labels_hdr, labels_data, datatype=datatype, preserve=preserve)
+    rois = create_rois_lut(iatlas, labels, labels_hdr, labels_data, datatype=datatype, preserve=preserve, output=output)
 
     return (labels_hdr, rois)
 
@@ -149,6 +215,7 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--out_rois', help='output 4D seed ROIs file name')
     parser.add_argument('-p', '--preserve', action='store_true', help='preserve label values')
     parser.add_argument('-t', '--datatype', type=int, choices=[2, 4, 8, 16], help='data type (2: char, 4: short, 8: int, 16: float)')
+    parser.add_argument('-s', '--output', default='stack', choices=['stack', 'labels'], help='4D hyperstack or 3D image of ROI numbers (not overlapping ROIs)')
     args = parser.parse_args()
 
     ext_text = '.txt'
@@ -174,7 +241,7 @@ if __name__ == '__main__':
     #print(pt.get_date())
 
     # create atlas labels hyperstack (4D)
-    labels_hdr, rois = create_rois(path_labels, path_atlas, datatype=args.datatype, preserve=args.preserve)
+    labels_hdr, rois = create_rois(path_labels, list_atlas, datatype=args.datatype, preserve=args.preserve, output=args.output)
 
     # save atlas labels file
     voxel_dims = labels_hdr[0].get_zooms()
@@ -21,6 +21,15 @@ import scipy.io as sio
 
 import proc_tools as pt
 
+def roi_operator(mask):
+    # Sparse region x voxel matrix with a 1 for every voxel of a region (one
+    # volume per region in the 4D mask), voxels numbered in Fortran order like
+    # nibabel arranges the data in memory
+    from scipy import sparse
+    mask = np.asarray(mask)
+    voxels, regions = np.nonzero(mask.reshape(-1, mask.shape[3], order='F') > 0)
+    return sparse.csr_matrix((np.ones(len(voxels)), (regions, voxels)), shape=(mask.shape[3], mask[..., 0].size))
+
 def mean_ts(path_data, path_mask, path_out, label_names):
     # Read 4D data file (NIfTI)
     data, _ = pt.read_data(path_data)
@@ -40,11 +49,12 @@ def mean_ts(path_data, path_mask, path_out, label_names):
     #path_out_mat = path_out + '.mat'
     path_out_mat = os.path.join(os.path.dirname(path_out), os.path.basename(path_out) + '.mat')
 
+    # mean time series of all regions in one sparse product over the voxels
+    operator = roi_operator(mask)
+    counts = np.asarray(operator.sum(axis=1)).ravel()
+    sums = operator @ np.asarray(data).reshape(-1, data.shape[3], order='F')
     m = np.zeros((mask.shape[3], data.shape[3]), dtype=data.dtype)
-    for k in zrange(mask.shape[3]):
-        msk = np.array(mask[:, :, :, k]) > 0
-        if data[msk, :].size > 0:
-            m[k] = np.mean(data[msk, :], 0)
+    m[counts > 0] = sums[counts > 0] / counts[counts > 0, np.newaxis]
 
     mT = np.transpose(m)
 
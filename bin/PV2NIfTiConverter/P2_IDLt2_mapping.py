@@ -8,14 +8,14 @@ University Hospital Cologne
 
 """
 import os
-from math import *
-from lmfit import  Minimizer, Parameters
+import sys
+import functools
+import concurrent.futures
 import matplotlib.pyplot as plt
 import nibabel as nii
 import numpy as np
-import progressbar
 
-from .ReferenceMethods import brummerSNR
+from .ReferenceMethods import brummerSNR, changSNR, sijbersSNR
 
 
 
@@ -67,163 +67,343 @@ def t2_monoexp2(params, t, data):
     return model - data
 
 ###############################################################################
-# t2_fitmonoexp1
+# t2_initial
 #
-# Perform the data fitting using a mono-exponential model:
-# S = Y0 + (S0 * EXP(-TE / T2))
+# Closed-form start values of all voxels at once: weighted log-linear fit
+# log(S) = log(S0) - TE / T2 with the weights S^2 (the squared signal
+# compensates the noise amplification of the logarithm). T2 is kept inside
+# the bounds.
+# T2_3p: the offset biases the log-linear fit, the start values are the
+# best of a T2 grid instead, with S0 and Y0 solved linearly for every T2.
 ###############################################################################
 
+def t2_initial(y, te, model, uplim):
+    if 'T2_3p' in model:
+        grid = np.geomspace(uplim * 1e-2, uplim * (1 - 1e-3), 48)
+        # least squares coefficients of the basis [EXP(-TE / T2), 1] for
+        # every grid T2 from the projections of y on the basis
+        e = np.exp(-te / grid[:, np.newaxis])
+        ye = y @ e.T
+        sy = y.sum(axis=1)[:, np.newaxis]
+        ee = np.square(e).sum(axis=1)
+        se = e.sum(axis=1)
+        det = ee * len(te) - se * se
+        S0 = (ye * len(te) - se * sy) / det
+        Y0 = (ee * sy - se * ye) / det
+        # residual sum of squares up to the constant |y|^2
+        best = np.argmin(-(S0 * ye + Y0 * sy), axis=1)
+        rows = np.arange(len(y))
+        return np.stack([grid[best], S0[rows, best], Y0[rows, best]], axis=1)
+    w = np.square(np.maximum(y, 0))
+    logy = np.log(np.maximum(y, 1e-6))
+    sw = w.sum(axis=1)
+    st = w @ te
+    stt = w @ np.square(te)
+    sl = (w * logy).sum(axis=1)
+    stl = (w * logy * te).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = sw * stt - st * st
+        slope = (sw * stl - st * sl) / det
+        intercept = (sl - slope * st) / sw
+        T2 = -1 / slope
+    T2 = np.where(np.isfinite(T2) & (T2 > 0), T2, uplim / 2)
+    T2 = np.clip(T2, uplim * 1e-3, uplim * (1 - 1e-3))
+    S0 = np.where(np.isfinite(intercept), np.exp(np.clip(intercept, -700, 700)), y[:, 0])
+    return np.stack([T2, S0], axis=1)
 
-#def t2_fitmonoexp1 (T2, S0, Y0, T2bn, T2pe, img, snr, snrlim, nx, ny, slc, te, start, pinfo, FIXOFFSE):
-#(slice, echoTime, model, curSnrMap, snrLim, slc)
-def t2_fitmonoexp1(slice,te,snrMap,snrLim, model,uplim):
+###############################################################################
+# t2_fit
+#
+# Least squares fit of the mono-exponential models of all voxels (rows of y)
+# at once:
+# T2_2p: S = S0 * EXP(-TE / T2)
+# T2_3p: S = S0 * EXP(-TE / T2) + Y0
+# Levenberg-Marquardt refinement of the t2_initial values as whole arrays,
+# T2 is projected into the bounds [0, uplim] and stays on a bound it reaches
+# with an improving step. Voxels are dropped from the iteration once their
+# cost or parameters change by less than tol (relative, the default of
+# MINPACK's leastsq behind lmfit).
+# Returns the parameters (voxels x [T2, S0(, Y0)]).
+###############################################################################
 
-    dims = slice.shape
-    nx = dims[1]
-    ny = dims[0]
+def t2_fit(y, te, model, uplim, max_iter=100, tol=1.5e-8):
+    y = np.asarray(y, dtype=np.float64)
+    te = np.asarray(te, dtype=np.float64)
+    params = t2_initial(y, te, model, uplim)
+    if len(y) == 0:
+        return params
+
+    def residual(p, yv):
+        decay = np.exp(-te / p[:, 0, np.newaxis])
+        f = p[:, 1, np.newaxis] * decay
+        if p.shape[1] == 3:
+            f = f + p[:, 2, np.newaxis]
+        return f - yv, decay
+
+    def jacobian(p, decay):
+        J = np.empty(decay.shape + (p.shape[1],))
+        J[:, :, 0] = p[:, 1, np.newaxis] * decay * te / np.square(p[:, 0, np.newaxis])
+        J[:, :, 1] = decay
+        if p.shape[1] == 3:
+            J[:, :, 2] = 1
+        return J
+
+    nparams = params.shape[1]
+    lam = np.full(len(y), 1e-3)
+    r, decay = residual(params, y)
+    cost = np.square(r).sum(axis=1)
+    active = np.flatnonzero(np.isfinite(cost))
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        p = params[active]
+        J = jacobian(p, decay[active])
+        JT = J.transpose(0, 2, 1)
+        JTJ = JT @ J
+        g = (JT @ r[active][:, :, np.newaxis])[:, :, 0]
+        damped = JTJ + lam[active, np.newaxis, np.newaxis] * (JTJ * np.eye(nparams) + 1e-12 * np.eye(nparams))
+        try:
+            step = np.linalg.solve(damped, -g[:, :, np.newaxis])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = (np.linalg.pinv(damped) @ -g[:, :, np.newaxis])[:, :, 0]
+        new_p = p + step
+        new_p[:, 0] = np.clip(new_p[:, 0], uplim * 1e-6, uplim)
+        # the fit leaves the bounds: T2 stays on the bound (S0 and Y0 follow below)
+        on_bound = new_p[:, 0] != p[:, 0] + step[:, 0]
+        step = new_p - p
+        new_r, new_decay = residual(new_p, y[active])
+        new_cost = np.square(new_r).sum(axis=1)
+
+        better = new_cost < cost[active]
+        done = ~better & (lam[active] > 1e10)
+        improved = active[better]
+        done[better] = (((cost[improved] - new_cost[better]) <= tol * cost[improved]) | on_bound[better] |
+                        (np.linalg.norm(step[better], axis=1) <= tol * (np.linalg.norm(p[better], axis=1) + tol)))
+        params[improved] = new_p[better]
+        r[improved] = new_r[better]
+        decay[improved] = new_decay[better]
+        cost[improved] = new_cost[better]
+        lam[active] = np.where(better, lam[active] / 10, lam[active] * 10)
+        active = active[~done]
+
+    # S0 (and Y0) are linear: solved exactly for the final T2, which also
+    # settles voxels that end up on a T2 bound
+    e = np.exp(-te / params[:, 0, np.newaxis])
+    ee = np.square(e).sum(axis=1)
+    ye = (y * e).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if params.shape[1] == 3:
+            se = e.sum(axis=1)
+            sy = y.sum(axis=1)
+            det = ee * len(te) - se * se
+            S0 = (ye * len(te) - se * sy) / det
+            Y0 = (ee * sy - se * ye) / det
+            solved = np.isfinite(S0) & np.isfinite(Y0) & (np.abs(det) > 1e-12 * ee * len(te))
+            params[solved, 1] = S0[solved]
+            params[solved, 2] = Y0[solved]
+        else:
+            S0 = ye / ee
+            solved = np.isfinite(S0)
+            params[solved, 1] = S0[solved]
+    return params
 
-    T2 = np.zeros([nx,ny],dtype='int8') #Temporary store T2 map
-    S0 = np.zeros([nx,ny],dtype='int8') #Temporary store S0 map
+###############################################################################
+# t2_dictionary
+#
+# Decay curves EXP(-TE / T2) for the echo times te on a T2 grid (step,
+# 2 * step, ... uplim), normalised to unit length for the matching. With
+# offset (T2_3p) the curves are centred, the offset Y0 is free. Cached per
+# echo-time set: all scans of a protocol share one dictionary.
+# Returns (T2 grid, curves, normalised curves, normalised curves as float32).
+###############################################################################
 
+@functools.lru_cache(maxsize=16)
+def t2_dictionary(te, offset, uplim, step):
+    grid = np.arange(1, int(round(uplim / step)) + 1) * step
+    curves = np.exp(-np.asarray(te) / grid[:, np.newaxis])
+    if offset:
+        curves = curves - curves.mean(axis=1, keepdims=True)
+    atoms = curves / np.linalg.norm(curves, axis=1, keepdims=True)
+    return grid, curves, atoms, atoms.astype(np.float32)
+
+###############################################################################
+# t2_match
+#
+# Dictionary matching of all voxels (rows of y) as an alternative to t2_fit:
+# the T2 of every voxel is the grid T2 of the curve with the largest inner
+# product, S0 (and Y0) follow by linear least squares, i.e. the least
+# squares fit on the T2 grid with S0 > 0. The products are computed in one
+# float32 matmul per block of voxels and those of the window grid T2s around
+# the best one again in float64. The cost per voxel is constant.
+# Returns the parameters (voxels x [T2, S0(, Y0)]).
+###############################################################################
+
+def t2_match(y, te, model, uplim, step=0.05, block_size=4096, window=8):
+    y = np.asarray(y, dtype=np.float64)
+    offset = 'T2_3p' in model
+    grid, curves, atoms, atoms32 = t2_dictionary(tuple(float(t) for t in te), offset, float(uplim), step)
+    neighbours = np.arange(-window, window + 1)
+    params = np.zeros((len(y), 3 if offset else 2))
+    for start in range(0, len(y), block_size):
+        yb = y[start:start + block_size]
+        if offset:
+            yb = yb - yb.mean(axis=1, keepdims=True)
+        best = np.argmax(yb.astype(np.float32) @ atoms32.T, axis=1)
+        candidates = np.clip(best[:, np.newaxis] + neighbours, 0, len(grid) - 1)
+        scores = np.einsum('nm,nkm->nk', yb, atoms[candidates])
+        best = candidates[np.arange(len(yb)), np.argmax(scores, axis=1)]
+        params[start:start + block_size, 0] = grid[best]
+        params[start:start + block_size, 1] = (yb * curves[best]).sum(axis=1) / np.square(curves[best]).sum(axis=1)
+    if offset:
+        # the mean of the centred curves is 0: Y0 = mean(y) - S0 * mean(EXP(-TE / T2))
+        decay = np.exp(-np.asarray(te) / params[:, 0, np.newaxis])
+        params[:, 2] = y.mean(axis=1) - params[:, 1] * decay.mean(axis=1)
+    return params
+
+###############################################################################
+# t2_estimate
+#
+# T2, S0 (and Y0) of all voxels (rows of y) with the chosen method:
+# 'fit' (t2_fit) or 'dictionary' (t2_match)
+###############################################################################
+
+def t2_estimate(y, te, model, uplim, method='fit'):
+    if method == 'fit':
+        return t2_fit(y, te, model, uplim)
+    elif method == 'dictionary':
+        return t2_match(y, te, model, uplim)
+    sys.exit("Error: No valid T2 method.")
+
+###############################################################################
+# t2_fitmonoexp1
+#
+# Perform the data fitting of one slice using a mono-exponential model
+# (T2_2p): S = S0 * EXP(-TE / T2)
+# for all voxels with a mean SNR of at least snrLim (method: see t2_estimate).
+###############################################################################
+
+def t2_fitmonoexp1(slice,te,snrMap,snrLim, model,uplim, method='fit'):
+
+    T2 = np.zeros(slice.shape[:2]) #Temporary store T2 map
+    S0 = np.zeros(slice.shape[:2]) #Temporary store S0 map
 
     # // FITTING PROCEDURE //
-    #bar = progressbar.ProgressBar()
-    for i in range(nx):
-        for j in range(ny):
-            y = slice[i][j][:]
-            if np.mean(snrMap[i, j]) >= snrLim:
-                result=mpfitfun(y, te, model,uplim)
-                T2[i, j] = result['T2'].value
-                S0[i, j] = result['S0'].value
-        #bar.update(i)
+    fitMask = np.mean(snrMap, axis=2) >= snrLim
+    result = np.nan_to_num(t2_estimate(slice[fitMask], te, model, uplim, method))
+    T2[fitMask] = result[:, 0]
+    S0[fitMask] = result[:, 1]
     allResult = {'T2': T2, 'S0': S0, 'SNR': snrMap}
-    #plt.imshow(T2, cmap='gray')
     return allResult
 
 ###############################################################################
 # t2_fitmonoexp2
 #
-# Perform the data fitting using a mono-exponential model:
-# S = S0 * EXP(-TE / T2)
-#------------------------------------------------------------------------------
+# Perform the data fitting of one slice using a mono-exponential model
+# with offset (T2_3p): S = Y0 + (S0 * EXP(-TE / T2))
+# for all voxels with a mean SNR of at least snrLim (method: see t2_estimate).
 ###############################################################################
 
-#def t2_fitmonoexp2 (T2, S0, T2bn, T2pe, slice, snr, snrlim, nx, ny, slc, te, start, pinfo):
-def t2_fitmonoexp2(slice,te,snrMap,snrLim, model,uplim):
+def t2_fitmonoexp2(slice,te,snrMap,snrLim, model,uplim, method='fit'):
 
-    dims = slice.shape
-    nx = dims[1]
-    ny = dims[0]
-
-    T2 = np.zeros([nx, ny],dtype='int8')  # Temporary store T2 map
-    S0 = np.zeros([nx, ny],dtype='int8')  # Temporary store S0 map
-    Y0 = np.zeros([nx, ny],dtype='int8')  # Temporary storeY0 map
+    T2 = np.zeros(slice.shape[:2])  # Temporary store T2 map
+    S0 = np.zeros(slice.shape[:2])  # Temporary store S0 map
+    Y0 = np.zeros(slice.shape[:2])  # Temporary storeY0 map
 
     # // FITTING PROCEDURE //
-    bar = progressbar.ProgressBar()
-    for i in bar(range(nx)):
-        for j in range(ny):
-            y = slice[i][j][:]
-            if np.mean(snrMap[i, j]) >= snrLim:
-                result = mpfitfun(y, te, model, uplim)
-                T2[i, j] = result['T2'].value
-                S0[i, j] = result['S0'].value
-                Y0[i, j] = result['Y0'].value
-        bar.update(i)
+    fitMask = np.mean(snrMap, axis=2) >= snrLim
+    result = np.nan_to_num(t2_estimate(slice[fitMask], te, model, uplim, method))
+    T2[fitMask] = result[:, 0]
+    S0[fitMask] = result[:, 1]
+    Y0[fitMask] = result[:, 2]
     allResult = {'T2': T2, 'S0': S0, 'Y0': Y0, 'SNR': snrMap}
-    #plt.imshow(T2, cmap='gray')
     return allResult
 
 
+###############################################################################
+# t2_slice
+#
+# Compute the SNR map of one slice (x, y, echoes) and fit the voxels of the
+# slice. Returns the maps of the slice as float32 (x, y, [T2, S0, (Y0,) SNR]).
+###############################################################################
+
+def t2_slice(slice, echoTime, model, uplim, snrLim, SNRMethod, method='fit'):
+
+    # Temporal map containing the snr values for the selected slice
+    if 'Chang' in SNRMethod:
+        curSnrMap, estStdSijbers, estStdSijbersNorm = changSNR.calcSNR(slice, 0, 1)
+    elif 'Brummer' in SNRMethod:
+        curSnrMap, estStdSijbers, estStdSijbersNorm = brummerSNR.calcSNR(slice, 0, 1)
+    elif 'Sijbers' in SNRMethod:
+        curSnrMap, estStdSijbers, estStdSijbersNorm = sijbersSNR.calcSNR(slice, 0, 1)
+    else:
+        sys.exit("Error: No valid SNR model.")
+
+    if 'T2_2p' in model:
+        # Fit the data of the single slice (model 1)
+        results = t2_fitmonoexp1(slice, echoTime, curSnrMap, snrLim, model, uplim, method)
+        maps = [results['T2'], results['S0'], results['SNR'][:, :, 0]]
+    elif 'T2_3p' in model:
+        # Fit the data of the single slice (model 2)
+        results = t2_fitmonoexp2(slice, echoTime, curSnrMap, snrLim, model, uplim, method)
+        maps = [results['T2'], results['S0'], results['Y0'], results['SNR'][:, :, 0]]
+    else:
+        sys.exit("Error: No valid model.")
+
+    return np.stack(maps, axis=2).astype(np.float32)
+
+
 ###############################################################################
 # t2_mapping
 #
 # Main function for the T2 mapping project. Iterate over the slices
 # T2 maps are generated from Bruker ParaVision data.
-# Generate arrays to store data and call the fitting routines.
+# The maps of all slices are stored in one float32 array
+# (x, y, slices, [T2, S0, (Y0,) SNR]). With workers > 1 the slices are
+# distributed over a process pool. callback is called with the number of
+# finished slices, e.g. to advance a progress bar.
 ###############################################################################
 
-def t2_mapping(data,echoTime, model, uplim, snrLim, SNRMethod):
+def t2_mapping(data,echoTime, model, uplim, snrLim, SNRMethod, method='fit', workers=1, callback=None):
 
 
-    imgData = data.get_data()
+    imgData = np.asanyarray(data.dataobj)
 
 
     nx = imgData.shape[0] # Images size in x - direction
     ny = imgData.shape[1] # Images size in y - direction
     ns = imgData.shape[3] # Number of slices
 
-
     if 'T2_2p' in model:
-         # Array to store the T2, S0 and Y0 maps
-         pvMaps = np.zeros([nx, ny, ns, 3],dtype=data.get_data_dtype())
-
-
-         #Loop to go through all slices
-         for slc in range(ns):
-            #   Print % of progress
-            #print('Slice: ' + str(slc + 1))
-
-            # Temporal image containing all TE values for the selected slice
-            slice = imgData[:, :, :, slc]
-
-
-            # Temporal map containing the snr values for the selected slice
-            if 'Chang' in SNRMethod:
-                curSnrMap, estStdSijbers, estStdSijbersNorm = changSNR.calcSNR(slice, 0, 1)
-            elif 'Brummer' in SNRMethod:
-                curSnrMap, estStdSijbers, estStdSijbersNorm = brummerSNR.calcSNR(slice, 0, 1)
-            elif 'Sijbers' in SNRMethod:
-                curSnrMap, estStdSijbers, estStdSijbersNorm = sijbersSNR.calcSNR(slice, 0, 1)
-            else:
-                sys.exit("Error: No valid SNR model.")
-
-            # Fit the data of the single slice (model 1)
-            results = t2_fitmonoexp1(slice, echoTime, curSnrMap, snrLim, model, uplim)
-
-            # Store data of slice in final image
-            pvMaps[:, :, slc, 0] = results['T2']
-            pvMaps[:, :, slc, 1] = results['S0']
-            pvMaps[:, :, slc, 2] = results['SNR'][:, :, 0]
-
+        nMaps = 3  # T2, S0 and SNR
     elif 'T2_3p' in model:
-        # Array to store the T2, S0 maps
-        pvMaps = np.zeros([nx, ny, ns, 4],dtype=data.get_data_dtype())
-
-        # Loop to go through all slices
-        for slc in range(ns):
-            #   Print % of progress
-            print('Slice: ' + str(slc + 1) +'\n')
-
-            # Temporal image containing all TE values for the selected slice
-            slice = imgData[:, :, :, slc]
-
-            # Temporal map containing the snr values for the selected slice
-            if 'Chang' in SNRMethod:
-                curSnrMap, estStdSijbers, estStdSijbersNorm = changSNR.calcSNR(slice, 0, 1)
-            elif 'Brummer' in SNRMethod:
-                curSnrMap, estStdSijbers, estStdSijbersNorm = brummerSNR.calcSNR(slice, 0, 1)
-            elif 'Sijbers' in SNRMethod:
-                curSnrMap, estStdSijbers, estStdSijbersNorm = sijbersSNR.calcSNR(slice, 0, 1)
-            else:
-                sys.exit("Error: No valid SNR model.")
-
-            # Fit the data of the single slice (model 1)
-            results = t2_fitmonoexp2(slice, echoTime, curSnrMap, snrLim, model, uplim)
-
-            # Store data of slice in final image
-            pvMaps[:, :, slc, 0] = results['T2']
-            pvMaps[:, :, slc, 1] = results['S0']
-            pvMaps[:, :, slc, 2] = results['Y0']
-            pvMaps[:, :, slc, 3] = results['SNR'][:,:,0]
-
+        nMaps = 4  # T2, S0, Y0 and SNR
     else:
         sys.exit("Error: No valid model.")
 
+    # Array to store the maps of all slices
+    pvMaps = np.zeros([nx, ny, ns, nMaps], dtype=np.float32)
+
+    if workers > 1 and ns > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(t2_slice, np.asarray(imgData[:, :, :, slc]), echoTime, model, uplim,
+                                       snrLim, SNRMethod, method): slc
+                       for slc in range(ns)}
+            for future in concurrent.futures.as_completed(futures):
+                pvMaps[:, :, futures[future]] = future.result()
+                if callback is not None:
+                    callback(1)
+    else:
+        # Loop to go through all slices
+        for slc in range(ns):
+            pvMaps[:, :, slc] = t2_slice(imgData[:, :, :, slc], echoTime, model, uplim, snrLim, SNRMethod, method)
+            if callback is not None:
+                callback(1)
 
     return pvMaps
 
 def mpfitfun(data,te,model,uplim):
+    # single voxel fit with lmfit (former fitting procedure, kept for comparisons)
+    from lmfit import Minimizer, Parameters
 
     y = data
     x = te
@@ -239,7 +419,7 @@ def mpfitfun(data,te,model,uplim):
     elif 'T2_3p' in model:
         estT2 = (x[1]-x[0])/(np.log(y[0])/np.log(y[1]))
         est = [estT2, y[0], y[len(y)-1]]
-        params.add('T2', value=est[0], min=0, max=70)
+        params.add('T2', value=est[0], min=0, max=uplim)
         params.add('S0', value=est[1])
         params.add('Y0', value=est[2])
         minner = Minimizer(t2_monoexp3, params, fcn_args=(x, y))
@@ -322,7 +502,7 @@ def parsePV(filename):
     return params
 
 
-def getT2mapping(path,model,upLim,snrLim,SNRMethod,echoTime,output_path):
+def getT2mapping(path,model,upLim,snrLim,SNRMethod,echoTime,output_path,method='fit',workers=1,callback=None):
 
     data = nii.load(path)
     hdr = data.header
@@ -330,7 +510,8 @@ def getT2mapping(path,model,upLim,snrLim,SNRMethod,echoTime,output_path):
     if raw['dim'][3] < 2:
         sys.exit("Error: '%s' has wrong dimensions." % (path,))
 
-    t2map = t2_mapping(data, echoTime, model=model, uplim=upLim, snrLim=snrLim, SNRMethod=SNRMethod)
+    t2map = t2_mapping(data, echoTime, model=model, uplim=upLim, snrLim=snrLim, SNRMethod=SNRMethod, method=method,
+                       workers=workers, callback=callback)
     pathT2Map = os.path.split(path)[0]
     t2map = t2map[:, :, :, 0] #delete this line if you want more outputdata
     t2map = np.flip(t2map, 2)
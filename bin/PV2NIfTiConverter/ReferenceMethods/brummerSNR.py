@@ -21,19 +21,17 @@ University Hospital Cologne
 
 """
 
-from math import *
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.optimize, scipy.signal
+try:
+    from .snrHistogram import normHistogram
+except ImportError:  # imported from this folder, e.g. by getSNR.py
+    from snrHistogram import normHistogram
 def calcSNR(img,show,fac):
-    # Normalize input dataset and plot histogram
+    # Normalize input dataset and plot histogram (shared with the other methods)
     #img = np.fliplr(img)
-    img = img.astype(float)
-    maxi =  img.max()
-    imgFlat = img.flatten()
-    imgNorm= imgFlat/maxi
-    bins  = ceil(sqrt(imgNorm.size))*fac
-    binCount, binLoc = np.histogram(imgNorm, int(bins))
+    img, maxi, imgNorm, binCount, binLoc = normHistogram(img, fac)
 
 
 
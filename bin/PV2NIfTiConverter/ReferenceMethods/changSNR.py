@@ -19,9 +19,12 @@ University Hospital Cologne
 
 """
 
-from math import *
 import numpy as np
 import matplotlib.pyplot as plt
+try:
+    from .snrHistogram import normHistogram, kdeMode
+except ImportError:  # imported from this folder, e.g. by getSNR.py
+    from snrHistogram import normHistogram, kdeMode
 
 
 
@@ -30,37 +33,20 @@ def calcSNR(img,show,fac):
     # Normalize input dataset and plot histogram
     #img = np.fliplr(img)
 
-    img = img.astype(int)
-    maxi =  img.max()
-    imgFlat = img.flatten(2)
-    imgNorm= imgFlat/maxi
-    bins  = ceil(sqrt(imgNorm.size))*fac
-    binCount, binLoc = np.histogram(imgNorm, int(bins))
+    img, maxi, imgNorm, binCount, binLoc = normHistogram(img, fac, integer=True)
+    bins  = len(binCount)
     n = len(imgNorm)
 
 
     estStd = np.argmax(binCount)
-    estStd = (estStd)/binCount.shape
-
-    x = np.linspace(0, 1, bins)
-    fhat = np.zeros([1,len(x)])
+    estStd = (estStd)/bins
 
     h = 1.06 * n**(-1/5) * estStd
 
-    # define function
-    gauss = lambda x: gaussianFct(x)
-
-    for i in range(n):
-        # get each kernel function evaluated at x
-        # centered at data
-        f = gauss((x-imgNorm[i])/h)
-        # plot(x, f / (n * h))
-        fhat = fhat+f
-
-
-    fhat =  fhat/(n*h)
+    # Mode of the kernel density estimate on linspace(0, 1, bins), the
+    # histogram convolved with the Gaussian kernel by FFT (see kdeMode)
+    maxPos = kdeMode(imgNorm, bins, h)
     # SNR-Map
-    maxPos = np.argmax(fhat)
     estStdNorm = binLoc[maxPos]
     estStd = (binLoc[maxPos]*maxi)/10
 
@@ -77,7 +63,3 @@ def calcSNR(img,show,fac):
             plt.show()
 
     return snrMap, estStd, estStdNorm
-
-def gaussianFct(x):
-    y = 1/sqrt(2*pi)*np.exp((-(np.square(x)))/2)
-    return y
\ No newline at end of file
@@ -9,6 +9,21 @@ This script runs every needed script for all (pre-)processing and registration
 steps. The data needs to be ordered like after Bruker2NIfTI conversion:
 project_folder/days/groups/subjects/.
 For the script to work, it needs to be placed within the /bin folder of AIDAmri.
+All steps of all subjects run in one process pool; every subject advances as
+soon as its own previous steps are finished. Completed steps are recorded in
+project_folder/batchproc_state.json together with the content hashes of their
+input and output files, the version of the step scripts and the parameters.
+A step is only executed again if one of these changed, so an interrupted run
+continues where it stopped and reruns on a grown cohort only process the new
+or changed data (use -rs to process everything again).
+Every executed script is recorded with its wall and CPU time, peak memory
+(for scripts run within a worker: the increase of the worker's peak memory),
+exit code and the amount of data written into its datatype folder in
+project_folder/batchproc_ledger.jsonl;
+-sum prints a summary of the slowest steps, invocations and subjects.
+The scripts of the steps run as functions within the worker processes, so
+the imports are only paid once per worker (use -sp to start a new Python
+interpreter for every script instead).
 
 Example:
 python batchProc.py -i /Volumes/Desktop/MRI/proc_data -t anat dwi func t2map
@@ -28,6 +43,17 @@ import multiprocessing
 import logging
 import shlex
 import time
+import json
+import hashlib
+import sys
+import threading
+import importlib
+import traceback
+import signal
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 
 def findData(projectPath, sessions, dataTypes):
@@ -76,7 +102,158 @@ def findData(projectPath, sessions, dataTypes):
 
     return all_files
     
-def run_subprocess(command,datatype,step,anat_process=False):
+def threadEnv(threads):
+    # Environment limiting OpenMP (NiftyReg, DSI Studio via dsi_tools) and the
+    # numpy BLAS backends of a step to its thread budget
+    env = dict(os.environ)
+    if threads:
+        for var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS"]:
+            env[var] = str(threads)
+    return env
+
+
+def folderSizes(folder):
+    # {file: (size, mtime)} of all files below folder except the logs, used to
+    # measure the bytes a step writes into its datatype folder
+    sizes = {}
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for name in filenames:
+            if name.endswith(".log"):
+                continue
+            file = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            sizes[file] = (stat.st_size, stat.st_mtime_ns)
+    return sizes
+
+
+def runMeasured(command_args, outfile, timeout, env, cwd=None):
+    # Runs a command like subprocess.run and measures it. Returns
+    # (exit code, timed out, cpu time in s, peak RSS in MB); the resource usage
+    # is None where os.wait4 is not available.
+    if resource is None or not hasattr(os, "wait4"):
+        try:
+            result = subprocess.run(command_args, stdout=outfile, stderr=outfile, text=True, timeout=timeout, env=env, cwd=cwd)
+            return result.returncode, False, None, None
+        except subprocess.TimeoutExpired:
+            return None, True, None, None
+
+    proc = subprocess.Popen(command_args, stdout=outfile, stderr=outfile, text=True, env=env, cwd=cwd)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    finally:
+        timer.cancel()
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    # ru_maxrss is given in kB on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss / 1024 ** 2 if sys.platform == "darwin" else usage.ru_maxrss / 1024
+    return proc.returncode, timed_out.is_set(), usage.ru_utime + usage.ru_stime, peak_rss
+
+
+class StageTimeout(BaseException):
+    # not an Exception, so the except blocks of the stage scripts do not catch it
+    pass
+
+
+def runInProcess(folder, command_args, outfile, timeout, env):
+    # Runs a stage script as its main() function in this process, so a warm
+    # worker does not pay interpreter start and the imports of nipype, nibabel
+    # and scipy again. Returns like runMeasured, but instead of the peak RSS
+    # (the one of the whole worker life) the increase of the worker's peak RSS
+    # during the step in MB (of the worker or of the tools it waited for):
+    # 0 if the step stayed below the peak of an earlier step.
+    module_name = os.path.splitext(os.path.basename(command_args[1]))[0]
+    stage_root = os.path.dirname(os.path.abspath(__file__))
+    # the stage folders share module names (MICO, applyMICO, ...), so the
+    # stage modules of previous steps are dropped and imported again
+    for name, module in list(sys.modules.items()):
+        file = getattr(module, "__file__", None)
+        if file and os.path.dirname(os.path.dirname(os.path.abspath(file))) == stage_root:
+            del sys.modules[name]
+
+    saved_env = dict(os.environ)
+    saved_cwd = os.getcwd()
+    saved_path = list(sys.path)
+    saved_fds = [os.dup(1), os.dup(2)]
+    usage_before = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)] if resource else None
+    # external tools started by the stage write to the file descriptors directly
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(outfile.fileno(), 1)
+    os.dup2(outfile.fileno(), 2)
+    os.environ.update(env)
+    os.chdir(folder)
+    sys.path.insert(0, folder)
+
+    def expired(signum, frame):
+        raise StageTimeout()
+
+    use_alarm = hasattr(signal, "SIGALRM") and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, expired)
+        signal.alarm(timeout)
+    returncode, timed_out = 0, False
+    try:
+        importlib.import_module(module_name).main(command_args[2:])
+    except StageTimeout:
+        returncode, timed_out = None, True
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            returncode = e.code
+        elif e.code is not None:
+            print(e.code, file=sys.stderr)
+            returncode = 1
+    except Exception:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous_handler)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        for fd in saved_fds:
+            os.close(fd)
+        os.chdir(saved_cwd)
+        sys.path[:] = saved_path
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+    if usage_before is None:
+        return returncode, timed_out, None, None
+    usage_after = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    cpu_time = sum(after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+                   for before, after in zip(usage_before, usage_after))
+    rss_increase = max(after.ru_maxrss - before.ru_maxrss for before, after in zip(usage_before, usage_after))
+    rss_increase = rss_increase / 1024 ** 2 if sys.platform == "darwin" else rss_increase / 1024
+    return returncode, timed_out, cpu_time, rss_increase
+
+
+def writeLedger(ledger_file, entry):
+    # Appends one JSON line; a single O_APPEND write keeps lines of parallel workers intact
+    line = (json.dumps(entry) + "\n").encode()
+    fd = os.open(ledger_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def run_subprocess(command,datatype,step,anat_process=False,threads=None,folder=None,in_process=False):
+    # Runs command = 'python <script> <args>' in folder, either as subprocess or
+    # with in_process as main() function of the stage script in this process
     timeout = 3600 # set maximum time in seconds after which the subprocess will be terminated
     command_args = shlex.split(command)
     file = command_args[-1]
@@ -93,31 +270,60 @@ def run_subprocess(command,datatype,step,anat_process=False):
     directories = normalized_path.split(os.path.sep)
     sub = [directory for directory in directories if "sub-" in directory][0]
     ses = [directory for directory in directories if "ses-" in directory][0]
-    
+    # every invocation is recorded in the run ledger of the project folder
+    ses_dir = os.path.sep.join(directories[:directories.index(ses) + 1])
+    ledger_file = os.path.join(os.path.dirname(os.path.dirname(ses_dir)), "batchproc_ledger.jsonl")
+    # only the step's own datatype folder: steps of other datatypes of the
+    # session may write at the same time
+    data_dir = os.path.join(ses_dir, datatype)
+
     try:
         logging.info(f"Running command: {command}.\nCheck {log_file} for further information.")
         if os.path.exists(log_file):
             os.remove(log_file)    
         with open(log_file, 'w') as outfile:
             time.sleep(2) # make sure logging file is created before starting the subprocess
-            result = subprocess.run(command_args, stdout=outfile, stderr=outfile, text=True, timeout=timeout)
-            if result.returncode != 0:
+            sizes_before = folderSizes(data_dir)
+            start = time.time()
+            rss_increase = None
+            if in_process:
+                # the peak RSS of a warm worker may come from an earlier step
+                returncode, timed_out, cpu_time, rss_increase = runInProcess(folder, command_args, outfile, timeout, threadEnv(threads))
+                peak_rss = None
+            else:
+                returncode, timed_out, cpu_time, peak_rss = runMeasured(command_args, outfile, timeout, threadEnv(threads), folder)
+            wall_time = time.time() - start
+            sizes_after = folderSizes(data_dir)
+            bytes_written = sum(size for file, (size, mtime) in sizes_after.items()
+                                if sizes_before.get(file) != (size, mtime))
+            writeLedger(ledger_file, {
+                "start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start)),
+                "sub": sub, "ses": ses, "datatype": datatype, "step": step,
+                "script": os.path.basename(command_args[1]), "threads": threads,
+                "wall_time": round(wall_time, 3),
+                "cpu_time": None if cpu_time is None else round(cpu_time, 3),
+                "peak_rss_mb": None if peak_rss is None else round(peak_rss, 1),
+                "peak_rss_increase_mb": None if rss_increase is None else round(rss_increase, 1),
+                "exit_code": returncode, "timed_out": timed_out, "bytes_written": bytes_written,
+                "in_process": in_process})
+            if timed_out:
+                logging.error(f'Timeout expired for command: {command_args}')
+                return sub,ses,datatype,step
+            if returncode != 0:
                 return sub,ses,datatype,step
             else:
                 return 0
-    except subprocess.TimeoutExpired:
-        logging.error(f'Timeout expired for command: {command_args}')
-        return sub,ses,datatype,step
     except Exception as e:
         logging.error(f'Error while executing the command: {command_args} Errorcode: {str(e)}')
         raise
     
 
-def executeScripts(currentPath_wData, dataFormat, step, stc=False, *optargs):
+def executeScripts(currentPath_wData, dataFormat, step, stc=False, threads=1, *optargs, in_process=False):
     # For every datatype (T2w, fMRI, DTI), go in all days/group/subjects folders
     # and execute the respective (pre-)processing/registration-scripts.
     # If a certain file does not exist, a note will be created in the errorList.
-    # cwd should contain the path of the /bin folder (the user needs to navigate to the /bin folder before executing this script)
+    # Every script runs with its stage folder as working directory, either as a
+    # subprocess or, with in_process, as main() function of the calling worker.
     #KEEP IN MIND DUE TO PARALLEL COMPUTING NO ERRORS IN THIS FUNCTION WILL BE PRINTED OUT => GREY ZONE
     errorList = [];
     message = '';
@@ -137,34 +343,33 @@ def executeScripts(currentPath_wData, dataFormat, step, stc=False, *optargs):
     if os.path.isdir(currentPath_wData):
         if dataFormat == 'anat':
             if step == "preprocess":
-                os.chdir(os.path.join(cwd, '2.1_T2PreProcessing'))
+                folder = os.path.join(cwd, '2.1_T2PreProcessing')
                 currentFile = list(currentPath_wData.glob("*T2w.nii.gz"))
                 if len(currentFile) > 0:
-                    command = f'python preProcessing_T2.py -i {currentFile[0]}'
-                    result = run_subprocess(command, dataFormat, step)
+                    # the thread budget goes to the MICO slice workers, each of them single threaded
+                    command = f'python preProcessing_T2.py -w {threads} -i {currentFile[0]}'
+                    result = run_subprocess(command, dataFormat, step, threads=1, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
                 else:
                     message = f'Could not find *T2w.nii.gz in {str(currentPath_wData)}'
                     logging.error(message)
                     errorList.append(message)
-                os.chdir(cwd)
 
             elif step == "registration":
-                os.chdir(os.path.join(cwd, '2.1_T2PreProcessing'))
+                folder = os.path.join(cwd, '2.1_T2PreProcessing')
                 currentFile = list(currentPath_wData.glob("*Bet.nii.gz"))
                 if len(currentFile) > 0:
                     command = f'python registration_T2.py -i {currentFile[0]}'
-                    result = run_subprocess(command, dataFormat, step)
+                    result = run_subprocess(command, dataFormat, step, threads=threads, folder=folder, in_process=in_process)
                     command = f'python t2_value_extraction.py -i {currentFile[0]}'
-                    result = run_subprocess(command, dataFormat, step)
+                    result = run_subprocess(command, dataFormat, step, threads=threads, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
                 else:
                     message = f'Could not find *Bet.nii.gz in {str(currentPath_wData)}'
                     logging.error(message)
                     errorList.append(message)
-                os.chdir(cwd)
 
             elif step == "process":
                 has_stroke_mask = any(currentPath_wData.glob("**/*Stroke_mask.nii.gz"))
@@ -173,130 +378,123 @@ def executeScripts(currentPath_wData, dataFormat, step, stc=False, *optargs):
                     logging.info(message)  #write in log-file
                     #print(message, flush=True)
                     return 0
-                os.chdir(os.path.join(cwd, '3.1_T2Processing'))
+                folder = os.path.join(cwd, '3.1_T2Processing')
                 command = f'python getIncidenceSize_par.py -i {str(currentPath_wData)}'
-                result = run_subprocess(command, dataFormat, step)
+                result = run_subprocess(command, dataFormat, step, threads=threads, folder=folder, in_process=in_process)
                 if isinstance(result, tuple) and len(result) == 4:
                     errorList.append(result)
                 command = f'python getIncidenceSize.py -i {str(currentPath_wData)}'
-                result = run_subprocess(command, dataFormat, step, anat_process=True)
+                result = run_subprocess(command, dataFormat, step, anat_process=True, threads=threads, folder=folder, in_process=in_process)
                 if isinstance(result, tuple) and len(result) == 4:
                     errorList.append(result)
-                os.chdir(cwd)
 
         elif dataFormat == 'func':
             if step == "preprocess":
-                os.chdir(os.path.join(cwd, '2.3_fMRIPreProcessing'))
+                folder = os.path.join(cwd, '2.3_fMRIPreProcessing')
                 currentFile = list(currentPath_wData.glob("*EPI.nii.gz"))
                 if len(currentFile)>0:
                     command = f'python preProcessing_fMRI.py -i {currentFile[0]}'
-                    result = run_subprocess(command,dataFormat,step)
+                    result = run_subprocess(command, dataFormat, step, threads=threads, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
                 else:
                     message = f'Could not find *EPI.nii.gz in {str(currentPath_wData)}';
                     logging.error(message)
                     errorList.append(message)
-                os.chdir(cwd)
             elif step == "registration":
-                os.chdir(os.path.join(cwd, '2.3_fMRIPreProcessing'))
+                folder = os.path.join(cwd, '2.3_fMRIPreProcessing')
                 currentFile = list(currentPath_wData.glob("*SmoothBet.nii.gz"))
                 if len(currentFile)>0:
                     command = f'python registration_rsfMRI.py -i {currentFile[0]}'
-                    result = run_subprocess(command,dataFormat,step)
+                    result = run_subprocess(command, dataFormat, step, threads=threads, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
                 else:
                     message = f'Could not find *SmoothBet.nii.gz in {str(currentPath_wData)}';
                     logging.error(message)
                     errorList.append(message)
-                os.chdir(cwd)
             elif step == "process":
                 currentFile = list(currentPath_wData.glob("*EPI.nii.gz"))
                 if len(currentFile)>0:
-                    os.chdir(os.path.join(cwd, '3.3_fMRIActivity'))
+                    folder = os.path.join(cwd, '3.3_fMRIActivity')
                     command = f'python process_fMRI.py -i {currentFile[0]} -stc {stc}'
-                    result = run_subprocess(command,dataFormat,step)
+                    result = run_subprocess(command, dataFormat, step, threads=threads, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
-                    os.chdir(cwd)
         elif dataFormat == 't2map':
             if step == "preprocess":
-                os.chdir(os.path.join(cwd, '4.1_T2mapPreProcessing'))
+                folder = os.path.join(cwd, '4.1_T2mapPreProcessing')
                 currentFile = list(currentPath_wData.glob("*MEMS.nii.gz"))
                 if len(currentFile)>0:
-                    command = f'python preProcessing_T2MAP.py -i {currentFile[0]}'
-                    result = run_subprocess(command,dataFormat,step)
+                    # the thread budget goes to the MICO slice workers, each of them single threaded
+                    command = f'python preProcessing_T2MAP.py -w {threads} -i {currentFile[0]}'
+                    result = run_subprocess(command, dataFormat, step, threads=1, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
                 else:
                     message = f'Could not find *MEMS.nii.gz in {str(currentPath_wData)}';
                     logging.error(message)
                     errorList.append(message)
-                os.chdir(cwd)
             elif step == "registration":
-                os.chdir(os.path.join(cwd, '4.1_T2mapPreProcessing'))
+                folder = os.path.join(cwd, '4.1_T2mapPreProcessing')
                 currentFile = list(currentPath_wData.glob("*SmoothMicoBet.nii.gz"))
                 if len(currentFile)>0:
                     command = f'python registration_T2MAP.py -i {currentFile[0]}'
-                    result = run_subprocess(command,dataFormat,step)
+                    result = run_subprocess(command, dataFormat, step, threads=threads, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
                 else:
                     message = f'Could not find *SmoothMicoBet.nii.gz in {str(currentPath_wData)}';
                     print(message)
                     errorList.append(message)
-                os.chdir(cwd)
             elif step == "process":
+                folder = os.path.join(cwd, '4.1_T2mapPreProcessing')
                 currentFile = list(currentPath_wData.glob("*T2w_MAP.nii.gz"))
                 if len(currentFile)>0:
                     command = f'python t2map_data_extract.py -i {currentFile[0]}'
-                    result = run_subprocess(command,dataFormat,step)
+                    result = run_subprocess(command, dataFormat, step, threads=threads, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
                 else:
                     message = f'Could not find *T2w_MAP.nii.gz in {str(currentPath_wData)}';
                     logging.error(message)
                     errorList.append(message)
-                os.chdir(cwd)
         elif dataFormat == 'dwi':
             if step == "preprocess":
-                os.chdir(os.path.join(cwd, '2.2_DTIPreProcessing'))
+                folder = os.path.join(cwd, '2.2_DTIPreProcessing')
                 currentFile = list(currentPath_wData.glob("*dwi.nii.gz"))
                 if len(currentFile)>0:
-                    command = f'python preProcessing_DTI.py -i {currentFile[0]}'
-                    result = run_subprocess(command,dataFormat,step)
+                    # the thread budget goes to the MICO slice workers, each of them single threaded
+                    command = f'python preProcessing_DTI.py -w {threads} -i {currentFile[0]}'
+                    result = run_subprocess(command, dataFormat, step, threads=1, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
                 else:
                     message = f'Could not find *dwi.nii.gz in {str(currentPath_wData)}';
                     logging.error(message)
                     errorList.append(message)
-                os.chdir(cwd)
             elif step == "registration":
-                os.chdir(os.path.join(cwd, '2.2_DTIPreProcessing'))
+                folder = os.path.join(cwd, '2.2_DTIPreProcessing')
                 currentFile = list(currentPath_wData.glob("*SmoothMicoBet.nii.gz"))
                 if len(currentFile)>0:
                     command = f'python registration_DTI.py -i {currentFile[0]}'
-                    result = run_subprocess(command,dataFormat,step)
+                    result = run_subprocess(command, dataFormat, step, threads=threads, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
                 else:
                     message = f'Could not find *SmoothMicoBet.nii.gz in {str(currentPath_wData)}';
                     logging.error(message)
                     errorList.append(message)
-                os.chdir(cwd)
             elif step == "process":
                 currentFile = list(currentPath_wData.glob("*dwi.nii.gz"))
                 # Appends optional (fa0, nii_gz) flags to DTI main process if passed
                 if len(currentFile)>0:
                     cli_str = f'dsi_main.py -i {currentFile[0]}'
-                    os.chdir(os.path.join(cwd, '3.2_DTIConnectivity'))
+                    folder = os.path.join(cwd, '3.2_DTIConnectivity')
                     command = f'python {cli_str}'
-                    result = run_subprocess(command,dataFormat,step)
+                    result = run_subprocess(command, dataFormat, step, threads=threads, folder=folder, in_process=in_process)
                     if result != 0:
                         errorList.append(result)
-                    os.chdir(cwd)
         else:
             message = 'The data folders'' names do not match anat, dwi, func or t2map';
             logging.error(message);
@@ -322,6 +520,353 @@ def find(pattern, path):
                 result.append(os.path.join(root, name))
     return result
 
+STEP_ORDER = ["preprocess", "registration", "process"]
+
+# folders with the scripts executed by each step, their content is the script version
+STAGE_FOLDERS = {
+    ("anat", "preprocess"): ["2.1_T2PreProcessing"],
+    ("anat", "registration"): ["2.1_T2PreProcessing"],
+    ("anat", "process"): ["3.1_T2Processing"],
+    ("dwi", "preprocess"): ["2.2_DTIPreProcessing"],
+    ("dwi", "registration"): ["2.2_DTIPreProcessing"],
+    ("dwi", "process"): ["3.2_DTIConnectivity"],
+    ("func", "preprocess"): ["2.3_fMRIPreProcessing"],
+    ("func", "registration"): ["2.3_fMRIPreProcessing"],
+    ("func", "process"): ["3.3_fMRIActivity"],
+    ("t2map", "preprocess"): ["4.1_T2mapPreProcessing"],
+    ("t2map", "registration"): ["4.1_T2mapPreProcessing"],
+    ("t2map", "process"): ["4.1_T2mapPreProcessing"],
+}
+
+# (thread budget, memory ceiling in GB) of one job of each step. The threads
+# are handed to reg_aladin/reg_f3d and DSI Studio (OpenMP) or to the MICO
+# slice workers; jobs are packed so that their budgets never exceed the cores.
+JOB_RESOURCES = {
+    ("anat", "preprocess"): (2, 2),
+    ("anat", "registration"): (4, 4),
+    ("anat", "process"): (1, 2),
+    ("dwi", "preprocess"): (2, 2),
+    ("dwi", "registration"): (2, 3),
+    ("dwi", "process"): (4, 6),
+    ("func", "preprocess"): (1, 4),
+    ("func", "registration"): (2, 4),
+    ("func", "process"): (4, 8),
+    ("t2map", "preprocess"): (2, 2),
+    ("t2map", "registration"): (2, 3),
+    ("t2map", "process"): (1, 2),
+}
+
+
+def jobKey(job):
+    # job = (sub, ses, datatype, step) -> key used in the state file
+    return "/".join(job)
+
+
+def buildJobs(all_files, steps):
+    # Builds the step DAG of every subject/session. Returns a dict
+    # job -> (path, prerequisites) with job = (sub, ses, datatype, step).
+    # Within a datatype the steps follow STEP_ORDER; the registration of dwi,
+    # func and t2map data needs the transforms of the anat registration of the
+    # same session. Prerequisites that are not part of this run are expected
+    # to be finished already.
+    jobs = {}
+    steps = [step for step in STEP_ORDER if step in steps]
+    for datatype, paths in all_files.items():
+        for path in paths:
+            sub, ses = Path(path).parts[-3:-1]
+            for idx, step in enumerate(steps):
+                deps = []
+                if idx > 0:
+                    deps.append((sub, ses, datatype, steps[idx - 1]))
+                if datatype != "anat" and step == "registration":
+                    deps.append((sub, ses, "anat", "registration"))
+                jobs[(sub, ses, datatype, step)] = (path, deps)
+
+    for path, deps in jobs.values():
+        deps[:] = [dep for dep in deps if dep in jobs]
+    return jobs
+
+
+
+def upstreamJobs(job):
+    # All steps whose outputs job may read, independent of the steps of this run
+    sub, ses, datatype, step = job
+    upstream = {(sub, ses, datatype, prev) for prev in STEP_ORDER[:STEP_ORDER.index(step)]}
+    if datatype != "anat" and step != "preprocess":
+        upstream |= {(sub, ses, "anat", "preprocess"), (sub, ses, "anat", "registration")}
+    return upstream
+
+
+def inputFolders(path, datatype, step):
+    # Data folders a step reads; non-anat registrations use the anat transforms
+    folders = [str(path)]
+    if datatype != "anat" and step != "preprocess":
+        folders.append(os.path.join(os.path.dirname(str(path)), "anat"))
+    return folders
+
+
+def fileDigest(file, known=None):
+    # [size, mtime, sha256] of a file. The hash of known is reused if size and
+    # mtime did not change, so unchanged data is not read again.
+    stat = os.stat(file)
+    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+        return known
+    sha = hashlib.sha256()
+    with open(file, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b""):
+            sha.update(chunk)
+    return [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+
+
+def snapshot(folders, root, known):
+    # Digests of all data files below folders, keyed by their path relative to root
+    digests = {}
+    for folder in folders:
+        for dirpath, dirnames, filenames in os.walk(folder):
+            for name in filenames:
+                if name.endswith(".log") or name == ".DS_Store":
+                    continue
+                file = os.path.join(dirpath, name)
+                rel = os.path.relpath(file, root)
+                digests[rel] = fileDigest(file, known.get(rel))
+    return digests
+
+
+def scriptVersion(datatype, step):
+    # Hash of all python sources in the stage folders of a step
+    cwd = str(Path(__file__).resolve().parent)
+    sha = hashlib.sha256()
+    for folder in STAGE_FOLDERS[(datatype, step)]:
+        for file in sorted(glob.glob(os.path.join(cwd, folder, "*.py"))):
+            sha.update(os.path.basename(file).encode())
+            with open(file, "rb") as infile:
+                sha.update(infile.read())
+    return sha.hexdigest()
+
+
+def physicalMemory():
+    # Total memory of the machine in GB, None if unknown
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def runStep(path, datatype, step, stc, record, exclude, threads=1, in_process=False):
+    # Executes one step unless record shows that it is up to date: same script
+    # version and parameters, all recorded inputs and outputs still have the
+    # recorded hash and no other file was added to the folders it reads.
+    # Files in exclude (outputs of steps job does not depend on) are not
+    # treated as inputs. Outputs are the files changed in the step's own
+    # datatype folder.
+    # Returns (errorList, record, skipped); the record of a skipped step has
+    # the current size and mtime of its files.
+    root = str(Path(path).parents[2])
+    folders = inputFolders(path, datatype, step)
+    params = [datatype, step, str(stc)]
+    version = scriptVersion(datatype, step)
+    known = {}
+    if record is not None:
+        known.update(record["inputs"])
+        known.update(record["outputs"])
+    before = snapshot(folders, root, known)
+
+    if record is not None and record["script"] == version and record["params"] == params:
+        # only the content counts, a touch or a copy without times does not
+        unchanged = all(file in before and before[file][2] == digest[2] for file, digest in known.items())
+        if unchanged and not set(before) - exclude - set(known):
+            record = dict(record, inputs={file: before[file] for file in record["inputs"]},
+                          outputs={file: before[file] for file in record["outputs"]})
+            return 0, record, True
+
+    errorList = executeScripts(path, datatype, step, stc, threads, in_process=in_process)
+    if errorList != 0:
+        return errorList, None, False
+
+    # only the step's own datatype folder holds its outputs; the anat folder
+    # it reads may be written by an anat step running at the same time, such
+    # files keep their digest from before the step as inputs
+    after = snapshot([str(path)], root, before)
+    outputs = {file: digest for file, digest in after.items() if before.get(file) != digest}
+    inputs = {file: digest for file, digest in before.items() if file not in outputs and file not in exclude}
+    record = {"finished": time.strftime("%Y-%m-%d %H:%M:%S"), "script": version, "params": params,
+              "inputs": inputs, "outputs": outputs}
+    return 0, record, False
+
+def loadState(state_file):
+    # Completed steps of previous runs
+    if os.path.exists(state_file):
+        with open(state_file) as infile:
+            return json.load(infile)
+    return {}
+
+
+def saveState(state, state_file):
+    # write to a temporary file first, so a killed run never leaves a broken state file
+    temp_file = state_file + ".tmp"
+    with open(temp_file, "w") as outfile:
+        json.dump(state, outfile, indent=1, sort_keys=True)
+    os.replace(temp_file, state_file)
+
+
+def runJobs(jobs, num_processes, stc, state_file, memory_limit=None, in_process=False):
+    # Runs all jobs in one persistent process pool. A job is submitted as soon
+    # as its own prerequisites are finished, so a slow subject does not hold
+    # back the others. Every finished job is recorded in state_file with the
+    # hashes of its inputs and outputs; runStep skips a job whose record is
+    # still valid, so a crashed or killed run resumes without redoing finished
+    # work and unchanged data is not processed again. Jobs whose
+    # prerequisites failed are skipped. Each job gets the thread budget of
+    # JOB_RESOURCES; jobs are only started while the sum of their budgets
+    # fits into num_processes cores and their memory into memory_limit (GB).
+    # With in_process the workers run the stage scripts as functions instead
+    # of starting a new interpreter for every script.
+    state = loadState(state_file)
+    done = set()
+    failed = set()
+    pending = set(jobs)
+    errors = []
+    skipped = 0
+    if state:
+        print(f"Found records of {len(state)} completed steps, unchanged steps will be skipped")
+        logging.info(f"Using {state_file}: {len(state)} steps recorded")
+
+    def excludedFiles(job):
+        # outputs of recorded steps of the same session that job does not depend on
+        sub, ses = job[:2]
+        upstream = upstreamJobs(job)
+        exclude = set()
+        for other in jobs:
+            record = state.get(jobKey(other))
+            if other[:2] == (sub, ses) and other != job and other not in upstream and record is not None:
+                exclude.update(record["outputs"])
+        return exclude
+
+    # deeper steps first, so subjects run to completion; anat first, as other datatypes wait for it
+    def priority(job):
+        sub, ses, datatype, step = job
+        return (-STEP_ORDER.index(step), datatype != "anat", sub, ses, datatype)
+
+    progress_bar = tqdm(total=len(jobs), desc="batch processing")
+    def resources(job):
+        threads, memory = JOB_RESOURCES[job[2:]]
+        return min(threads, num_processes), memory
+
+    def fits(job):
+        # an idle pool always accepts a job, even if it exceeds the limits
+        if not running:
+            return True
+        threads, memory = resources(job)
+        used_threads = sum(resources(other)[0] for other in running.values())
+        used_memory = sum(resources(other)[1] for other in running.values())
+        return (used_threads + threads <= num_processes
+                and (memory_limit is None or used_memory + memory <= memory_limit))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+        running = {}
+
+        def submitReady():
+            changed = True
+            while changed:
+                changed = False
+                for job in sorted(pending, key=priority):
+                    path, deps = jobs[job]
+                    if any(dep in failed for dep in deps):
+                        pending.discard(job)
+                        failed.add(job)
+                        errors.append(f"Skipped {jobKey(job)}, a previous step failed")
+                        progress_bar.update(1)
+                        changed = True
+                    elif all(dep in done for dep in deps) and fits(job):
+                        pending.discard(job)
+                        sub, ses, datatype, step = job
+                        running[executor.submit(runStep, path, datatype, step, stc, state.get(jobKey(job)),
+                                                excludedFiles(job), resources(job)[0], in_process)] = job
+
+        submitReady()
+        while running:
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                errorList, record, up_to_date = future.result()
+                if errorList == 0:
+                    done.add(job)
+                    if up_to_date:
+                        skipped += 1
+                        logging.info(f"{jobKey(job)} is up to date, skipped")
+                        if record != state.get(jobKey(job)):
+                            # store the new size and mtime, so the files are not hashed again
+                            state[jobKey(job)] = record
+                            saveState(state, state_file)
+                    else:
+                        state[jobKey(job)] = record
+                        saveState(state, state_file)
+                        logging.info(f"{jobKey(job)} completed")
+                else:
+                    failed.add(job)
+                    if state.pop(jobKey(job), None) is not None:
+                        saveState(state, state_file)
+                    if isinstance(errorList, list):
+                        errors.extend(errorList)
+                    else:
+                        errors.append(errorList)
+                progress_bar.update(1)
+            submitReady()
+    progress_bar.close()
+    if skipped:
+        print(f"{skipped} steps were up to date and skipped")
+
+    return done, failed, errors
+
+
+
+def summarizeLedger(ledger_file, top=10):
+    # Ranks the invocations recorded in the run ledger: time per datatype and
+    # step, the slowest single invocations and the slowest subjects/sessions
+    entries = []
+    with open(ledger_file) as infile:
+        for line in infile:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    if not entries:
+        print(f"{ledger_file} is empty")
+        return
+
+    def group(keyFunc):
+        groups = {}
+        for entry in entries:
+            groups.setdefault(keyFunc(entry), []).append(entry)
+        return sorted(groups.items(), key=lambda item: -sum(e["wall_time"] for e in item[1]))
+
+    def number(entries_, field, func):
+        values = [e[field] for e in entries_ if e.get(field) is not None]
+        return func(values) if values else float("nan")
+
+    total = sum(e["wall_time"] for e in entries)
+    print(f"{len(entries)} invocations, {total / 3600:.2f} h wall time in total\n")
+
+    print(f"{'datatype':<10}{'step':<14}{'runs':>6}{'failed':>8}{'wall [s]':>12}{'share':>8}"
+          f"{'mean [s]':>10}{'cpu [s]':>12}{'max RSS [MB]':>14}{'RSS incr. [MB]':>16}{'written [MB]':>14}")
+    for (datatype, step), group_entries in group(lambda e: (e["datatype"], e["step"])):
+        wall = sum(e["wall_time"] for e in group_entries)
+        failed = sum(1 for e in group_entries if e["exit_code"] != 0)
+        print(f"{datatype:<10}{step:<14}{len(group_entries):>6}{failed:>8}{wall:>12.1f}{wall / total:>8.1%}"
+              f"{wall / len(group_entries):>10.1f}{number(group_entries, 'cpu_time', sum):>12.1f}"
+              f"{number(group_entries, 'peak_rss_mb', max):>14.1f}"
+              f"{number(group_entries, 'peak_rss_increase_mb', max):>16.1f}"
+              f"{sum(e['bytes_written'] for e in group_entries) / 1024 ** 2:>14.1f}")
+
+    print(f"\nSlowest {top} invocations:")
+    for e in sorted(entries, key=lambda e: -e["wall_time"])[:top]:
+        print(f"{e['wall_time']:>10.1f} s  {e['sub']} {e['ses']} {e['datatype']} {e['step']} "
+              f"({e['script']}, exit code {e['exit_code']}, started {e['start']})")
+
+    print(f"\nSlowest {top} subjects/sessions:")
+    for (sub, ses), group_entries in group(lambda e: (e["sub"], e["ses"]))[:top]:
+        print(f"{sum(e['wall_time'] for e in group_entries):>10.1f} s  {sub} {ses} ({len(group_entries)} invocations)")
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description='Batch processing of all data. This script runs every needed script for all registration and processing steps. The data needs to be ordered like after Bruker2NIfTI conversion: project_folder/days/groups/subjects/. For the script to work, it needs to be placed within the /bin folder of AIDAmri. Example: python batchProc.py -f /Volumes/Desktop/MRI/proc_data -g Treatment_C3a Treatment_PBS -d Baseline P7 P14 P28 P42 P56 -t T2w fMRI DTI')
@@ -339,11 +884,19 @@ if __name__ == "__main__":
     optionalNamed.add_argument('-ds', '--debug_steps', required=False, nargs='+', help='Define which steps of the processing should be done. Default = [preprocess, registration, process]')
     optionalNamed.add_argument('-cpu', '--cpu_cores', required=False, default = "Half", help='Define how many parallel processes should be use to process your data. CAUTION: Too many processes will slow down your computer noticeably. Select between: ["Min", "Half", "Max"]')
     optionalNamed.add_argument('-e_cpu', '--expert_cpu', required=False, help='Define precisely how many parallel processes should be used. Enter a number.')
+    optionalNamed.add_argument('-mem', '--memory', required=False, type=float, help='Memory in GB the parallel jobs may use together. Default = physical memory of the machine.')
+    optionalNamed.add_argument('-rs', '--restart', action='store_true', help='Ignore the steps recorded as completed in batchproc_state.json by previous runs and process everything again.')
+    optionalNamed.add_argument('-sp', '--subprocess', action='store_true', help='Start a new Python interpreter for every script instead of running the scripts within the worker processes.')
+    optionalNamed.add_argument('-sum', '--summary', action='store_true', help='Print the run time summary of all steps recorded in batchproc_ledger.jsonl and exit.')
     
 
     args = parser.parse_args()
     pathToData = args.input
     sessions = args.sessions
+
+    if args.summary:
+        summarizeLedger(os.path.join(pathToData, "batchproc_ledger.jsonl"))
+        sys.exit(0)
     
     #configurate the logging module
     log_file_path = os.path.join(pathToData, "batchproc_log.txt")
@@ -382,61 +935,37 @@ if __name__ == "__main__":
     if args.expert_cpu:
         num_processes = int(args.expert_cpu)
     
+    memory_limit = args.memory if args.memory else physicalMemory()
+
     print(f"Running with {num_processes} parallel processes!")
 
     logging.info(f"Entered information:\n{pathToData}\n dataTypes {dataTypes}\n Slice time correction [{stc}]")
-    logging.info(f"Using {num_processes} CPUs for the parallelization")
+    logging.info(f"Using {num_processes} CPUs for the parallelization, memory limit {memory_limit} GB")
     logging.info(f"Processing following datasets:\n{all_files}")
 
+    state_file = os.path.join(pathToData, "batchproc_state.json")
+    if args.restart and os.path.exists(state_file):
+        os.remove(state_file)
+
+    jobs = buildJobs(all_files, steps)
+    done, failed, error_list_all = runJobs(jobs, num_processes, stc, state_file, memory_limit, in_process=not args.subprocess)
+
     for key, value in all_files.items():
         if value:
-            error_list_all = []
-            print()
-            print(f"Entered {key} data: \n{value}")
-            print()
-            print(f"\n{key} processing \33[5m...\33[0m (wait!)") 
-            print()
-            for step in steps: 
-                error_list_step = []
-                progress_bar = tqdm(total=len(value), desc=f"{step} {key} data")
-                with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
-                    futures = [executor.submit(executeScripts, path, key, step, stc) for path in value]
-
-                    for future in concurrent.futures.as_completed(futures):
-                        progress_bar.update(1)
-
-                        errorList = future.result()
-                        if errorList != 0:
-                            if isinstance(errorList, list):
-                                error_list_step.extend(errorList)
-                            else:
-                                error_list_step.append(errorList)
-                        
-                    concurrent.futures.wait(futures)
-                progress_bar.close()
-                error_list_all.extend(error_list_step)
-                if not error_list_step:
-                    print(f"{key} {step}  \033[0;30;42m COMPLETED \33[0m")
-                else:
+            for step in [step for step in STEP_ORDER if step in steps]:
+                if any(job[2] == key and job[3] == step for job in failed):
                     print(f"{key} {step}  \033[0;30;41m INCOMPLETE \33[0m")
+                else:
+                    print(f"{key} {step}  \033[0;30;42m COMPLETED \33[0m")
                 logging.info(f"{key} {step} processing completed")
-                
-                
-            logging.error(f"Following errors were occuring {error_list_all}")
-            logging.info(f"{key} processing completed")
-            if not error_list_all:
-                print(f"\n{key} processing \033[0;30;42m COMPLETED \33[0m")
-            else:
-                print(f"\n{key} processing \033[0;30;41m INCOMPLETE \33[0m")
-            if error_list_all:
-                print()
-                for error in error_list_all:
-                    if isinstance(error, tuple) and len(error) == 4:
-                        sub, ses, datatype, step = error
-                        print(
-                            f"Error in sub: {sub} in session: {ses} in datatype: {datatype} and step: {step}. Check logging file for further information")
-                    else:
-                        print(f"Unrecognized error format: {error}")
-                
 
- 
+    logging.error(f"Following errors were occuring {error_list_all}")
+    if error_list_all:
+        print()
+        for error in error_list_all:
+            if isinstance(error, tuple) and len(error) == 4:
+                sub, ses, datatype, step = error
+                print(
+                    f"Error in sub: {sub} in session: {ses} in datatype: {datatype} and step: {step}. Check logging file for further information")
+            else:
+                print(f"Unrecognized error format: {error}")
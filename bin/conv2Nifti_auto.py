@@ -24,6 +24,7 @@ import glob as glob
 from pathlib import Path
 import numpy as np
 import re
+import time
 import concurrent.futures
 from PV2NIfTiConverter import P2_IDLt2_mapping
 import functools
@@ -130,9 +131,13 @@ def get_visu_pars(path):
             lines = infile.readlines()
             for idx, line in enumerate(lines):
                 if "VisuAcqEchoTime=" in line:    
-                    if lines[idx+1]:
-                        echotimes = [float(s) for s in re.findall(r'\d+', lines[idx+1])]
-                        echotimes = np.array(echotimes)
+                    # values may be fractional and span several lines up to the next parameter
+                    values = []
+                    for value_line in lines[idx+1:]:
+                        if value_line.startswith(("##", "$$")):
+                            break
+                        values += [float(s) for s in re.findall(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?', value_line)]
+                    echotimes = np.array(values)
     return echotimes
 
 def bids_convert(input_dir, output_dir):
@@ -202,7 +207,7 @@ def brkraw_tonii(input_path):
         logging.error(f'Fehler bei der Ausführung des Befehls: {command_args}\nFehlermeldung: {str(e)}')
         raise
 
-def create_mems_and_map(mese_scan_ses, mese_scan_data, output_dir):
+def create_mems_and_map(mese_scan_ses, mese_scan_data, output_dir, t2_method='fit'):
     # iterate over every subject and ses to check if MEMS files are included
     
     sub = os.path.basename(os.path.dirname(mese_scan_ses))
@@ -262,8 +267,9 @@ def create_mems_and_map(mese_scan_ses, mese_scan_data, output_dir):
         if not os.path.exists(os.path.join(output_dir, sub, ses, "t2map")):
             os.mkdir(os.path.join(output_dir, sub, ses, "t2map"))
         try:
-            P2_IDLt2_mapping.getT2mapping(t2_mems_path, 'T2_2p', 100, 1.5, 'Brummer', echotimes, t2map_path)
-            logging.info(f"Map created for: {os.path.basename(t2_mems_path)}")
+            start = time.perf_counter()
+            P2_IDLt2_mapping.getT2mapping(t2_mems_path, 'T2_2p', 100, 1.5, 'Brummer', echotimes, t2map_path, method=t2_method)
+            logging.info(f"Map created for: {os.path.basename(t2_mems_path)} ({new_img.shape[3]} slices in {time.perf_counter() - start:.1f} s)")
         except Exception as e:
             logging.error(f"Error while computing T2w Map:\n{e}")
             raise
@@ -339,6 +345,10 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--sessions',
                         help='Select which sessions of your data should be processed, if no days are given all data will be used.', type=str, required=False)
     parser.add_argument('-o', '--output', type=str, required=False, help='Output directory where the results will be saved.')
+    parser.add_argument('-t', '--t2Method', type=str, required=False, default='fit', choices=['fit', 'dictionary'],
+                        help='T2 estimation of the T2 maps: least squares fit or matching with a precomputed decay dictionary (faster). Default = fit')
+    parser.add_argument('-j', '--jobs', type=int, required=False, default=None,
+                        help='Number of sessions whose T2 maps are computed in parallel processes. Default = number of CPUs')
 
     ## read out parameters
     args = parser.parse_args()
@@ -447,10 +457,11 @@ if __name__ == "__main__":
    
     print("T2 mapping running \33[5m...\33[0m (wait!)")
     logging.info(f"Creating T2w maps for following datasets:\n{mese_scan_ids}")
-    with concurrent.futures.ProcessPoolExecutor() as executor:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
         
-        futures = [executor.submit(create_mems_and_map, mese_scan_ses, mese_scan_data, output_dir) for mese_scan_ses in mese_scan_sessions]
-        concurrent.futures.wait(futures)
+        futures = [executor.submit(create_mems_and_map, mese_scan_ses, mese_scan_data, output_dir, args.t2Method) for mese_scan_ses in mese_scan_sessions]
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            print(f"\rT2 mapping running \33[5m...\33[0m {done}/{len(futures)} sessions", end='', flush=True)
         
         
     print('\rT2 mapping \033[0;30;42m COMPLETED \33[0m                            ')
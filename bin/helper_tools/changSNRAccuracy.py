@@ -0,0 +1,88 @@
+"""
+Compares the noise estimation of Chang's method
+(PV2NIfTiConverter/ReferenceMethods/changSNR.py) with the former kernel
+density estimate, which added the Gaussian kernel of every voxel on all
+histogram bins.
+
+Rician noise images with a bright region of random size and intensity are
+generated (or the slices of an image given with -i are used), the mode of the
+kernel density estimate is computed with kdeMode (binned, FFT) and with the
+direct sum over all voxels, and the run times and the number of differing
+modes are reported.
+
+Example:
+python changSNRAccuracy.py -n 20 -x 128 -e 8
+python changSNRAccuracy.py -i sub-01_ses-01_T2w_MEMS.nii.gz
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import nibabel as nii
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PV2NIfTiConverter.ReferenceMethods import snrHistogram
+
+
+def directMode(data, nGrid, h, block_size=4096):
+    # grid point with the largest kernel density, summed over all voxels as before
+    x = np.linspace(0, 1, nGrid)
+    fhat = np.zeros(nGrid)
+    for start in range(0, len(data), block_size):
+        fhat += snrHistogram.gaussianFct((x - data[start:start + block_size, np.newaxis]) / h).sum(axis=0)
+    return int(np.argmax(fhat))
+
+
+def syntheticSlices(count, size, echoes, rng):
+    yy, xx = np.mgrid[:size, :size]
+    for _ in range(count):
+        sigma = rng.uniform(20, 200)
+        img = np.abs(rng.normal(0, sigma, (size, size, echoes)) + 1j * rng.normal(0, sigma, (size, size, echoes)))
+        region = (xx - size / 2) ** 2 + (yy - size / 2) ** 2 < (rng.uniform(0.1, 0.4) * size) ** 2
+        img[region] += rng.uniform(100, 3000, (region.sum(), 1))
+        yield img.astype(np.int16)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the binned kernel density mode of Chang's method with the direct sum.")
+    parser.add_argument('-i', '--input', help='Image whose slices (last axis) are used. Default: synthetic slices')
+    parser.add_argument('-n', '--slices', type=int, default=20, help='Number of synthetic slices. Default = 20')
+    parser.add_argument('-x', '--size', type=int, default=128, help='In-plane size of the synthetic slices. Default = 128')
+    parser.add_argument('-e', '--echoes', type=int, default=8, help='Echoes of the synthetic slices. Default = 8')
+    args = parser.parse_args()
+
+    if args.input is None:
+        slices = syntheticSlices(args.slices, args.size, args.echoes, np.random.default_rng(0))
+    elif os.path.exists(args.input):
+        img = np.asanyarray(nii.load(args.input).dataobj)
+        slices = (img[..., slc] for slc in range(img.shape[-1]))
+    else:
+        sys.exit("Error: '%s' is not an existing file." % (args.input,))
+
+    total, skipped, differing = 0, 0, 0
+    binned_time, direct_time = 0.0, 0.0
+    for img in slices:
+        img, maxi, imgNorm, binCount, binLoc = snrHistogram.normHistogram(img, 1, integer=True)
+        bins = len(binCount)
+        h = 1.06 * len(imgNorm) ** (-1 / 5) * np.argmax(binCount) / bins
+        if not h > 0:
+            # histogram mode in the first bin, no kernel density estimate
+            skipped += 1
+            continue
+        start = time.perf_counter()
+        binned = snrHistogram.kdeMode(imgNorm, bins, h)
+        binned_time += time.perf_counter() - start
+        start = time.perf_counter()
+        direct = directMode(imgNorm, bins, h)
+        direct_time += time.perf_counter() - start
+        total += 1
+        differing += binned != direct
+
+    if total == 0:
+        sys.exit("Error: no slice with a kernel density estimate.")
+    print('slices: %d (skipped with the histogram mode in the first bin: %d)' % (total, skipped))
+    print('binned (FFT): %8.1f ms per slice' % (1000 * binned_time / total))
+    print('direct sum:   %8.1f ms per slice' % (1000 * direct_time / total))
+    print('differing modes: %d' % differing)
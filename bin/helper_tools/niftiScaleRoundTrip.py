@@ -0,0 +1,98 @@
+"""
+Checks that the voxel size scaling around FSL calls (niftiScale.py, copied
+into 2.1, 2.2, 2.3, 3.3 and 4.1) leaves the voxel data unchanged.
+
+Every image is scaled with scaleBy10(inv=False) and scaled back with
+scaleBy10(inv=True), and the result is compared with the input: the stored
+values, the data type, the scale factor (scl_slope/scl_inter), the scaled
+voxel values and the affine must be identical. Without -i, images of
+different data types with and without a scale factor are generated.
+
+Example:
+python niftiScaleRoundTrip.py
+python niftiScaleRoundTrip.py -i sub-01_ses-01_T2w.nii.gz sub-01_ses-01_EPI.nii.gz
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import nibabel as nii
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '2.1_T2PreProcessing'))
+import niftiScale
+
+
+def syntheticImages(work_dir, rng):
+    # (name, data type, slope, intercept) of the generated test images
+    cases = [('int16_scaled', np.int16, 0.37, 1.5), ('int16', np.int16, 1, 0),
+             ('uint8_scaled', np.uint8, 2.5, -10), ('float32', np.float32, 1, 0),
+             ('int32_scaled_4d', np.int32, 1e-3, 0)]
+    paths = []
+    for name, dtype, slope, inter in cases:
+        shape = (24, 20, 8, 5) if name.endswith('4d') else (24, 20, 8)
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            data = rng.integers(max(info.min, -30000), min(info.max, 30000), shape, endpoint=True).astype(dtype)
+        else:
+            data = rng.normal(0, 100, shape).astype(dtype)
+        img = nii.Nifti1Image(data, np.diag([0.1, 0.1, 0.5, 1]))
+        img.set_data_dtype(dtype)
+        img.header.set_slope_inter(slope, inter)
+        path = os.path.join(work_dir, name + '.nii.gz')
+        nii.save(img, path)
+        paths.append(path)
+    return paths
+
+
+def roundTripErrors(input_path, work_dir):
+    # Returns the list of differences between the input and its round trip
+    temp_path = niftiScale.scaleBy10(input_path, False,
+                                     os.path.join(work_dir, 'scaled_' + os.path.basename(input_path).split('.')[0] + '.nii'))
+    result_path = os.path.join(work_dir, 'result_' + os.path.basename(input_path))
+    niftiScale.scaleBy10(temp_path, True, result_path)
+
+    original, result = nii.load(input_path), nii.load(result_path)
+    errors = []
+    if original.get_data_dtype() != result.get_data_dtype():
+        errors.append('data type %s -> %s' % (original.get_data_dtype(), result.get_data_dtype()))
+    if not np.array_equal(original.dataobj.get_unscaled(), result.dataobj.get_unscaled()):
+        errors.append('stored values differ')
+    if (original.dataobj.slope, original.dataobj.inter) != (result.dataobj.slope, result.dataobj.inter):
+        errors.append('scale factor (%g, %g) -> (%g, %g)' % (original.dataobj.slope, original.dataobj.inter,
+                                                             result.dataobj.slope, result.dataobj.inter))
+    deviation = np.max(np.abs(np.asanyarray(original.dataobj) - np.asanyarray(result.dataobj)))
+    if deviation != 0:
+        errors.append('max. voxel deviation %g' % deviation)
+    if not np.allclose(original.affine, result.affine, rtol=0, atol=1e-6):
+        errors.append('affine differs')
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Checks that the FSL voxel size scaling leaves the voxel data unchanged.')
+    parser.add_argument('-i', '--input', nargs='+', help='NIfTI images to check. Default: generated test images')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='niftiScaleRoundTrip_')
+    try:
+        if args.input is None:
+            inputs = syntheticImages(work_dir, np.random.default_rng(0))
+        else:
+            for path in args.input:
+                if not os.path.exists(path):
+                    sys.exit("Error: '%s' is not an existing file." % (path,))
+            inputs = args.input
+        failed = 0
+        for path in inputs:
+            errors = roundTripErrors(path, work_dir)
+            failed += len(errors) > 0
+            print('%-40s %s' % (os.path.basename(path), 'exact' if not errors else ', '.join(errors)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if failed:
+        sys.exit("\033[0;30;41m Failed \33[0m %d of %d images changed" % (failed, len(inputs)))
+    print("\033[0;30;42m Passed \33[0m")
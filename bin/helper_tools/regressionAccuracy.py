@@ -0,0 +1,91 @@
+"""
+Compares the in-process nuisance regression of the rs-fMRI processing with
+the slice-wise fsl_regfilt path it replaces.
+
+regress.regrSliceWise (NumPy) and regress.fsl_RegrSliceWise (fslsplit,
+fsl_regfilt per slice, fslmerge) are run on the same motion corrected input
+(the *_f.nii.gz of the regr folder) and regression tables (txtRegrPython),
+and the voxel-wise differences are reported. fsl_regfilt reads text tables,
+they are exported from the binary regressor table (*_regressors.npy) if the
+folder has none. Needs FSL and nipype.
+Instead of running FSL, a result of an earlier run of the FSL path can be
+given with -r.
+
+Example:
+python regressionAccuracy.py -i .../fMRI/regr/rs-fMRI_mcf_f.nii.gz -t .../fMRI/txtRegrPython
+"""
+
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import nibabel as nii
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '3.3_fMRIActivity'))
+import regress
+import getSingleRegTable
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares the NumPy nuisance regression of the rs-fMRI processing with fsl_regfilt.')
+    requiredNamed = parser.add_argument_group('required named arguments')
+    requiredNamed.add_argument('-i', '--input', help='Motion corrected 4D input of the regression (*_f.nii.gz)', required=True)
+    requiredNamed.add_argument('-t', '--txtRegr', help='Folder with the regressor tables (txtRegrPython)', required=True)
+    parser.add_argument('-r', '--reference', help='Result of the FSL path (*_RGR.nii.gz) instead of running FSL')
+    parser.add_argument('-a', '--tolerance', type=float, default=1e-4,
+                        help='Accepted deviation relative to the intensity range of the input. Default = 1e-4')
+    args = parser.parse_args()
+
+    for path in [args.input, args.txtRegr, args.reference]:
+        if path is not None and not os.path.exists(path):
+            sys.exit("Error: '%s' is not an existing file or directory." % (path,))
+    input_file = os.path.abspath(args.input)
+    txt_path = os.path.abspath(args.txtRegr)
+
+    work_dir = tempfile.mkdtemp(prefix='regressionAccuracy_')
+    try:
+        start = time.perf_counter()
+        numpy_file = regress.regrSliceWise(input_file, txt_path, work_dir)
+        print('NumPy regression: %.1f s' % (time.perf_counter() - start))
+
+        if args.reference is None:
+            # fsl_RegrSliceWise works in the temp folder next to its input
+            fsl_dir = os.path.join(work_dir, 'fsl')
+            os.makedirs(os.path.join(fsl_dir, 'temp'))
+            fsl_input = os.path.join(fsl_dir, os.path.basename(input_file))
+            shutil.copyfile(input_file, fsl_input)
+            if len(regress.findRegData(txt_path)) == 0:
+                design_file = glob.glob(os.path.join(txt_path, '*_regressors.npy'))[0]
+                txt_path = os.path.join(work_dir, 'txtRegrPython')
+                os.makedirs(txt_path)
+                getSingleRegTable.saveRegrDesign(np.load(design_file), txt_path,
+                                                 os.path.basename(design_file).split('_mcf_regressors')[0], text=True)
+            cwd = os.getcwd()
+            start = time.perf_counter()
+            reference_file = regress.fsl_RegrSliceWise(fsl_input, txt_path, fsl_dir)
+            print('FSL regression:   %.1f s' % (time.perf_counter() - start))
+            os.chdir(cwd)
+        else:
+            reference_file = args.reference
+
+        result = nii.load(numpy_file).get_fdata(dtype=np.float32)
+        reference = nii.load(reference_file).get_fdata(dtype=np.float32)
+        if result.shape != reference.shape:
+            sys.exit("Error: results differ in shape: %s vs. %s" % (result.shape, reference.shape))
+
+        data = nii.load(input_file).get_fdata(dtype=np.float32)
+        value_range = float(data.max() - data.min()) or 1.0
+        diff = np.abs(result - reference)
+        print('max. abs. difference:  %g' % diff.max())
+        print('mean abs. difference:  %g' % diff.mean())
+        print('max. difference relative to the intensity range: %g' % (diff.max() / value_range))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if diff.max() / value_range > args.tolerance:
+        sys.exit("\033[0;30;41m Failed \33[0m results differ by more than %g of the intensity range" % args.tolerance)
+    print("\033[0;30;42m Passed \33[0m")
@@ -0,0 +1,67 @@
+"""
+Benchmarks the seed voxel correlation statistics of
+3.3_fMRIActivity/correlate_seed_voxels.py for seeds of different size.
+
+For every seed size random time series are generated and the blocked
+statistics (pairwise_corr_stat) are timed together with their peak memory.
+Up to the size given with -f the former computation with the full
+np.corrcoef matrix is run as well and the largest deviation of the
+statistics is reported; its memory grows with the square of the seed size
+(50k voxels need more than 20 GB).
+
+Example:
+python seedCorrelationBenchmark.py -s 1000 10000 50000 -t 300
+"""
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '3.3_fMRIActivity'))
+from correlate_seed_voxels import pairwise_corr_stat
+
+
+def fullMatrixStat(ts):
+    # statistics of the upper triangle of the full r-to-z matrix, as computed before
+    with np.errstate(divide='ignore'):
+        matrix = np.arctanh(np.corrcoef(ts, rowvar=True))
+    triu_cc = matrix[np.triu_indices_from(matrix, k=1)]
+    triu_cc[np.isinf(triu_cc)] = np.nan
+    return np.array([np.nanmin(triu_cc), np.nanmax(triu_cc), np.nanmean(triu_cc), np.nanstd(triu_cc)])
+
+
+def measure(function, *args, **kwargs):
+    # Returns (result, wall time in s, peak memory in MB)
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the blocked seed voxel correlation statistics.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='Seed sizes in voxels. Default = 1000 10000 50000')
+    parser.add_argument('-t', '--timepoints', type=int, default=300, help='Number of time points. Default = 300')
+    parser.add_argument('-b', '--block_size', type=int, default=2048, help='Block size of the blocked computation. Default = 2048')
+    parser.add_argument('-f', '--full_max', type=int, default=10000, help='Largest seed size also computed with the full matrix. Default = 10000')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'voxels':>8} {'blocked [s]':>12} {'peak [MB]':>10} {'full [s]':>10} {'peak [MB]':>10} {'max. deviation':>15}")
+    for size in args.sizes:
+        # a shared signal gives the voxels a spread of positive correlations
+        ts = rng.standard_normal((size, args.timepoints)) + rng.standard_normal(args.timepoints) * rng.random((size, 1))
+        stat, duration, peak = measure(pairwise_corr_stat, ts, r_to_z=True, ignore_nan=True, block_size=args.block_size)
+        line = f"{size:>8} {duration:>12.2f} {peak:>10.0f}"
+        if size <= args.full_max:
+            full, full_duration, full_peak = measure(fullMatrixStat, ts)
+            line += f" {full_duration:>10.2f} {full_peak:>10.0f} {np.max(np.abs(stat - full)):>15.2e}"
+        else:
+            line += f" {'-':>10} {'-':>10} {'-':>15}"
+        print(line)
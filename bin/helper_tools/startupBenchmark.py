@@ -0,0 +1,97 @@
+"""
+Measures the import time of every AIDAmri entry point.
+
+Every script with a command line entry point (if __name__ == "__main__") in
+the stage folders of bin/ is imported in a fresh interpreter with its stage
+folder as working directory, as batchProc.py does. The main function is not
+called, so the measured time is what a step pays before it starts to work.
+The slowest direct imports of every script are taken from python -X importtime.
+
+Example:
+python startupBenchmark.py -r 5 -o startup_times.csv
+"""
+
+import os
+import re
+import sys
+import csv
+import glob
+import time
+import argparse
+import subprocess
+
+
+def findEntryPoints(bin_dir):
+    # scripts in the stage folders (2.1_T2PreProcessing, ...) with a command line entry point
+    scripts = []
+    for folder in sorted(glob.glob(os.path.join(bin_dir, "[0-9]*"))):
+        for script in sorted(glob.glob(os.path.join(folder, "*.py"))):
+            with open(script, errors="ignore") as infile:
+                if re.search(r"^if __name__ == ['\"]__main__['\"]", infile.read(), re.M):
+                    scripts.append(script)
+    return scripts
+
+
+def timeImport(script, repeat):
+    # Returns (best wall time in s, error message, slowest direct imports [(module, s)])
+    folder = os.path.dirname(script)
+    module = os.path.splitext(os.path.basename(script))[0]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=folder,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        duration = time.perf_counter() - start
+        if result.returncode != 0:
+            error = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+            return None, error[-1] if error else f"exit code {result.returncode}", []
+        best = duration if best is None else min(best, duration)
+
+    # import time: self [us] | cumulative | imported package, nesting by indentation;
+    # the imports of the script itself are one level below the script
+    imports = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)", line)
+        if match and len(match.group(2)) == 3:
+            imports.append((match.group(3), int(match.group(1)) / 1e6))
+    return best, None, sorted(imports, key=lambda item: -item[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measures the import time of every AIDAmri entry point in a fresh interpreter.')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs per script, the fastest is reported. Default = 3')
+    parser.add_argument('-n', '--top', type=int, default=3, help='Number of slowest direct imports listed per script. Default = 3')
+    parser.add_argument('-o', '--output', help='Optional CSV file for the results')
+    args = parser.parse_args()
+
+    bin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"])
+        times.append(time.perf_counter() - start)
+    baseline = min(times)
+    print(f"Interpreter start without imports: {baseline:.3f} s\n")
+
+    rows = []
+    for script in findEntryPoints(bin_dir):
+        name = os.path.relpath(script, bin_dir)
+        duration, error, imports = timeImport(script, args.repeat)
+        top = ", ".join(f"{module} {seconds:.2f} s" for module, seconds in imports[:args.top])
+        rows.append({"script": name, "seconds": duration, "error": error or "", "slowest_imports": top})
+
+    for row in sorted(rows, key=lambda row: -(row["seconds"] or 0)):
+        if row["error"]:
+            print(f"{'failed':>9}  {row['script']}  ({row['error']})")
+        else:
+            print(f"{row['seconds']:>7.3f} s  {row['script']}  [{row['slowest_imports']}]")
+
+    total = sum(row["seconds"] for row in rows if row["seconds"] is not None)
+    print(f"\n{len(rows)} entry points, {total:.2f} s import time in total")
+
+    if args.output:
+        with open(args.output, "w", newline="") as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=["script", "seconds", "error", "slowest_imports"])
+            writer.writeheader()
+            writer.writerows(rows)
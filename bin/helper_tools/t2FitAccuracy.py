@@ -0,0 +1,71 @@
+"""
+Compares the batched T2 fit of the T2 mapping (PV2NIfTiConverter/P2_IDLt2_mapping.py)
+with the former fit of every voxel with lmfit.
+
+Mono-exponential decays with random T2, S0 (and Y0) and Gaussian noise are
+generated, estimated with t2_estimate (all voxels at once, by the batched
+fit or by dictionary matching, -t) and with mpfitfun (one lmfit Minimizer per
+voxel), and the run times and the deviations of T2 and of the residual sum of
+squares are reported. Needs lmfit.
+
+Example:
+python t2FitAccuracy.py -m T2_2p -n 2000 -u 100
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PV2NIfTiConverter import P2_IDLt2_mapping
+
+
+def residualSS(params, te, y):
+    # residual sum of squares of every voxel
+    model = params[:, 1, np.newaxis] * np.exp(-te / params[:, 0, np.newaxis])
+    if params.shape[1] == 3:
+        model = model + params[:, 2, np.newaxis]
+    return np.square(model - y).sum(axis=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares the batched T2 fit with the voxel-wise lmfit fit.')
+    parser.add_argument('-m', '--model', default='T2_2p', choices=['T2_2p', 'T2_3p'], help='Decay model. Default = T2_2p')
+    parser.add_argument('-n', '--voxels', type=int, default=2000, help='Number of voxels. Default = 2000')
+    parser.add_argument('-u', '--upLim', type=float, default=100, help='Upper limit of T2. Default = 100')
+    parser.add_argument('-e', '--echoTimes', type=float, nargs='+', default=list(np.arange(1, 17) * 10.0),
+                        help='Echo times. Default = 10 20 ... 160')
+    parser.add_argument('-t', '--t2Method', default='fit', choices=['fit', 'dictionary'], help='T2 estimation. Default = fit')
+    parser.add_argument('-s', '--noise', type=float, default=20, help='Standard deviation of the noise. Default = 20')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    te = np.asarray(args.echoTimes)
+    T2 = rng.uniform(0.15, 0.9, args.voxels) * args.upLim
+    S0 = rng.uniform(500, 3000, args.voxels)
+    y = S0[:, np.newaxis] * np.exp(-te / T2[:, np.newaxis])
+    if args.model == 'T2_3p':
+        y += rng.uniform(0, 200, (args.voxels, 1))
+    y = np.abs(y + rng.normal(0, args.noise, y.shape))
+
+    start = time.perf_counter()
+    params = P2_IDLt2_mapping.t2_estimate(y, te, args.model, args.upLim, method=args.t2Method)
+    print('batched %s: %.2f s' % (args.t2Method, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    names = ['T2', 'S0', 'Y0'][:params.shape[1]]
+    reference = []
+    for voxel in y:
+        result = P2_IDLt2_mapping.mpfitfun(voxel, te, args.model, args.upLim)
+        reference.append([result[name].value for name in names])
+    reference = np.array(reference)
+    print('lmfit: %.2f s' % (time.perf_counter() - start))
+
+    diff = np.abs(params[:, 0] - reference[:, 0])
+    excess = (residualSS(params, te, y) - residualSS(reference, te, y)) / residualSS(reference, te, y)
+    print('max. abs. T2 difference:    %g' % diff.max())
+    print('median abs. T2 difference:  %g' % np.median(diff))
+    print('voxels with a smaller residual than lmfit: %.1f %%' % (100 * np.mean(excess < 0)))
+    print('max. relative residual excess over lmfit:  %g' % excess.max())
@@ -0,0 +1,91 @@
+"""
+Benchmarks the T2 mapping (PV2NIfTiConverter/P2_IDLt2_mapping.py) of a
+multi echo volume with the slices mapped one after another and distributed
+over a process pool.
+
+The volume is given with -i (x, y, echoes, slices, e.g. *_T2w_MEMS.nii.gz)
+together with its echo times, or a synthetic volume with mono-exponential
+decays and Rician noise is generated. The throughput of t2_mapping with one
+worker and with -w workers is reported together with the largest deviation
+of the two maps (expected: 0). The maps are float32; the deviation from the
+maps rounded to the data type of the input, in which they were stored
+before, is reported as well.
+
+Example:
+python t2MappingBenchmark.py -w 4 -n 20
+python t2MappingBenchmark.py -i sub-01_ses-01_T2w_MEMS.nii.gz -e 10 20 30 40 50 60 70 80 -w 4
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import nibabel as nii
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PV2NIfTiConverter import P2_IDLt2_mapping
+
+
+def syntheticVolume(size, slices, te, rng):
+    # disc of brain tissue with random T2 and S0, Rician noise, stored as int16
+    yy, xx = np.mgrid[:size, :size]
+    brain = (xx - size / 2) ** 2 + (yy - size / 2) ** 2 < (0.35 * size) ** 2
+    T2 = rng.uniform(30, 80, (size, size, 1, slices))
+    S0 = np.where(brain[:, :, np.newaxis, np.newaxis], rng.uniform(1000, 3000, (size, size, 1, slices)), 0)
+    signal = S0 * np.exp(-te[np.newaxis, np.newaxis, :, np.newaxis] / T2)
+    noise = rng.normal(0, 30, signal.shape) + 1j * rng.normal(0, 30, signal.shape)
+    return nii.Nifti1Image(np.abs(signal + noise).astype(np.int16), np.eye(4))
+
+
+def timedMapping(data, te, args, workers):
+    # Returns (maps, wall time in s)
+    finished = []
+    start = time.perf_counter()
+    maps = P2_IDLt2_mapping.t2_mapping(data, te, args.model, args.upLim, args.snrLim, args.snrMethod,
+                                       method=args.t2Method, workers=workers, callback=finished.append)
+    duration = time.perf_counter() - start
+    if sum(finished) != maps.shape[2]:
+        sys.exit("Error: progress callback reported %d of %d slices." % (sum(finished), maps.shape[2]))
+    return maps, duration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the serial and the parallel T2 mapping of a volume.')
+    parser.add_argument('-i', '--input', help='Multi echo volume (x, y, echoes, slices). Default: synthetic volume')
+    parser.add_argument('-e', '--echoTimes', type=float, nargs='+', default=list(np.arange(1, 17) * 10.0),
+                        help='Echo times. Default = 10 20 ... 160')
+    parser.add_argument('-n', '--slices', type=int, default=20, help='Slices of the synthetic volume. Default = 20')
+    parser.add_argument('-x', '--size', type=int, default=256, help='In-plane size of the synthetic volume. Default = 256')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Workers of the parallel run. Default = number of CPUs')
+    parser.add_argument('-m', '--model', default='T2_2p', choices=['T2_2p', 'T2_3p'], help='Decay model. Default = T2_2p')
+    parser.add_argument('-t', '--t2Method', default='fit', choices=['fit', 'dictionary'], help='T2 estimation. Default = fit')
+    parser.add_argument('-u', '--upLim', type=float, default=100, help='Upper limit of T2. Default = 100')
+    parser.add_argument('-s', '--snrLim', type=float, default=1.5, help='Minimal SNR of fitted voxels. Default = 1.5')
+    parser.add_argument('-k', '--snrMethod', default='Brummer', help='SNR estimation (Brummer, Chang, Sijbers). Default = Brummer')
+    args = parser.parse_args()
+
+    te = np.asarray(args.echoTimes)
+    if args.input is None:
+        data = syntheticVolume(args.size, args.slices, te, np.random.default_rng(0))
+    elif os.path.exists(args.input):
+        data = nii.load(args.input)
+    else:
+        sys.exit("Error: '%s' is not an existing file." % (args.input,))
+    if data.ndim != 4 or data.shape[2] != len(te):
+        sys.exit("Error: volume of shape %s does not match %d echo times." % (data.shape, len(te)))
+    slices = data.shape[3]
+
+    serial, serial_time = timedMapping(data, te, args, 1)
+    print('1 worker:   %6.1f s  %6.2f slices/s' % (serial_time, slices / serial_time))
+    parallel, parallel_time = timedMapping(data, te, args, args.workers)
+    print('%d workers: %6.1f s  %6.2f slices/s' % (args.workers, parallel_time, slices / parallel_time))
+
+    print('max. abs. difference serial vs. parallel:     %g' % np.max(np.abs(serial - parallel)))
+    fitted = serial[:, :, :, 0] > 0
+    dtype = data.get_data_dtype()
+    if np.issubdtype(dtype, np.integer):
+        # assignment to an integer array truncates towards zero
+        truncated = serial[:, :, :, 0][fitted].astype(dtype).astype(np.float32)
+        print('mean abs. T2 change by storing as %s:      %g' % (dtype, np.mean(np.abs(serial[:, :, :, 0][fitted] - truncated))))
+    print('fitted voxels: %d, T2 range %.2f - %.2f' % (fitted.sum(), serial[:, :, :, 0][fitted].min(), serial[:, :, :, 0][fitted].max()))